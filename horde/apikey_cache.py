@@ -0,0 +1,72 @@
+import time
+from collections import OrderedDict
+from datetime import timedelta
+from threading import Lock
+
+from horde.logger import logger
+from horde import horde_redis as hr
+
+# How long each node trusts its own copy of an api key before asking redis again
+LOCAL_TTL_SECONDS = 10
+# How many api keys each node keeps in memory
+LOCAL_MAX_ENTRIES = 10000
+REDIS_TTL = timedelta(minutes=5)
+
+
+class ApiKeyCache:
+    '''Maps hashed api keys to the id of their user
+    Each node keeps the most recently used keys in memory for a few seconds,
+    and all nodes share them through redis for a few minutes
+    '''
+
+    def __init__(self):
+        self.entries = OrderedDict()
+        self.lock = Lock()
+
+    def get_redis_key(self, hashed_api_key):
+        return f"apikey_user_{hashed_api_key}"
+
+    def get(self, hashed_api_key):
+        '''Returns the cached user details of this api key, or None if they're not cached'''
+        with self.lock:
+            entry = self.entries.get(hashed_api_key)
+            if entry is not None:
+                if entry[0] > time.monotonic():
+                    self.entries.move_to_end(hashed_api_key)
+                    return entry[1]
+                del self.entries[hashed_api_key]
+        try:
+            user_details = hr.horde_r_get_json(self.get_redis_key(hashed_api_key))
+        except Exception as err:
+            logger.warning(f"Failed to retrieve cached api key: {err}")
+            return None
+        if user_details is not None:
+            self.store_locally(hashed_api_key, user_details)
+        return user_details
+
+    def set(self, hashed_api_key, user_details):
+        self.store_locally(hashed_api_key, user_details)
+        try:
+            hr.horde_r_setex_json(self.get_redis_key(hashed_api_key), REDIS_TTL, user_details)
+        except Exception as err:
+            logger.warning(f"Failed to cache api key: {err}")
+
+    def store_locally(self, hashed_api_key, user_details):
+        with self.lock:
+            self.entries[hashed_api_key] = (time.monotonic() + LOCAL_TTL_SECONDS, user_details)
+            self.entries.move_to_end(hashed_api_key)
+            while len(self.entries) > LOCAL_MAX_ENTRIES:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, hashed_api_key):
+        '''Forgets this api key, so that its user is loaded again on the next request
+        Other nodes might keep using their own copy for a few more seconds
+        '''
+        with self.lock:
+            self.entries.pop(hashed_api_key, None)
+        try:
+            hr.horde_r_delete(self.get_redis_key(hashed_api_key))
+        except Exception as err:
+            logger.warning(f"Failed to invalidate cached api key: {err}")
+
+apikey_cache = ApiKeyCache()
@@ -70,6 +70,9 @@ class TextModels(v2.Models):
             'softprompt': fields.String(description="The soft prompt requested for this generation."),
             'model': fields.String(description="Which of the available models to use for this request."),
         })
+        self.response_model_job_pop_batch = api.inherit('GenerationPayloadKoboldBatch', self.response_model_job_pop, {
+            'jobs': fields.List(fields.Nested(self.response_model_job_pop, skip_none=True), description="When popping more than one job, this contains all the popped jobs, including the one at the top level."),
+        })
         self.input_model_job_pop = api.inherit('PopInputKobold', self.input_model_job_pop, {
             'max_length': fields.Integer(default=512,description="The maximum amount of tokens this worker can generate."),
             'max_context_length': fields.Integer(default=2048,description="The max amount of context to submit to this AI for sampling."), 
@@ -109,6 +109,9 @@ class ImageModels(v2.Models):
             'source_mask': fields.String(description="If img_processing is set to 'inpainting' or 'outpainting', this parameter can be optionally provided as the mask of the areas to inpaint. If this arg is not passed, the inpainting/outpainting mask has to be embedded as alpha channel."),
             'r2_upload': fields.String(description="The r2 upload link to use to upload this image."),
         })
+        self.response_model_job_pop_batch = api.inherit('GenerationPayloadStableBatch', self.response_model_job_pop, {
+            'jobs': fields.List(fields.Nested(self.response_model_job_pop, skip_none=True), description="When popping more than one job, this contains all the popped jobs, including the one at the top level."),
+        })
         self.input_model_job_pop = api.inherit('PopInputStable', self.input_model_job_pop, {
             'max_pixels': fields.Integer(default=512*512,description="The maximum amount of pixels this worker can generate."),
             'blacklist': fields.List(fields.String(description="Words which, when detected will refuste to pick up any jobs.")),
@@ -6,6 +6,7 @@ from horde.database import functions as database
 from horde.classes.base import stats
 from horde.classes import processing_generations,waiting_prompts,Worker,WaitingPrompt
 from horde import maintenance, cm
+from horde.countermeasures import IP_CHECK_PENDING
 from enum import Enum
 import os, time, json
 
@@ -250,7 +251,10 @@ class PromptPop(Resource):
     @api.expect(parser)
     def post(self):
         args = self.parser.parse_args()
-        if not cm.is_ip_safe(request.remote_addr):
+        safe_ip = cm.is_ip_safe(request.remote_addr)
+        if safe_ip == IP_CHECK_PENDING:
+            return(f"We are getting too many new workers from unknown IPs. To prevent abuse, please try again later.",403)
+        if not safe_ip:
             return(f"Due to abuse prevention, we cannot accept workers from your IP address. Please contact us on Discord if you feel this is a mistake.",403)
         skipped = {}
         user = database.find_user_by_api_key(args['api_key'])
@@ -10,7 +10,7 @@ from horde.argparser import maintenance, invite_only
 from horde.classes import Worker, WaitingPrompt
 from horde.database import functions as database
 from horde.classes.base import stats
-from horde.countermeasures import CounterMeasures
+from horde.countermeasures import CounterMeasures, IP_CHECK_PENDING
 from horde.flask import db
 from horde.limiter import limiter
 from horde.logger import logger
@@ -265,7 +265,10 @@ class PromptPop(Resource):
     decorators = [limiter.limit("45/second")]
     @api.expect(parser)
     def post(self):
-        if not CounterMeasures.is_ip_safe(request.remote_addr):
+        safe_ip = CounterMeasures.is_ip_safe(request.remote_addr)
+        if safe_ip == IP_CHECK_PENDING:
+            return f"We are getting too many new workers from unknown IPs. To prevent abuse, please try again later.", 403
+        if not safe_ip:
             return f"Due to abuse prevention, we cannot accept workers from your IP address. Please contact us on Discord if you feel this is a mistake.", 403
         args = self.parser.parse_args()
         skipped = {}
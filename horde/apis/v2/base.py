@@ -17,7 +17,7 @@ from horde.limiter import limiter
 from horde.logger import logger
 from horde.argparser import args
 from horde import exceptions as e
-from horde.classes.base.user import User, UserSharedKey
+from horde.classes.base.user import User, UserSharedKey, has_role_flag
 from horde.classes.base.waiting_prompt import WaitingPrompt
 from horde.classes.base.worker import Worker
 import horde.classes.base.stats as stats
@@ -26,12 +26,15 @@ from horde.classes.base.news import News
 from horde.classes.base.detection import Filter
 from horde.suspicions import Suspicions
 from horde.utils import is_profane, sanitize_string, hash_api_key, hash_dictionary
-from horde.countermeasures import CounterMeasures
+from horde.countermeasures import CounterMeasures, IP_CHECK_PENDING
 from horde import horde_redis as hr
+from horde.cached_request import cached_request
+from horde import dispatch
 from horde.patreon import patrons
 from horde.detection import prompt_checker
 from horde.r2 import upload_prompt
 from horde.consts import HORDE_VERSION, WHITELISTED_SERVICE_IPS
+from horde.enums import UserRoleTypes
 
 # Not used yet
 authorizations = {
@@ -381,11 +384,17 @@ class JobPopTemplate(Resource):
         self.models = []
         if self.args.models:
             self.models = self.args.models
+        self.amount = 1
+        if self.args.amount:
+            self.amount = self.args.amount
+        # We pick up at least as many WPs per page as the jobs we want to pop
+        self.wp_per_page = max(3, self.amount)
+        self.wait_seconds = 0
+        if self.args.wait_seconds:
+            self.wait_seconds = min(self.args.wait_seconds, dispatch.MAX_POP_WAIT_SECONDS)
         self.worker_ip = request.remote_addr
         self.validate()
         self.check_in()
-        # This ensures that the priority requested by the bridge is respected
-        self.prioritized_wp = []
         # self.priority_users = [self.user]
         ## Start prioritize by bridge request ##
         pre_priority_user_ids = [x.split("#")[-1] for x in self.priority_usernames]
@@ -399,20 +408,47 @@ class JobPopTemplate(Resource):
         #     priority_user = database.find_user_by_username(priority_username)
         #     if priority_user:
         #        self.priority_users.append(priority_user)
-        self.wp_page = 0
+        pop_ret = self.find_jobs()
+        if pop_ret is not None:
+            return pop_ret, 200
+        if self.wait_seconds > 0 and dispatch.new_wp_listener.park():
+            try:
+                # We don't want to keep our DB connection while the request is parked
+                db.session.commit()
+                wait_until = time.time() + self.wait_seconds
+                while dispatch.new_wp_listener.wait(self.worker_class.wtype, self.models, wait_until - time.time()):
+                    self.skipped = {}
+                    pop_ret = self.find_jobs()
+                    if pop_ret is not None:
+                        return pop_ret, 200
+                    db.session.commit()
+            finally:
+                dispatch.new_wp_listener.unpark()
+        # We report maintenance exception only if we couldn't find any jobs
+        if self.worker.maintenance:
+            raise e.WorkerMaintenance(self.worker.maintenance_msg)
+        # logger.warning(datetime.utcnow())
+        return({"id": None, "skipped": self.skipped}, 200)
+
+    def find_jobs(self):
+        '''Goes through the WPs this worker can pick up and pops as many jobs as requested
+        Returns None if no job was popped
+        '''
+        # This ensures that the priority requested by the bridge is respected
+        self.prioritized_wp = []
         wp_list = self.get_sorted_wp(self.priority_user_ids)
         for wp in wp_list:
             self.prioritized_wp.append(wp)
         ## End prioritize by bridge request ##
-        for wp in self.get_sorted_wp():
+        sorted_wp = self.get_sorted_wp()
+        for wp in sorted_wp:
             if wp.id not in [wp.id for wp in self.prioritized_wp]:
                 self.prioritized_wp.append(wp)
         # logger.warning(datetime.utcnow())
+        self.pops = []
         while len(self.prioritized_wp) > 0:
-            for wp in self.prioritized_wp:
-                check_gen = self.worker.can_generate(wp)
-                if not check_gen[0]:
-                    skipped_reason = check_gen[1]
+            for wp, can_generate, skipped_reason in self.worker.filter_generatable(self.prioritized_wp):
+                if not can_generate:
                     # We don't report on secret skipped reasons
                     # as they're typically countermeasures to raids
                     if skipped_reason != "secret":
@@ -424,27 +460,37 @@ class JobPopTemplate(Resource):
                 # time.sleep(random.uniform(0, 1))
                 if not wp.needs_gen():  # this says if < 1
                     continue
-                worker_ret = self.start_worker(wp)
-                # logger.debug(worker_ret)
-                if worker_ret is None:
-                    continue
-                # logger.debug(worker_ret)
-                return worker_ret, 200
-            self.wp_page += 1
-            self.prioritized_wp = self.get_sorted_wp()
-            logger.debug(f"Couldn't find WP. Checking next page: {self.wp_page}")
-        # We report maintenance exception only if we couldn't find any jobs
-        if self.worker.maintenance:
-            raise e.WorkerMaintenance(self.worker.maintenance_msg)
-        # logger.warning(datetime.utcnow())
-        return({"id": None, "skipped": self.skipped}, 200)
-
-    def get_sorted_wp(self,priority_user_ids=None):
+                # A WP with n > 1 can provide more than one of the jobs we're popping
+                # But a paused worker only gets a single fake job out of each WP
+                wp_jobs = min(wp.n, self.amount - len(self.pops))
+                if self.is_faking(wp):
+                    wp_jobs = 1
+                for _ in range(wp_jobs):
+                    worker_ret = self.start_worker(wp)
+                    # logger.debug(worker_ret)
+                    if worker_ret is None:
+                        break
+                    self.pops.append(worker_ret)
+                if len(self.pops) >= self.amount:
+                    return self.get_pop_response()
+            if len(sorted_wp) == 0:
+                break
+            # The WPs we popped to n=0 already drop out of the query in this transaction
+            # so we continue after the last WP we've seen, instead of skipping by offset
+            sorted_wp = self.get_sorted_wp(after_wp=sorted_wp[-1])
+            self.prioritized_wp = sorted_wp
+            logger.debug("Couldn't find WP. Checking next page")
+        if len(self.pops) > 0:
+            return self.get_pop_response()
+        return None
+
+    def get_sorted_wp(self,priority_user_ids=None, after_wp=None):
         '''Extendable class to retrieve the sorted WP list for this worker'''
         return database.get_sorted_wp_filtered_to_worker(
             self.worker,
             priority_user_ids=priority_user_ids,
-            page=self.wp_page
+            after_wp=after_wp,
+            per_page=self.wp_per_page,
         )
 
     # Making it into its own function to allow extension
@@ -452,12 +498,26 @@ class JobPopTemplate(Resource):
         # Paused worker gives a fake prompt
         # Unless the owner of the worker is the owner of the prompt
         # Then we allow them to fulfil their own request
-        if self.worker.paused and wp.user != self.worker.user:
-            ret = wp.fake_generation(self.worker)
+        # We commit all the popped jobs together in get_pop_response()
+        if self.is_faking(wp):
+            ret = wp.fake_generation(self.worker, commit=False)
         else:
-            ret = wp.start_generation(self.worker)
+            ret = wp.start_generation(self.worker, commit=False)
         return(ret)
 
+    def is_faking(self, wp):
+        return self.worker.paused and wp.user != self.worker.user
+
+    def get_pop_response(self):
+        '''Commits all the popped jobs at once and prepares the payload to send back
+        The first job is always sent at the top level, for workers which only pop one job at a time.
+        '''
+        db.session.commit()
+        pop_response = self.pops[0].copy()
+        if self.amount > 1:
+            pop_response["jobs"] = self.pops
+        return pop_response
+
     # We split this to its own function so that it can be extended with the specific vars needed to check in
     # You typically never want to use this template's function without extending it
     def check_in(self):
@@ -518,7 +578,7 @@ class JobPopTemplate(Resource):
         self.safe_ip = True
         if not self.user.trusted and not self.user.vpn and not patrons.is_patron(self.user.id):
             self.safe_ip = CounterMeasures.is_ip_safe(self.worker_ip)
-            if self.safe_ip is None:
+            if self.safe_ip is None or self.safe_ip == IP_CHECK_PENDING:
                 raise e.TooManyNewIPs(self.worker_ip)
             if self.safe_ip is False:
                 # Outside of a raid, we allow 1 worker in unsafe IPs from untrusted users. They will have to explicitly request it via discord
@@ -554,11 +614,16 @@ class JobSubmitTemplate(Resource):
         self.procgen = self.get_progen()
         if not self.procgen:
             raise e.InvalidJobID(self.args['id'])
-        self.user = database.find_user_by_api_key(self.args['apikey'])
-        if not self.user:
+        # The submitting user is only needed to check it owns the worker, so we don't load it
+        user_details = database.find_user_details_by_api_key(self.args['apikey'])
+        if not user_details:
             raise e.InvalidAPIKey('worker submit:' + self.args['name'])
-        if self.user != self.procgen.worker.user:
-            raise e.WrongCredentials(self.user.get_unique_alias(), self.procgen.worker.name)
+        if user_details["id"] != self.procgen.worker.user_id:
+            user = database.find_user_by_api_key(self.args['apikey'])
+            # The cached details can outlive the user, if it was deleted in the meantime
+            if not user:
+                raise e.InvalidAPIKey('worker submit:' + self.args['name'])
+            raise e.WrongCredentials(user.get_unique_alias(), self.procgen.worker.name)
         self.set_generation()
         if self.kudos == 0 and not self.procgen.worker.maintenance:
             raise e.DuplicateGen(self.procgen.worker.name, self.args['id'])
@@ -656,24 +721,24 @@ class Workers(Resource):
     def retrieve_workers_details(self):
         details_privilege = 0
         if self.args.apikey:
-            admin = database.find_user_by_api_key(self.args['apikey'])
-            if admin and admin.moderator:
+            admin_details = database.find_user_details_by_api_key(self.args['apikey'])
+            if admin_details and has_role_flag(admin_details["role_flags"], UserRoleTypes.MODERATOR):
                 details_privilege = 2
         if not hr.horde_r:
             return self.parse_worker_by_query(self.get_worker_info_list(details_privilege))
         if details_privilege == 2:
-            cached_workers = hr.horde_r_get('worker_cache_privileged')
+            cached_workers = hr.horde_r_get_decoded('worker_cache_privileged')
         else:
-            cached_workers = hr.horde_r_get('worker_cache')
+            cached_workers = hr.horde_r_get_decoded('worker_cache')
         if cached_workers is None:
             logger.warning(f"No {details_privilege} worker cache found! Check caching thread!")
-            workers = self.parse_worker_by_query(self.get_worker_info_list(details_privilege))
-            if details_privilege > 0:
-                hr.horde_local_setex_to_json("worker_cache_privileged", 300, workers)
-            else:
-                hr.horde_local_setex_to_json("worker_cache", 300, workers)
-            return workers
-        return self.parse_worker_by_query(json.loads(cached_workers))
+            cached_workers = self.get_fallback_worker_info_list(details_privilege)
+        return self.parse_worker_by_query(cached_workers)
+
+    @cached_request(key=lambda self, details_privilege: f"worker_cache_fallback_{details_privilege}", ttl=60)
+    def get_fallback_worker_info_list(self, details_privilege):
+        '''Used when the primary hasn't stored the worker cache, so that only one request at a time builds it'''
+        return self.get_worker_info_list(details_privilege)
 
     def get_worker_info_list(self, details_privilege):
         workers_ret = []
@@ -707,8 +772,8 @@ class WorkerSingle(Resource):
         details_privilege = 0
         self.args = self.get_parser.parse_args()
         if self.args.apikey:
-            admin = database.find_user_by_api_key(self.args['apikey'])
-            if admin and admin.moderator:
+            admin_details = database.find_user_details_by_api_key(self.args['apikey'])
+            if admin_details and has_role_flag(admin_details["role_flags"], UserRoleTypes.MODERATOR):
                 details_privilege = 2
         if not hr.horde_r:
             cache_exists = False
@@ -900,6 +965,21 @@ class Users(Resource):
         return users_ret
 
 
+def serialize_user_details(user_details):
+    cached_details = user_details.copy()
+    if "monthly_kudos" in cached_details:
+        cached_details["monthly_kudos"] = cached_details["monthly_kudos"].copy()
+    if user_details.get("monthly_kudos",{}).get("last_received"):
+        cached_details["monthly_kudos"]["last_received"] = cached_details["monthly_kudos"]["last_received"].isoformat()
+    return cached_details
+
+
+def deserialize_user_details(user_details):
+    if type(user_details.get("monthly_kudos",{}).get("last_received")) == str:
+        user_details["monthly_kudos"]["last_received"] = datetime.fromisoformat(user_details["monthly_kudos"]["last_received"])
+    return user_details
+
+
 class UserSingle(Resource):
     get_parser = reqparse.RequestParser()
     get_parser.add_argument("apikey", type=str, required=False, help="The Admin, Mod or Owner API key.", location='headers')
@@ -918,34 +998,26 @@ class UserSingle(Resource):
         self.args = self.get_parser.parse_args()
         details_privilege = 0
         if self.args.apikey:
-            resolved_user = database.find_user_by_api_key(self.args['apikey'])
-            if not resolved_user:
+            resolved_user_details = database.find_user_details_by_api_key(self.args['apikey'])
+            if not resolved_user_details:
                 raise e.InvalidAPIKey('User action: ' + 'GET UserSingle')
-            if resolved_user.moderator:
+            if has_role_flag(resolved_user_details["role_flags"], UserRoleTypes.MODERATOR):
                 details_privilege = 2
-            elif str(resolved_user.id) == str(user_id):
+            elif str(resolved_user_details["id"]) == str(user_id):
                 details_privilege = 1
-        cached_user = None
-        cache_name = f"cached_user_id_{user_id}_privilege_{details_privilege}"
-        if hr.horde_r:
-            cached_user = hr.horde_r_get(cache_name)
-        if cached_user:
-            user_details = json.loads(cached_user)
-            if type(user_details.get("monthly_kudos",{}).get("last_received")) == str:
-                user_details["monthly_kudos"]["last_received"] = datetime.fromisoformat(user_details["monthly_kudos"]["last_received"])
-        else:
-            user = database.find_user_by_id(user_id)
-            if not user:
-                raise e.UserNotFound(user_id)
-            user_details = user.get_details(details_privilege)
-            if hr.horde_r:
-                cached_details = user_details.copy()
-                if "monthly_kudos" in cached_details:
-                    cached_details["monthly_kudos"] = cached_details["monthly_kudos"].copy()
-                if user_details.get("monthly_kudos",{}).get("last_received"):
-                    cached_details["monthly_kudos"]["last_received"] = cached_details["monthly_kudos"]["last_received"].isoformat()
-                hr.horde_r_setex_json(cache_name, timedelta(seconds=30), cached_details)
-        return user_details,200
+        return self.retrieve_user_details(user_id, details_privilege),200
+
+    @cached_request(
+        key=lambda self, user_id, details_privilege: f"cached_user_id_{user_id}_privilege_{details_privilege}",
+        ttl=30,
+        serialize=serialize_user_details,
+        deserialize=deserialize_user_details,
+    )
+    def retrieve_user_details(self, user_id, details_privilege):
+        user = database.find_user_by_id(user_id)
+        if not user:
+            raise e.UserNotFound(user_id)
+        return user.get_details(details_privilege)
 
 
     parser = reqparse.RequestParser()
@@ -188,7 +188,7 @@ class TextJobPop(JobPopTemplate):
     worker_class = TextWorker
     decorators = [limiter.limit("60/second")]
     @api.expect(parsers.job_pop_parser, models.input_model_job_pop, validate=True)
-    @api.marshal_with(models.response_model_job_pop, code=200, description='Generation Popped')
+    @api.marshal_with(models.response_model_job_pop_batch, code=200, description='Generation Popped')
     @api.response(400, 'Validation Error', models.response_model_error)
     @api.response(401, 'Invalid API Key', models.response_model_error)
     @api.response(403, 'Access Denied', models.response_model_error)
@@ -219,13 +219,14 @@ class TextJobPop(JobPopTemplate):
         )
 
 
-    def get_sorted_wp(self, priority_user_ids=None):
+    def get_sorted_wp(self, priority_user_ids=None, after_wp=None):
         '''We're sending the lists directly, to avoid having to join tables'''
         sorted_wps = text_database.get_sorted_text_wp_filtered_to_worker(
             self.worker,
             self.models,
             priority_user_ids = priority_user_ids,
-            page = self.wp_page,
+            after_wp = after_wp,
+            per_page = self.wp_per_page,
         )        
 
         return sorted_wps
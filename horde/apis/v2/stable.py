@@ -7,7 +7,7 @@ from horde.classes.stable.waiting_prompt import ImageWaitingPrompt
 from horde.classes.stable.worker import ImageWorker
 from horde.classes.stable.interrogation import Interrogation
 from horde.classes.stable.interrogation_worker import InterrogationWorker
-from horde.countermeasures import CounterMeasures
+from horde.countermeasures import CounterMeasures, IP_CHECK_PENDING
 from horde.logger import logger
 from horde.classes.stable.genstats import compile_imagegen_stats_totals, compile_imagegen_stats_models
 from horde.image import ensure_source_image_uploaded, calculate_image_tiles
@@ -71,6 +71,9 @@ class ImageAsyncGenerate(GenerateTemplate):
         # During raids, we prevent VPNs
         if settings.mode_raid() and not self.user.trusted and not patrons.is_patron(self.user.id):
             self.safe_ip = CounterMeasures.is_ip_safe(self.user_ip)
+            # New IPs have to wait until they've been checked
+            if self.safe_ip == IP_CHECK_PENDING:
+                raise e.TooManyNewIPs(self.user_ip)
             # We allow unsafe IPs when being rate limited as they're only temporary
             if self.safe_ip is None:
                 self.safe_ip = True
@@ -370,7 +373,7 @@ class ImageJobPop(JobPopTemplate):
 
     decorators = [limiter.limit("60/second")]
     @api.expect(parsers.job_pop_parser, models.input_model_job_pop, validate=True)
-    @api.marshal_with(models.response_model_job_pop, code=200, description='Generation Popped')
+    @api.marshal_with(models.response_model_job_pop_batch, code=200, description='Generation Popped')
     @api.response(400, 'Validation Error', models.response_model_error)
     @api.response(401, 'Invalid API Key', models.response_model_error)
     @api.response(403, 'Access Denied', models.response_model_error)
@@ -420,14 +423,15 @@ class ImageJobPop(JobPopTemplate):
             priority_usernames = self.priority_usernames,
         )
 
-    def get_sorted_wp(self, priority_user_ids=None):
+    def get_sorted_wp(self, priority_user_ids=None, after_wp=None):
         '''We're sending the lists directly, to avoid having to join tables'''
         sorted_wps = database.get_sorted_wp_filtered_to_worker(
             self.worker,
             self.models,
             self.blacklist,
             priority_user_ids = priority_user_ids,
-            page = self.wp_page
+            after_wp = after_wp,
+            per_page = self.wp_per_page,
         )
         return sorted_wps
 
@@ -663,6 +667,9 @@ class Interrogate(Resource):
                 raise e.TooManyPrompts(self.username, i_count + len(self.forms), user_limit)
         if settings.mode_raid() and not self.user.trusted and not patrons.is_patron(self.user.id):
             self.safe_ip = CounterMeasures.is_ip_safe(self.user_ip)
+            # New IPs have to wait until they've been checked
+            if self.safe_ip == IP_CHECK_PENDING:
+                raise e.TooManyNewIPs(self.user_ip)
             # We allow unsafe IPs when being rate limited as they're only temporary
             if self.safe_ip is None:
                 self.safe_ip = True
@@ -871,11 +878,16 @@ class InterrogateSubmit(Resource):
         self.form = database.get_form_by_id(self.args['id'])
         if not self.form:
             raise e.InvalidJobID(self.args['id'])
-        self.user = database.find_user_by_api_key(self.args['apikey'])
-        if not self.user:
+        # The submitting user is only needed to check it owns the worker, so we don't load it
+        user_details = database.find_user_details_by_api_key(self.args['apikey'])
+        if not user_details:
             raise e.InvalidAPIKey('worker submit:' + self.args['name'])
-        if self.user != self.form.worker.user:
-            raise e.WrongCredentials(self.user.get_unique_alias(), self.form.worker.name)
+        if user_details["id"] != self.form.worker.user_id:
+            user = database.find_user_by_api_key(self.args['apikey'])
+            # The cached details can outlive the user, if it was deleted in the meantime
+            if not user:
+                raise e.InvalidAPIKey('worker submit:' + self.args['name'])
+            raise e.WrongCredentials(user.get_unique_alias(), self.form.worker.name)
 
 
 class ImageHordeStatsTotals(Resource):
@@ -1,3 +1,5 @@
+from functools import lru_cache
+
 from horde.logger import logger
 from horde.consts import KNOWN_POST_PROCESSORS
 
@@ -121,6 +123,90 @@ BRIDGE_SAMPLERS = {
     }
 }
 
+# Each known capability gets its own bit, so that we can check them with bitwise operations
+CAPABILITY_FLAGS = {}
+for bridge_versions in BRIDGE_CAPABILITIES.values():
+    for capabilities in bridge_versions.values():
+        for capability in sorted(capabilities):
+            if capability not in CAPABILITY_FLAGS:
+                CAPABILITY_FLAGS[capability] = 1 << len(CAPABILITY_FLAGS)
+
+# When it's an unknown worker agent we treat it like AI Horde Worker for samplers and post-processors
+FALLBACK_BRIDGE = ("AI Horde Worker", 23)
+
+
+class BridgeProfile:
+    """Everything a specific bridge name and version supports, precalculated"""
+    __slots__ = ("capabilities", "capability_flags", "karras_samplers", "all_samplers", "post_processors")
+
+    def __init__(self, capabilities, karras_samplers, all_samplers, post_processors):
+        self.capabilities = frozenset(capabilities)
+        self.capability_flags = 0
+        for capability in self.capabilities:
+            self.capability_flags |= CAPABILITY_FLAGS[capability]
+        self.karras_samplers = frozenset(karras_samplers)
+        self.all_samplers = frozenset(all_samplers)
+        self.post_processors = frozenset(post_processors)
+
+    def has_capability(self, capability):
+        flag = CAPABILITY_FLAGS.get(capability)
+        if flag is None:
+            return False
+        return bool(self.capability_flags & flag)
+
+    def get_samplers(self, karras=True):
+        # If karras == True, only karras samplers can be used.
+        # Else, all samplers can be used
+        if karras:
+            return self.karras_samplers
+        return self.all_samplers
+
+
+def accumulate_capabilities(bridge_name, bridge_version):
+    total_capabilities = set()
+    # Because we start from 0 
+    for iter, capabilities in BRIDGE_CAPABILITIES.get(bridge_name, {}).items():
+        if iter <= bridge_version:
+            total_capabilities.update(capabilities)
+    return total_capabilities
+
+def accumulate_samplers(bridge_name, bridge_version):
+    karras_samplers = set()
+    all_samplers = set()
+    for iter, samplers in BRIDGE_SAMPLERS[bridge_name].items():
+        if iter <= bridge_version:
+            karras_samplers.update(samplers["karras"])
+            all_samplers.update(samplers["karras"])
+            all_samplers.update(samplers["no karras"])
+    return karras_samplers, all_samplers
+
+def build_bridge_profile(bridge_name, bridge_version):
+    capabilities = accumulate_capabilities(bridge_name, bridge_version)
+    if bridge_name in BRIDGE_SAMPLERS:
+        sampler_bridge = (bridge_name, bridge_version)
+    else:
+        sampler_bridge = FALLBACK_BRIDGE
+    karras_samplers, all_samplers = accumulate_samplers(*sampler_bridge)
+    post_processors = {
+        capability 
+        for capability in accumulate_capabilities(*sampler_bridge) 
+        if capability in KNOWN_POST_PROCESSORS
+    }
+    return BridgeProfile(capabilities, karras_samplers, all_samplers, post_processors)
+
+def get_max_known_version(bridge_name):
+    known_versions = list(BRIDGE_CAPABILITIES.get(bridge_name, {}).keys()) + list(BRIDGE_SAMPLERS.get(bridge_name, {}).keys())
+    return max(known_versions)
+
+# We precalculate the profile of every version of every known bridge at import
+# Versions above the latest known one, support the same as the latest known one
+BRIDGE_PROFILES = {}
+for bridge_name in set(BRIDGE_CAPABILITIES) | set(BRIDGE_SAMPLERS):
+    for bridge_version in range(get_max_known_version(bridge_name) + 1):
+        BRIDGE_PROFILES[(bridge_name, bridge_version)] = build_bridge_profile(bridge_name, bridge_version)
+UNKNOWN_BRIDGE_PROFILE = build_bridge_profile("unknown", 0)
+
+
 def parse_bridge_agent(bridge_agent):
     try:
         bridge_name, bridge_version, _ = bridge_agent.split(":", 2)
@@ -134,48 +220,25 @@ def parse_bridge_agent(bridge_agent):
     # logger.debug([bridge_name, bridge_version])
     return bridge_name,bridge_version
 
-def check_bridge_capability(capability, bridge_agent):
+@lru_cache(maxsize=4096)
+def get_bridge_profile(bridge_agent):
+    '''Returns the precalculated BridgeProfile for this bridge agent string
+    As there's only a few distinct agent strings, we cache the parsing of each of them
+    '''
     bridge_name, bridge_version = parse_bridge_agent(bridge_agent)
-    if bridge_name not in BRIDGE_CAPABILITIES:
-        return False
-    total_capabilities = set()
-    # Because we start from 0 
-    for iter in range(bridge_version + 1):
-        if iter in BRIDGE_CAPABILITIES[bridge_name]:
-            total_capabilities.update(BRIDGE_CAPABILITIES[bridge_name][iter])
-    # logger.debug([total_capabilities, capability, capability in total_capabilities])
-    return capability in total_capabilities
+    if bridge_name not in BRIDGE_CAPABILITIES and bridge_name not in BRIDGE_SAMPLERS:
+        return UNKNOWN_BRIDGE_PROFILE
+    bridge_version = min(bridge_version, get_max_known_version(bridge_name))
+    return BRIDGE_PROFILES[(bridge_name, bridge_version)]
+
+def check_bridge_capability(capability, bridge_agent):
+    return get_bridge_profile(bridge_agent).has_capability(capability)
 
 def get_supported_samplers(bridge_agent, karras=True):
-    bridge_name, bridge_version = parse_bridge_agent(bridge_agent)
-    if bridge_name not in BRIDGE_SAMPLERS:
-        # When it's an unknown worker agent we treat it like AI Horde Worker
-        bridge_name = "AI Horde Worker"
-        bridge_version = 23
-    available_samplers = set()
-    for iter in range(bridge_version + 1):
-        if iter in BRIDGE_SAMPLERS[bridge_name]:
-            available_samplers.update(BRIDGE_SAMPLERS[bridge_name][iter]["karras"])
-            # If karras == True, only karras samplers can be used.
-            # Else, all samplers can be used
-            if not karras:
-                available_samplers.update(BRIDGE_SAMPLERS[bridge_name][iter]["no karras"])
-    # logger.debug([available_samplers, sampler, sampler in available_samplers])
-    return available_samplers
+    return get_bridge_profile(bridge_agent).get_samplers(karras)
 
 def check_sampler_capability(sampler, bridge_agent, karras=True):
-    return sampler in get_supported_samplers(bridge_agent, karras)
+    return sampler in get_bridge_profile(bridge_agent).get_samplers(karras)
 
 def get_supported_pp(bridge_agent):
-    bridge_name, bridge_version = parse_bridge_agent(bridge_agent)
-    if bridge_name not in BRIDGE_SAMPLERS:
-        # When it's an unknown worker agent we treat it like AI Horde Worker
-        bridge_name = "AI Horde Worker"
-        bridge_version = 23
-    available_pp = set()
-    for iter in range(bridge_version + 1):
-        if iter in BRIDGE_CAPABILITIES[bridge_name]:
-            for capability in BRIDGE_CAPABILITIES[bridge_name][iter]:
-                if capability in KNOWN_POST_PROCESSORS:
-                    available_pp.add(capability)
-    return available_pp
\ No newline at end of file
+    return get_bridge_profile(bridge_agent).post_processors
@@ -0,0 +1,273 @@
+import json
+import math
+import functools
+import random
+import time
+import uuid
+from datetime import timedelta
+from threading import Lock
+
+from horde.logger import logger
+from horde import horde_redis as hr
+
+# Only deletes the recompute lock if we're still the ones holding it
+RELEASE_LOCK_SCRIPT = """
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("del", KEYS[1])
+end
+return 0
+"""
+# The horde-wide metrics of all the cached requests, as "<name>:<metric>" fields
+METRICS_KEY = "cached_request_metrics"
+# How often each process adds the metrics it gathered to the horde-wide ones
+METRICS_FLUSH_SECONDS = 60
+# How long a thread waits between checks, while another thread computes a missing value
+WAIT_BACKOFF_START = 0.05
+WAIT_BACKOFF_MAX = 0.5
+
+
+class CacheMetrics:
+    '''Counts the hits, misses and recompute times of the cached requests of this process
+    and adds them to the horde-wide metrics in redis every now and then, in a single pipeline
+    '''
+
+    def __init__(self):
+        self.counters = {}
+        self.last_flush = time.time()
+        self.lock = Lock()
+
+    def record(self, name, metric, amount=1):
+        flush_counters = None
+        with self.lock:
+            field = f"{name}:{metric}"
+            self.counters[field] = self.counters.get(field, 0) + amount
+            if time.time() - self.last_flush > METRICS_FLUSH_SECONDS:
+                flush_counters = self.counters
+                self.counters = {}
+                self.last_flush = time.time()
+        # We don't hold the lock while we talk to redis
+        if flush_counters:
+            self.flush(flush_counters)
+
+    def flush(self, counters):
+        try:
+            pipe = hr.horde_r.pipeline(transaction=False)
+            for field, amount in counters.items():
+                pipe.hincrbyfloat(METRICS_KEY, field, amount)
+            pipe.execute()
+        except Exception as err:
+            logger.warning(f"Failed to store the cached request metrics: {err}")
+
+cache_metrics = CacheMetrics()
+
+def get_cache_metrics():
+    '''Returns the horde-wide metrics of each cached request, by its name'''
+    if not hr.horde_r:
+        return {}
+    metrics = {}
+    for field, value in (hr.horde_r_hgetall(METRICS_KEY) or {}).items():
+        name, metric = field.rsplit(':', 1)
+        metrics.setdefault(name, {})[metric] = float(value)
+    return metrics
+
+
+class CachedRequest:
+    '''Caches the result of an expensive DB request in redis (cache-aside)
+    * Only one thread in the horde recomputes an expired value, while the others wait for it,
+      or keep serving the stale value if there is one (stale-while-revalidate)
+    * Busy values are refreshed a bit before they expire, with a probability which rises
+      the closer they get to their expiry and the slower they are to recompute (XFetch)
+    The value is stored in redis along with its expiry and how long it took to compute
+    '''
+
+    def __init__(
+            self,
+            func,
+            key,
+            ttl,
+            stale_ttl=None,
+            serialize=None,
+            deserialize=None,
+            should_cache=None,
+            beta=1.0,
+            wait_seconds=2,
+            local_cache=True,
+        ):
+        self.func = func
+        self.name = func.__qualname__
+        # A function which receives the same arguments as func and returns the redis key
+        self.key = key
+        self.ttl = ttl
+        # How long after its expiry we can still serve a value, while it's being recomputed
+        self.stale_ttl = ttl if stale_ttl is None else stale_ttl
+        self.serialize = serialize
+        self.deserialize = deserialize
+        self.should_cache = should_cache
+        self.beta = beta
+        # How long to wait for another node to recompute a missing value, before doing it ourselves
+        self.wait_seconds = wait_seconds
+        # Without the local cache, every node sees a refreshed value straight away
+        self.local_cache = local_cache
+
+    def __call__(self, *args, **kwargs):
+        if not hr.horde_r:
+            return self.func(*args, **kwargs)
+        key = self.key(*args, **kwargs)
+        entry = self.read(key, remote=not self.local_cache)
+        if entry is not None:
+            now = time.time()
+            if now < entry["expiry"] and not self.refresh_early(entry, now):
+                cache_metrics.record(self.name, "hits")
+                return self.load(entry)
+            # Only one thread refreshes the value. Everyone else keeps serving it until it's replaced
+            lock_token = self.acquire(key)
+            if lock_token is None:
+                cache_metrics.record(self.name, "stale_hits")
+                return self.load(entry)
+            try:
+                # The local redis might still be holding a copy which another node has already replaced
+                fresh_entry = self.read(key, remote=True)
+                if fresh_entry is not None and fresh_entry["expiry"] > entry["expiry"]:
+                    cache_metrics.record(self.name, "hits")
+                    return self.load(fresh_entry)
+                if now < entry["expiry"]:
+                    cache_metrics.record(self.name, "early_refreshes")
+                else:
+                    cache_metrics.record(self.name, "expired_refreshes")
+                return self.recompute(key, *args, **kwargs)
+            finally:
+                self.release(key, lock_token)
+        cache_metrics.record(self.name, "misses")
+        lock_token = self.acquire(key)
+        if lock_token is None:
+            # Another thread is computing it. We give it a chance to finish, before we hit the DB as well
+            entry = self.wait_for(key)
+            if entry is not None:
+                cache_metrics.record(self.name, "waited_hits")
+                return self.load(entry)
+            return self.recompute(key, *args, **kwargs)
+        try:
+            # It might have been computed since we last looked
+            entry = self.read(key, remote=True)
+            if entry is not None:
+                return self.load(entry)
+            return self.recompute(key, *args, **kwargs)
+        finally:
+            self.release(key, lock_token)
+
+    def refresh(self, *args, **kwargs):
+        '''Recomputes the value straight away. Use this when the underlying data has changed'''
+        if not hr.horde_r:
+            return self.func(*args, **kwargs)
+        return self.recompute(self.key(*args, **kwargs), *args, **kwargs)
+
+    def invalidate(self, *args, **kwargs):
+        '''Drops the cached value, so that the next read recomputes it
+        Unlike refresh(), this doesn't touch the DB, so it can be used after a transaction has ended
+        '''
+        if not hr.horde_r:
+            return
+        key = self.key(*args, **kwargs)
+        try:
+            hr.horde_r_delete(key)
+        except Exception as err:
+            logger.warning(f"Failed to invalidate {key} cache: {err}")
+
+    def recompute(self, key, *args, **kwargs):
+        start = time.time()
+        value = self.func(*args, **kwargs)
+        delta = time.time() - start
+        cache_metrics.record(self.name, "recomputes")
+        cache_metrics.record(self.name, "recompute_seconds", delta)
+        if self.should_cache is not None and not self.should_cache(value):
+            return value
+        entry = {
+            "value": value if self.serialize is None else self.serialize(value),
+            "expiry": time.time() + self.ttl,
+            "delta": delta,
+        }
+        try:
+            hr.horde_r_setex(key, timedelta(seconds=self.ttl + self.stale_ttl), json.dumps(entry))
+        except Exception as err:
+            logger.debug(f"Error when trying to set {key} cache: {err}. Retrieving from DB.")
+        return value
+
+    def refresh_early(self, entry, now):
+        # -log(random) is exponentially distributed, so most requests won't refresh until very close to the expiry
+        return now - entry["delta"] * self.beta * math.log(1 - random.random()) >= entry["expiry"]
+
+    def read(self, key, remote=False):
+        try:
+            if remote:
+                cached_value = hr.horde_r.get(key)
+            else:
+                cached_value = hr.horde_r_get(key)
+            if cached_value is None:
+                return None
+            entry = json.loads(cached_value)
+            # Values stored in another format are just recomputed
+            if not isinstance(entry, dict) or "expiry" not in entry:
+                return None
+            return entry
+        except Exception as err:
+            logger.error(f"{key} cache could not be loaded: {err}")
+            return None
+
+    def load(self, entry):
+        if self.deserialize is None:
+            return entry["value"]
+        return self.deserialize(entry["value"])
+
+    def wait_for(self, key):
+        '''Waits for another thread to store the value, checking less and less often
+        so that a slow recompute doesn't get hammered by its waiters
+        '''
+        deadline = time.time() + self.wait_seconds
+        backoff = WAIT_BACKOFF_START
+        while time.time() < deadline:
+            time.sleep(min(backoff, max(deadline - time.time(), 0)))
+            entry = self.read(key, remote=True)
+            if entry is not None:
+                return entry
+            backoff = min(backoff * 2, WAIT_BACKOFF_MAX)
+        return None
+
+    def acquire(self, key):
+        '''Takes the horde-wide recompute lock of this key
+        Returns the token to release it with, or None if another thread is recomputing it
+        We never block on the lock, as cached requests can call other cached requests while they recompute
+        '''
+        lock_token = str(uuid.uuid4())
+        try:
+            if hr.horde_r.set(f"{key}_recompute_lock", lock_token, nx=True, ex=max(int(self.wait_seconds * 5), 10)):
+                return lock_token
+        except Exception as err:
+            # If we can't lock in redis, we just recompute it without a lock
+            logger.warning(f"Failed to lock {key} for recompute: {err}")
+            return lock_token
+        return None
+
+    def release(self, key, lock_token):
+        try:
+            hr.horde_r.eval(RELEASE_LOCK_SCRIPT, 1, f"{key}_recompute_lock", lock_token)
+        except Exception as err:
+            logger.warning(f"Failed to unlock {key} after recompute: {err}")
+
+
+def cached_request(key, ttl, **kwargs):
+    '''Decorator which caches the results of the function through a CachedRequest
+    `key` receives the same arguments as the function and returns the redis key to use
+    Use `function.refresh(*args)` to recompute the cached value after changing the data behind it
+    or `function.invalidate(*args)` to just drop it
+    '''
+    def decorator(func):
+        cached = CachedRequest(func, key, ttl, **kwargs)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            return cached(*args, **kwargs)
+        wrapper.refresh = cached.refresh
+        wrapper.invalidate = cached.invalidate
+        wrapper.cached_request = cached
+        return wrapper
+    return decorator
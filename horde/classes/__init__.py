@@ -18,6 +18,7 @@ from horde.classes.kobold.worker import TextWorker
 from horde.classes.base.settings import HordeSettings
 import horde.classes.base.stats
 from horde.classes.base.detection import Filter
+from horde.classes.base.kudos_ledger import KudosLedger
 
 with HORDE.app_context():
 
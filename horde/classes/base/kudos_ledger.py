@@ -0,0 +1,47 @@
+from datetime import datetime
+
+from sqlalchemy import Enum
+from sqlalchemy.dialects.postgresql import UUID, insert as postgres_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+from horde.flask import db, SQLITE_MODE
+from horde.enums import LedgerEventTypes, UserRecordTypes
+
+
+uuid_column_type = lambda: UUID(as_uuid=True) if not SQLITE_MODE else db.String(36)
+
+
+class KudosLedger(db.Model):
+    '''Append-only log of the kudos and records each job or uptime reward adds
+    It's written in the same transaction as the job itself, and the primary folds it into
+    the UserStats, UserRecords, WorkerStats and Team totals in the background
+    '''
+    __tablename__ = "kudos_ledger"
+    id = db.Column(db.BigInteger().with_variant(db.Integer, "sqlite"), primary_key=True)
+    event_type = db.Column(Enum(LedgerEventTypes), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey("users.id", ondelete="CASCADE"), nullable=True)
+    worker_id = db.Column(uuid_column_type(), db.ForeignKey("workers.id", ondelete="CASCADE"), nullable=True)
+    team_id = db.Column(uuid_column_type(), db.ForeignKey("teams.id", ondelete="CASCADE"), nullable=True)
+    # Only used for USER_RECORD events
+    record_type = db.Column(Enum(UserRecordTypes), nullable=True)
+    # The stats action, the user record, or the team column this event adds to
+    key = db.Column(db.String(30), nullable=False)
+    value = db.Column(db.Float, nullable=False)
+    created = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+
+
+def upsert_counters(model, index_elements, rows):
+    '''Adds the value of each row to the matching counter of the model in a single statement
+    creating the counters which don't exist yet
+    '''
+    if not rows:
+        return
+    if SQLITE_MODE:
+        stmt = sqlite_insert(model).values(rows)
+    else:
+        stmt = postgres_insert(model).values(rows)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=index_elements,
+        set_={"value": model.__table__.c.value + stmt.excluded.value},
+    )
+    db.session.execute(stmt)
@@ -37,11 +37,15 @@ class ProcessingGeneration(db.Model):
     worker_id = db.Column(uuid_column_type(), db.ForeignKey("workers.id"), nullable=False)
     created = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
 
-    def __init__(self, *args, **kwargs):
+    def __init__(self, *args, commit=True, **kwargs):
         super().__init__(*args, **kwargs)
         # If there has been no explicit model requested by the user, we just choose the first available from the worker
         db.session.add(self)
-        db.session.commit()
+        # When popping multiple jobs at once, the caller commits all of them together at the end
+        if commit:
+            db.session.commit()
+        else:
+            db.session.flush()
         worker_models = self.worker.get_model_names()
         if len(worker_models):
             self.model = worker_models[0]
@@ -52,7 +56,8 @@ class ProcessingGeneration(db.Model):
         for model in self.wp.get_model_names():
             if model in worker_models:
                 self.model = model
-        db.session.commit()
+        if commit:
+            db.session.commit()
 
     def set_generation(self, generation, things_per_sec, **kwargs):
         if self.is_completed():
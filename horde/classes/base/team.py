@@ -8,6 +8,8 @@ from horde.logger import logger
 from horde.flask import db, SQLITE_MODE
 from horde import vars as hv
 from horde.utils import is_profane, get_db_uuid, sanitize_string
+from horde.enums import LedgerEventTypes
+from horde.classes.base.kudos_ledger import KudosLedger
 
 uuid_column_type = lambda: UUID(as_uuid=True) if not SQLITE_MODE else db.String(36)
 
@@ -98,16 +100,20 @@ class Team(db.Model):
         db.session.commit()
 
     def record_uptime(self, seconds):
-        self.uptime += seconds
-        self.last_active = datetime.utcnow()
-        db.session.commit()
+        '''The team totals are shared by all its workers, so they're only added up later, through the kudos ledger'''
+        self.queue_totals(uptime=seconds)
     
     def record_contribution(self, contributions, kudos):
-        self.contributions = round(self.contributions + contributions, 2)
-        self.fulfilments += 1
-        self.kudos = round(self.kudos + kudos, 2)
-        self.last_active = datetime.utcnow()
-        db.session.commit()
+        self.queue_totals(contributions=contributions, fulfilments=1, kudos=kudos)
+
+    def queue_totals(self, **totals):
+        for column, value in totals.items():
+            db.session.add(KudosLedger(
+                event_type=LedgerEventTypes.TEAM,
+                team_id=self.id,
+                key=column,
+                value=value,
+            ))
 
    # Should be extended by each specific horde
     @logger.catch(reraise=True)
@@ -5,7 +5,8 @@ import ipaddress
 import dateutil.relativedelta
 from datetime import datetime, timedelta
 from typing import Optional
-from sqlalchemy import Enum, UniqueConstraint
+from sqlalchemy import Enum, UniqueConstraint, event
+from sqlalchemy.orm import Session, object_session
 from sqlalchemy.ext.hybrid import hybrid_property
 from sqlalchemy.dialects.postgresql import UUID
 
@@ -16,14 +17,50 @@ from horde import vars as hv
 from horde.suspicions import Suspicions, SUSPICION_LOGS
 from horde.utils import is_profane, sanitize_string, generate_client_id
 from horde.patreon import patrons
-from horde.enums import UserRecordTypes, UserRoleTypes
+from horde.enums import UserRecordTypes, UserRoleTypes, LedgerEventTypes
 from horde.utils import get_db_uuid
 from horde.discord import send_problem_user_notification
 from horde import horde_redis as hr
+from horde.cached_request import cached_request
+from horde.apikey_cache import apikey_cache
 from horde.countermeasures import CounterMeasures
+from horde.classes.base.kudos_ledger import KudosLedger, upsert_counters
 
 uuid_column_type = lambda: UUID(as_uuid=True) if not SQLITE_MODE else db.String(36)
 
+def has_role_flag(role_flags, role):
+    return bool(role_flags & (1 << role.value))
+
+# Role changes have to reach every node straight away, so these skip the local redis
+@cached_request(key=lambda user_id: f"user_{user_id}_role_flags", ttl=600, local_cache=False)
+def retrieve_role_flags(user_id):
+    '''Returns all the roles of this user as a bitmask, with one bit per UserRoleTypes value'''
+    role_flags = 0
+    for user_role, in db.session.query(UserRole.user_role).filter(
+        UserRole.user_id == user_id,
+        UserRole.value == True,
+    ):
+        role_flags |= 1 << user_role.value
+    return role_flags
+
+# The users whose roles were changed in a transaction which is still open
+# Their cached role flags are only dropped once it commits, so that no node sees uncommitted roles
+ROLE_CHANGES_KEY = "role_flags_changed"
+# The hashed api keys which were replaced or deleted in a transaction which is still open
+API_KEY_CHANGES_KEY = "api_keys_changed"
+
+@event.listens_for(Session, "after_commit")
+def invalidate_committed_user_caches(session):
+    for user_id in session.info.pop(ROLE_CHANGES_KEY, set()):
+        retrieve_role_flags.invalidate(user_id)
+    for hashed_api_key in session.info.pop(API_KEY_CHANGES_KEY, set()):
+        apikey_cache.invalidate(hashed_api_key)
+
+@event.listens_for(Session, "after_rollback")
+def discard_uncommitted_user_caches(session):
+    session.info.pop(ROLE_CHANGES_KEY, None)
+    session.info.pop(API_KEY_CHANGES_KEY, None)
+
 
 class UserProblemJobs(db.Model):
     __tablename__ = "user_problem_jobs"
@@ -40,6 +77,7 @@ class UserProblemJobs(db.Model):
 
 class UserStats(db.Model):
     __tablename__ = "user_stats"
+    __table_args__ = (UniqueConstraint('user_id', 'action', name='user_stats_user_id_action_key'),)
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey("users.id", ondelete="CASCADE"), nullable=False)
     user = db.relationship("User", back_populates="stats")
@@ -124,7 +162,6 @@ class UserSharedKey(db.Model):
                 self.kudos = 0
         self.utilized = round(self.utilized + kudos, 2)
         logger.debug(f"Utilized {kudos} from shared key {self.id}. {self.kudos} remaining.")
-        db.session.commit()
 
     def is_valid(self):
         if self.kudos == 0:
@@ -205,6 +242,12 @@ class User(db.Model):
     interrogations = db.relationship("Interrogation", back_populates="user", cascade="all, delete-orphan")
     filters = db.relationship("Filter", back_populates="user")
 
+    def has_role(self, role):
+        # The roles are only loaded once per user object, as they're checked many times per request
+        if getattr(self, "role_flags", None) is None:
+            self.role_flags = retrieve_role_flags(self.id)
+        return has_role_flag(self.role_flags, role)
+
     ## TODO: Figure out how to make the below work
     # def get_role_expr(cls, role):
     #     subquery = db.session.query(UserRole.user_id
@@ -219,11 +262,7 @@ class User(db.Model):
 
     @hybrid_property
     def trusted(self) -> bool:
-        user_role = UserRole.query.filter_by(
-            user_id=self.id, 
-            user_role=UserRoleTypes.TRUSTED
-        ).first()
-        return user_role is not None and user_role.value
+        return self.has_role(UserRoleTypes.TRUSTED)
 
     @trusted.expression
     def trusted(cls):
@@ -239,11 +278,7 @@ class User(db.Model):
 
     @hybrid_property
     def flagged(self) -> bool:
-        user_role = UserRole.query.filter_by(
-            user_id=self.id, 
-            user_role=UserRoleTypes.FLAGGED
-        ).first()
-        return user_role is not None and user_role.value
+        return self.has_role(UserRoleTypes.FLAGGED)
 
 
     @flagged.expression
@@ -260,11 +295,7 @@ class User(db.Model):
 
     @hybrid_property
     def moderator(self) -> bool:
-        user_role = UserRole.query.filter_by(
-            user_id=self.id, 
-            user_role=UserRoleTypes.MODERATOR
-        ).first()
-        return user_role is not None and user_role.value
+        return self.has_role(UserRoleTypes.MODERATOR)
 
     @moderator.expression
     def moderator(cls):
@@ -280,11 +311,7 @@ class User(db.Model):
 
     @hybrid_property
     def customizer(self) -> bool:
-        user_role = UserRole.query.filter_by(
-            user_id=self.id, 
-            user_role=UserRoleTypes.CUSTOMIZER
-        ).first()
-        return user_role is not None and user_role.value
+        return self.has_role(UserRoleTypes.CUSTOMIZER)
 
     @customizer.expression
     def customizer(cls):
@@ -300,11 +327,7 @@ class User(db.Model):
 
     @hybrid_property
     def vpn(self) -> bool:
-        user_role = UserRole.query.filter_by(
-            user_id=self.id, 
-            user_role=UserRoleTypes.VPN
-        ).first()
-        return user_role is not None and user_role.value
+        return self.has_role(UserRoleTypes.VPN)
 
     @vpn.expression
     def vpn(cls):
@@ -320,11 +343,7 @@ class User(db.Model):
 
     @hybrid_property
     def special(self) -> bool:
-        user_role = UserRole.query.filter_by(
-            user_id=self.id, 
-            user_role=UserRoleTypes.SPECIAL
-        ).first()
-        return user_role is not None and user_role.value
+        return self.has_role(UserRoleTypes.SPECIAL)
 
     @special.expression
     def special(cls):
@@ -390,7 +409,8 @@ class User(db.Model):
         db.session.commit()
         return("OK")
 
-    def set_user_role(self, role, value):
+    def set_user_role(self, role, value, commit=True):
+        '''When commit is False, the role change is written along with the rest of the caller's transaction'''
         user_role = UserRole.query.filter_by(
             user_id=self.id, 
             user_role=role,
@@ -401,7 +421,7 @@ class User(db.Model):
             else:
                 # No entry means false
                 db.session.delete(user_role)
-                db.session.commit()
+                self.store_user_role(commit)
                 return 
         if user_role is None:
             new_role = UserRole(
@@ -410,19 +430,33 @@ class User(db.Model):
                 value=value
             )
             db.session.add(new_role)
-            db.session.commit()
+            self.store_user_role(commit)
             return
         logger.debug(user_role)
         if user_role.value is False:
             user_role.value = True
+            self.store_user_role(commit)
+
+    def store_user_role(self, commit=True):
+        if commit:
             db.session.commit()
+            self.refresh_role_flags()
+            return
+        # The cached role flags are dropped when the caller commits, and left alone if it rolls back
+        db.session.flush()
+        db.session.info.setdefault(ROLE_CHANGES_KEY, set()).add(self.id)
+        # Until then, only this transaction sees the new roles
+        self.role_flags = retrieve_role_flags.__wrapped__(self.id)
 
-    def set_trusted(self,is_trusted):
+    def refresh_role_flags(self):
+        self.role_flags = retrieve_role_flags.refresh(self.id)
+
+    def set_trusted(self,is_trusted, commit=True):
         # Anonymous can never be trusted
         if self.is_anon():
             return
-        self.set_user_role(UserRoleTypes.TRUSTED, is_trusted)
-        if self.trusted:
+        self.set_user_role(UserRoleTypes.TRUSTED, is_trusted, commit=commit)
+        if is_trusted:
             for worker in self.workers:
                 worker.paused = False
 
@@ -458,37 +492,37 @@ class User(db.Model):
     def get_unique_alias(self):
         return(f"{self.username}#{self.id}")
 
-    def update_user_record(self, record_type, record, increment_value):
-        record_details = db.session.query(
-            UserRecords
-        ).filter_by(
+    def update_user_record(self, record_type, record, increment_value, commit=True):
+        # The value is always added to the existing value, in a single statement, so that concurrent updates can't lose each other
+        upsert_counters(
+            UserRecords,
+            ["user_id", "record_type", "record"],
+            [{"user_id": self.id, "record_type": record_type, "record": record, "value": round(increment_value, 2)}],
+        )
+        if commit:
+            db.session.commit()
+
+    def queue_user_record(self, record_type, record, increment_value):
+        '''Like update_user_record(), but the record is only updated later, through the kudos ledger
+        Doesn't commit, so that a whole job can be recorded in a single transaction
+        '''
+        db.session.add(KudosLedger(
+            event_type=LedgerEventTypes.USER_RECORD,
             user_id=self.id,
             record_type=record_type,
-            record=record
-        ).first()
-        if not record_details:
-            record_details = UserRecords(
-                user_id=self.id, 
-                record_type=record_type, 
-                record=record, 
-                value=round(increment_value,2)
-            )
-            db.session.add(record_details)
-        else:
-            # The value is always added to the existing value
-            record_details.value = round(record_details.value + increment_value, 2)
-        db.session.commit()
-
+            key=record,
+            value=increment_value,
+        ))
 
     def record_usage(self, raw_things, kudos, usage_type):
         self.last_active = datetime.utcnow()
-        self.modify_kudos(-kudos,"accumulated")
-        self.update_user_record(
+        self.queue_kudos(-kudos,"accumulated")
+        self.queue_user_record(
             record_type=UserRecordTypes.REQUEST, 
             record=usage_type, 
             increment_value=1
         )
-        self.update_user_record(
+        self.queue_user_record(
             record_type=UserRecordTypes.USAGE, 
             record=usage_type, 
             increment_value=raw_things * self.usage_multiplier / hv.thing_divisors[usage_type]
@@ -496,7 +530,7 @@ class User(db.Model):
 
     def record_contributions(self, raw_things, kudos, contrib_type):
         self.last_active = datetime.utcnow()
-        self.update_user_record(
+        self.queue_user_record(
             record_type=UserRecordTypes.FULFILLMENT, 
             record=contrib_type, 
             increment_value=1
@@ -506,11 +540,11 @@ class User(db.Model):
             kudos_eval = round(kudos / 2, 2)
             kudos -= kudos_eval
             self.evaluating_kudos += kudos_eval
-            self.modify_kudos(kudos,"accumulated")
+            self.queue_kudos(kudos,"accumulated")
             self.check_for_trust()
         else:
-            self.modify_kudos(kudos,"accumulated")
-        self.update_user_record(
+            self.queue_kudos(kudos,"accumulated")
+        self.queue_user_record(
             record_type=UserRecordTypes.CONTRIBUTION, 
             record=contrib_type, 
             increment_value=raw_things/hv.thing_divisors[contrib_type]
@@ -524,7 +558,7 @@ class User(db.Model):
             self.evaluating_kudos += kudos
             self.check_for_trust()
         else:
-            self.modify_kudos(kudos,"accumulated")
+            self.queue_kudos(kudos,"accumulated")
 
     def check_for_trust(self):
         '''After a user passes the evaluation threshold (?? kudos)
@@ -540,16 +574,17 @@ class User(db.Model):
         # An account has to exist for at least 1 week to become trusted automatically
         if (datetime.utcnow() - self.created).total_seconds() < 86400 * 7:
             return
-        self.modify_kudos(self.evaluating_kudos,"accumulated")
+        self.queue_kudos(self.evaluating_kudos,"accumulated")
         self.evaluating_kudos = 0
-        self.set_trusted(True)
+        # This is called while recording a job or flushing the worker heartbeats, which are committed all together
+        self.set_trusted(True, commit=False)
 
     def modify_monthly_kudos(self, monthly_kudos):
         # We always give upfront the monthly kudos to the user once.
         # If they already had some, we give the difference but don't change the date
         logger.info(f"Modifying monthly kudos of {self.get_unique_alias()} by {monthly_kudos}")
         if monthly_kudos > 0:
-            self.modify_kudos(monthly_kudos, "recurring")
+            self.modify_kudos(monthly_kudos, "recurring", commit=False)
         if not self.monthly_kudos_last_received:
             self.monthly_kudos_last_received = datetime.utcnow()
         self.monthly_kudos += monthly_kudos
@@ -587,17 +622,32 @@ class User(db.Model):
         base_amount += patrons.get_monthly_kudos(self.id)
         return(base_amount)
 
-    def modify_kudos(self, kudos, action = 'accumulated'):
+    def modify_kudos(self, kudos, action = 'accumulated', commit=True):
+        '''When commit is False, the caller commits it along with its other changes'''
         logger.debug(f"modifying existing {self.kudos} kudos of {self.get_unique_alias()} by {kudos} for {action}")
         self.kudos = round(self.kudos + kudos, 2)
         self.ensure_kudos_positive()
-        kudos_details = db.session.query(UserStats).filter_by(user_id=self.id).filter_by(action=action).first()
-        if not kudos_details:
-            kudos_details = UserStats(user_id=self.id, action=action, value=round(kudos, 2))
-            db.session.add(kudos_details)
-        else:
-            kudos_details.value = round(kudos_details.value + kudos, 2)
-        db.session.commit()
+        upsert_counters(
+            UserStats,
+            ["user_id", "action"],
+            [{"user_id": self.id, "action": action, "value": round(kudos, 2)}],
+        )
+        if commit:
+            db.session.commit()
+
+    def queue_kudos(self, kudos, action = 'accumulated'):
+        '''Like modify_kudos(), but the UserStats are only updated later, through the kudos ledger
+        The kudos total itself changes immediately. Doesn't commit
+        '''
+        logger.debug(f"modifying existing {self.kudos} kudos of {self.get_unique_alias()} by {kudos} for {action}")
+        self.kudos = round(self.kudos + kudos, 2)
+        self.ensure_kudos_positive()
+        db.session.add(KudosLedger(
+            event_type=LedgerEventTypes.USER_KUDOS,
+            user_id=self.id,
+            key=action,
+            value=kudos,
+        ))
 
     def ensure_kudos_positive(self):
         if self.kudos < self.get_min_kudos():
@@ -876,3 +926,19 @@ class User(db.Model):
             hr.horde_r_setex(f"ip_{ipaddr}_daily_problem_notified", timedelta(days=1), 1)
             return
 
+
+# Whichever path replaces an api key or deletes a user, the old key stops authenticating once that's committed
+@event.listens_for(User.api_key, "set", active_history=True)
+def forget_replaced_api_key(user, value, oldvalue, initiator):
+    session = object_session(user)
+    if session is None or not isinstance(oldvalue, str) or oldvalue == value:
+        return
+    session.info.setdefault(API_KEY_CHANGES_KEY, set()).add(oldvalue)
+
+@event.listens_for(User, "after_delete")
+def forget_deleted_user_caches(mapper, connection, user):
+    session = object_session(user)
+    if session is None:
+        return
+    session.info.setdefault(API_KEY_CHANGES_KEY, set()).add(user.api_key)
+    session.info.setdefault(ROLE_CHANGES_KEY, set()).add(user.id)
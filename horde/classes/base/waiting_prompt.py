@@ -4,7 +4,8 @@ import json
 from datetime import datetime, timedelta
 from sqlalchemy.ext.mutable import MutableDict
 from sqlalchemy.dialects.postgresql import JSONB, UUID
-from sqlalchemy import JSON, func, or_
+from sqlalchemy import JSON, func, or_, and_, update
+from sqlalchemy.orm.attributes import set_committed_value
 from sqlalchemy.sql import expression
 
 from horde.logger import logger
@@ -16,6 +17,8 @@ from horde.classes.base.processing_generation import ProcessingGeneration
 from horde.classes.stable.processing_generation import ImageProcessingGeneration
 from horde.classes.kobold.processing_generation import TextProcessingGeneration
 from horde import horde_redis as hr
+from horde.cached_request import cached_request
+from horde import dispatch
 
 procgen_classes = {
     "template": ProcessingGeneration,
@@ -24,8 +27,16 @@ procgen_classes = {
 }
 
 json_column_type = JSONB if not SQLITE_MODE else JSON
+# Every 10 seconds a request is waiting in the queue, it gains as much priority as 50 kudos
+# The aging is continuous, so it's gaining 5 kudos of priority every second
+PRIORITY_AGING_SECONDS = 10
+PRIORITY_AGING_KUDOS = 50
 uuid_column_type = lambda: UUID(as_uuid=True) if not SQLITE_MODE else db.String(36)
 
+def get_priority_aging(timestamp):
+    '''How much priority a WP would have gained by aging from the epoch until this timestamp'''
+    return round(dispatch.to_epoch(timestamp) * PRIORITY_AGING_KUDOS / PRIORITY_AGING_SECONDS)
+
 class WPAllowedWorkers(db.Model):
     __tablename__ = "wp_allowed_workers"
     id = db.Column(db.Integer, primary_key=True)
@@ -85,6 +96,9 @@ class WaitingPrompt(db.Model):
     things = db.Column(db.BigInteger, default=0, nullable=False)
     total_usage = db.Column(db.Float, default=0, nullable=False)
     extra_priority = db.Column(db.Integer, default=0, nullable=False, index=True)
+    # The priority this WP would have had at the unix epoch. As every WP ages at the same rate,
+    # sorting by this is the same as sorting by their current priority, without having to update it every tick.
+    queue_priority = db.Column(db.BigInteger, default=0, nullable=False, index=True, server_default=expression.literal(0))
     job_ttl = db.Column(db.Integer, default=150, nullable=False)
     client_agent = db.Column(db.Text, default="unknown:0:unknown", nullable=False)
     sharedkey_id = db.Column(uuid_column_type(), db.ForeignKey("user_sharedkeys.id", ondelete="CASCADE"), nullable=True)
@@ -135,6 +149,9 @@ class WaitingPrompt(db.Model):
             self.extra_priority = -100
         else:    
             self.extra_priority = self.user.kudos
+        # Every WP ages at the same rate, so instead of adding the aging to all of them
+        # we take it away from the newer ones by subtracting the aging up to their creation
+        self.queue_priority = self.extra_priority - get_priority_aging(self.created)
         # This is an extra cost for the operation as a whole, to represent the infrastructure costs
         # and rewarding requests which bundle multiple jobs into the same payload
         # Instead of splitting them into multiples.
@@ -147,10 +164,19 @@ class WaitingPrompt(db.Model):
         )
         # logger.debug(f"wp {self.id} initiated and paying horde tax: {horde_tax}")
         db.session.commit()
+        dispatch.index_wp(self)
+        dispatch.notify_new_wp(self)
 
     def get_model_names(self):
         return [m.model for m in self.models]
 
+    def get_lowercase_prompt(self):
+        '''Returns the lowercased prompt, computed once per WP instead of once per worker checking it'''
+        # Not a column, so it only lives as long as this instance
+        if getattr(self, "lowercase_prompt", None) is None:
+            self.lowercase_prompt = self.prompt.lower()
+        return self.lowercase_prompt
+
     # These are typically horde-specific so they will be defined in the specific class for this horde type
     def extract_params(self):
         # logger.debug(self.params)
@@ -175,44 +201,76 @@ class WaitingPrompt(db.Model):
     def needs_gen(self):
         return self.n > 0
 
-    def start_generation(self, worker):
-        # # We have to do this to lock the row for updates, to ensure we don't have racing conditions on who is picking up requests
-        # myself_refresh = db.session.query(
-        #     type(self)
-        # ).filter(
-        #     type(self).id == self.id, 
-        #     type(self).n > 0
-        # ).with_for_update().populate_existing().first()
-        # if not myself_refresh:
-        #     return None
-        # myself_refresh.n -= 1
-        self.n -= 1
+    def claim_job(self):
+        '''Atomically decrements n in the DB, only if this WP still has jobs to do.
+        This avoids having to lock the row while we're checking if the worker can generate it
+        and ensures we never pop a WP more times than requested.
+        Returns True if we managed to claim a job
+        '''
+        claim = update(
+            WaitingPrompt
+        ).where(
+            WaitingPrompt.id == self.id,
+            WaitingPrompt.n > 0,
+        ).values(
+            n = WaitingPrompt.n - 1
+        )
+        if SQLITE_MODE:
+            result = db.session.execute(claim, execution_options={"synchronize_session": False})
+            if result.rowcount == 0:
+                return False
+            new_n = db.session.query(WaitingPrompt.n).filter(WaitingPrompt.id == self.id).scalar()
+        else:
+            new_n = db.session.execute(
+                claim.returning(WaitingPrompt.n), 
+                execution_options={"synchronize_session": False},
+            ).scalar()
+            if new_n is None:
+                return False
+        set_committed_value(self, "n", new_n)
+        return True
+
+    def start_generation(self, worker, commit=True):
+        # We claim the job with a conditional update, to ensure we don't have racing conditions on who is picking up requests
+        if not self.claim_job():
+            return None
         # We get the payload now, so that we ensure any further commits won't disrupt what our n value is
         # as that value is used to calclate that payload
         payload = self.get_job_payload()
-        db.session.commit()
+        if commit:
+            db.session.commit()
+        if not self.needs_gen():
+            dispatch.unindex_wp(self)
         procgen_class = procgen_classes[self.wp_type]
-        new_gen = procgen_class(wp_id=self.id, worker_id=worker.id)
+        new_gen = procgen_class(wp_id=self.id, worker_id=worker.id, commit=commit)
         logger.audit(f"Procgen with ID {new_gen.id} popped from WP {self.id} by worker {worker.id} ('{worker.name}' / {worker.ipaddr}) - {self.n} gens left")
         pop_payload = self.get_pop_payload(new_gen, payload)
         return pop_payload
 
-    def fake_generation(self, worker):
+    def fake_generation(self, worker, commit=True):
         payload = self.get_job_payload()
         procgen_class = procgen_classes[self.wp_type]
         new_gen = procgen_class(
             wp_id=self.id, 
             worker_id=worker.id,
-            fake=True)
+            fake=True,
+            commit=commit)
         new_trick = WPTrickedWorkers(wp_id=self.id, worker_id=worker.id)
         db.session.add(new_trick)
-        db.session.commit()
+        if commit:
+            db.session.commit()
         logger.audit(f"FAKE Procgen with ID {new_gen.id} popped from WP {self.id} by worker {worker.id} ('{worker.name}' / {worker.ipaddr}) - {self.n} gens left")
         return self.get_pop_payload(new_gen, payload)
     
     def tricked_worker(self, worker):
         return worker.id in [w.worker_id for w in self.tricked_workers]
 
+    def get_dispatch_entry(self):
+        '''Returns the details needed to place this WP in the dispatch index
+        Horde types which don't use the dispatch index should return None
+        '''
+        return None
+
     def get_pop_payload(self, procgen, payload):
         prompt_payload = {
             "payload": payload,
@@ -360,6 +418,7 @@ class WaitingPrompt(db.Model):
         logger.warning(f"Faulting waiting prompt {self.id} with payload '{self.gen_payload}' due to too many faulted jobs")
 
     def delete(self):
+        dispatch.unindex_wp(self)
         for gen in self.processing_gens:
             if not self.faulted and not gen.fake:
                 gen.cancel()
@@ -380,12 +439,13 @@ class WaitingPrompt(db.Model):
                 return
             self.n = 0
             db.session.commit()
+            dispatch.unindex_wp(self)
         except Exception as err:
             logger.warning(f"Error when aborting WP. Skipping: {err}")
 
     def refresh(self):
+        # The job which refreshed us commits this
         self.expiry = get_expiry_date()
-        db.session.commit()
 
     def is_stale(self):
         if datetime.utcnow() > self.expiry:
@@ -393,7 +453,10 @@ class WaitingPrompt(db.Model):
         return(False)
 
     def get_priority(self):
-        return(self.extra_priority)
+        '''The priority of the WP, including how much it has aged in the queue
+        It's derived from the queue_priority the queue is sorted by, so that both always agree
+        '''
+        return(self.queue_priority + get_priority_aging(datetime.utcnow()))
 
     def set_job_ttl(self):
         '''Returns how many seconds each job request should stay waiting before considering it stale and cancelling it
@@ -402,26 +465,26 @@ class WaitingPrompt(db.Model):
         self.job_ttl = 150
         db.session.commit()
 
-    def refresh_worker_cache(self):
-        worker_ids = [worker.worker_id for worker in self.workers]
-        worker_string_ids = [str(worker.worker_id) for worker in self.workers]
-        try:
-            hr.horde_r_setex(f'wp_{self.id}_worker_cache', timedelta(minutes=20), json.dumps(worker_string_ids))
-        except Exception as err:
-            logger.debug(f"Error when trying to set workers cache: {err}. Retrieving from DB.")
-        return worker_ids
-
+    @cached_request(
+        key=lambda self: f'wp_{self.id}_worker_cache',
+        ttl=1200,
+        serialize=lambda worker_ids: [str(wid) for wid in worker_ids],
+        deserialize=lambda worker_ids: [uuid.UUID(wid) for wid in worker_ids],
+    )
     def get_worker_ids(self):
-        if hr.horde_r is None:
-            return [worker.worker_id for worker in self.workers]
-        worker_cache = hr.horde_r_get(f'wp_{self.id}_worker_cache')
-        if not worker_cache:
-            return self.refresh_worker_cache()
-        try:
-            worker_cache = json.loads(worker_cache)
-        except TypeError as e:
-            logger.error(f"Worker cache could not be loaded: {worker_cache}")
-            return self.refresh_worker_cache()
-        if worker_cache is None:
-            return self.refresh_worker_cache()
-        return [uuid.UUID(wid) for wid in worker_cache]
+        return [worker.worker_id for worker in self.workers]
+
+
+# The pops walk the open WPs in queue order and stop once they have enough candidates
+# so an index in that order, over the open WPs only, lets them stop early without sorting
+db.Index(
+    "ix_waiting_prompts_open_queue",
+    WaitingPrompt.queue_priority.desc(),
+    WaitingPrompt.created,
+    WaitingPrompt.id,
+    postgresql_where=and_(
+        WaitingPrompt.n > 0,
+        WaitingPrompt.active == True,
+        WaitingPrompt.faulted == False,
+    ),
+)
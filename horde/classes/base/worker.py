@@ -1,8 +1,8 @@
 import json
 
-from sqlalchemy import func
+from sqlalchemy import func, UniqueConstraint
+from sqlalchemy.orm import selectinload
 from sqlalchemy.dialects.postgresql import UUID
-from sqlalchemy.ext.hybrid import hybrid_property
 from datetime import datetime, timedelta
 
 from horde.classes.base.waiting_prompt import WPModels
@@ -10,22 +10,59 @@ from horde.logger import logger
 from horde.flask import db, SQLITE_MODE
 from horde import vars as hv
 from horde.suspicions import SUSPICION_LOGS, Suspicions
-from horde.utils import is_profane, get_db_uuid, sanitize_string
+from horde.utils import is_profane, get_db_uuid, sanitize_string, hash_dictionary
 from horde import horde_redis as hr
+from horde.cached_request import cached_request
 from horde.classes.base import settings
 from horde.discord import send_pause_notification
+from horde.enums import LedgerEventTypes
+from horde.classes.base.kudos_ledger import KudosLedger, upsert_counters
 
 
 uuid_column_type = lambda: UUID(as_uuid=True) if not SQLITE_MODE else db.String(36)
+# The redis hash where the worker check-ins are stored until the primary flushes them to the DB
+HEARTBEATS_KEY = "worker_heartbeats"
+# The worker speed is a moving average which weighs the latest jobs about as much as the last 20 jobs used to
+SPEED_EWMA_ALPHA = 2 / (20 + 1)
+# The blacklist matchers, by the version of the blacklist
+blacklist_matchers = {}
+
+
+class BlacklistMatcher:
+    '''Checks a prompt against all the words of a worker blacklist at once'''
+
+    def __init__(self, words):
+        self.words = tuple(set(word.lower() for word in words))
+
+    def search(self, lowercase_prompt):
+        '''Expects the prompt already lowercased, as it's checked against every worker's blacklist'''
+        # A plain loop benchmarked a bit faster than any() over a generator
+        for word in self.words:
+            if word in lowercase_prompt:
+                return True
+        return False
+
+def get_blacklist_matcher(version, words):
+    '''Returns the matcher for this version of a blacklist, building it only the first time it's seen'''
+    matcher = blacklist_matchers.get(version)
+    if matcher is None:
+        # Workers don't change their blacklist often, but we don't want this to grow unbounded either
+        if len(blacklist_matchers) > 1000:
+            blacklist_matchers.clear()
+        matcher = BlacklistMatcher(words)
+        blacklist_matchers[version] = matcher
+    return matcher
 
 class WorkerStats(db.Model):
     __tablename__ = "worker_stats"
+    __table_args__ = (UniqueConstraint('worker_id', 'action', name='worker_stats_worker_id_action_key'),)
     id = db.Column(db.Integer, primary_key=True)
     worker_id = db.Column(uuid_column_type(), db.ForeignKey("workers.id", ondelete="CASCADE"), nullable=False)
     worker = db.relationship(f"Worker", back_populates="stats")
     action = db.Column(db.String(20), nullable=False, index=True)
     value = db.Column(db.BigInteger, default=0, nullable=False)
 
+# No longer written to, as the worker speed is now kept in its own column
 class WorkerPerformance(db.Model):
     __tablename__ = "worker_performances"
     id = db.Column(db.Integer, primary_key=True)
@@ -91,6 +128,8 @@ class WorkerTemplate(db.Model):
     # Used by all workers to record how much they can pick up to generate
     # The value of this column is dfferent per worker type
     max_power = db.Column(db.Integer, default=20, nullable=False)
+    # Exponentially weighted moving average of the speed of the latest jobs
+    speed = db.Column(db.Float, nullable=False, index=True)
 
     paused = db.Column(db.Boolean, default=False, nullable=False)
     maintenance = db.Column(db.Boolean, default=False, nullable=False)
@@ -110,30 +149,23 @@ class WorkerTemplate(db.Model):
     # Because I didn't use worker_type correctly. I should have called them "text" and "image"
     # TODO: Normalize this to the standard
     wtype = "image"
+    # The columns update_details() writes
+    details_columns = ("ipaddr", "bridge_version", "bridge_agent", "allow_unsafe_ipaddr")
 
-    @hybrid_property
-    def speed(self) -> int:
-        performance_avg = db.session.query(
-            func.avg(WorkerPerformance.performance)
-        ).filter_by(
-            worker_id=self.id
-        ).scalar()
-        if performance_avg:
-            return performance_avg
-        # We return a baseline speed if the workers hasn't fulfilled anything
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Workers start at a baseline speed until they fulfill something
         # in order to avoid a division by zero
-        return 1 * hv.thing_divisors[self.wtype]
-        
-    @speed.expression
-    def speed(cls):
-        performance_avg = (
-            db.select(
-                func.avg(WorkerPerformance.performance)
-                ).where(
-                    WorkerPerformance.worker_id == cls.id
-                ).label("speed")
-        )
-        return db.case([(performance_avg == None, 1 * hv.thing_divisors[cls.wtype])], else_=performance_avg)
+        if self.speed is None:
+            self.speed = 1 * hv.thing_divisors[self.wtype]
+
+    def record_speed(self, speed_sample):
+        '''Folds the speed of the latest job into the worker speed
+        Until the worker has fulfilled enough jobs, this is simply the average of all of them
+        '''
+        # The fulfilment of this job has already been counted
+        alpha = max(1 / max(self.fulfilments, 1), SPEED_EWMA_ALPHA)
+        self.speed = self.speed + alpha * (speed_sample - self.speed)
 
     def create(self, **kwargs):
         self.check_for_bad_actor()
@@ -235,27 +267,69 @@ class WorkerTemplate(db.Model):
         self.paused = is_paused_active
         db.session.commit()   
 
-    # This should be extended by each worker type
     def check_in(self, **kwargs):
-        self.ipaddr = kwargs.get("ipaddr", None)
-        self.bridge_version = kwargs.get("bridge_version", 1)
-        self.bridge_agent = sanitize_string(kwargs.get("bridge_agent", "unknown:0:unknown"))
-        self.threads = kwargs.get("threads", 1)
+        '''Records that this worker is alive and updates its details if they changed since its last check-in
+        The heartbeat itself is only written to the DB in bulk, by the primary
+        '''
         self.require_upfront_kudos = kwargs.get('require_upfront_kudos', False)
-        self.allow_unsafe_ipaddr = kwargs.get('allow_unsafe_ipaddr', True)
         # If's OK to provide an empty list here as we don't actually modify this var
         # We only check it in can_generate
         self.prioritized_users = kwargs.get('prioritized_users', [])
+        self.record_heartbeat(kwargs.get("threads", 1))
+        # The threads are part of the heartbeat, so they don't need to be compared
+        details = {k: v for k, v in kwargs.items() if k != "threads"}
+        details_hash_key = f'worker_{self.id}_details_hash'
+        if hr.horde_r and hr.horde_r_get(details_hash_key) == self.get_details_hash(details):
+            return
+        self.update_details(**kwargs)
+        db.session.commit()
+        if hr.horde_r:
+            hr.horde_r_setex(details_hash_key, timedelta(minutes=10), self.get_details_hash(details))
+
+    def get_details_hash(self, details):
+        '''Hashes the details the worker sent along with the ones currently stored in its row
+        so that if the row is changed through any other path, the next check-in writes the details again
+        '''
+        stored_details = {column: getattr(self, column) for column in self.details_columns}
+        return hash_dictionary({"sent": details, "stored": stored_details})
+
+    # This should be extended by each worker type
+    def update_details(self, **kwargs):
+        '''Writes the details the worker sent during its check-in to the DB'''
+        self.ipaddr = kwargs.get("ipaddr", None)
+        self.bridge_version = kwargs.get("bridge_version", 1)
+        self.bridge_agent = sanitize_string(kwargs.get("bridge_agent", "unknown:0:unknown"))
+        self.allow_unsafe_ipaddr = kwargs.get('allow_unsafe_ipaddr', True)
         if not kwargs.get("safe_ip", True) and not self.user.trusted:
             self.report_suspicion(reason = Suspicions.UNSAFE_IP)
+
+    def record_heartbeat(self, threads):
+        '''Stores the time of this check-in in redis, so that the primary can flush all of them to the DB together'''
+        check_in_time = datetime.utcnow()
+        # Without redis, or without a primary to flush them (sqlite), we have to write the heartbeat directly
+        if not hr.horde_r or SQLITE_MODE:
+            self.record_check_in(check_in_time, threads)
+            db.session.commit()
+            return
+        hr.horde_r_hset(
+            HEARTBEATS_KEY,
+            str(self.id),
+            json.dumps({"check_in": check_in_time.isoformat(), "threads": threads}),
+        )
+
+    def record_check_in(self, check_in_time, threads):
+        '''Applies a heartbeat of this worker and rewards its uptime'''
+        if self.last_check_in is not None and check_in_time <= self.last_check_in:
+            return
+        self.threads = threads
         if not self.is_stale() and not self.paused and not self.maintenance:
-            self.uptime += (datetime.utcnow() - self.last_check_in).total_seconds()
+            self.uptime += (check_in_time - self.last_check_in).total_seconds()
             # Every 10 minutes of uptime gets 100 kudos rewarded
             if self.uptime - self.last_reward_uptime > self.uptime_reward_threshold:
                 if self.team:
                     self.team.record_uptime(self.uptime_reward_threshold)
                 kudos = self.calculate_uptime_reward()
-                self.modify_kudos(kudos,'uptime')
+                self.queue_kudos(kudos,'uptime')
                 self.user.record_uptime(kudos)
                 logger.debug(f"Worker '{self.name}' received {kudos} kudos for uptime of {self.uptime_reward_threshold} seconds.")
                 self.last_reward_uptime = self.uptime
@@ -263,8 +337,7 @@ class WorkerTemplate(db.Model):
             # If the worker comes back from being stale, we just reset their last_reward_uptime
             # So that they have to stay up at least 10 mins to get uptime kudos
             self.last_reward_uptime = self.uptime
-        self.last_check_in = datetime.utcnow()
-        db.session.commit()
+        self.last_check_in = check_in_time
 
     def get_human_readable_uptime(self):
         if self.uptime < 60:
@@ -294,39 +367,37 @@ class WorkerTemplate(db.Model):
         '''
         kudos = kudos * self.get_bridge_kudos_multiplier()
         self.user.record_contributions(raw_things = raw_things, kudos = kudos, contrib_type = self.wtype)
-        self.modify_kudos(kudos,'generated')
+        self.queue_kudos(kudos,'generated')
         converted_amount = self.convert_contribution(raw_things)
         self.fulfilments += 1
         if self.team and self.wtype == "image":
             self.team.record_contribution(converted_amount, kudos)
-        performances = db.session.query(WorkerPerformance).filter_by(worker_id=self.id).order_by(WorkerPerformance.created.asc())
-        if performances.count() >= 20:
-            # Ensure we don't forget anything
-            subquery = (
-                db.session.query(WorkerPerformance.id)
-                .filter_by(worker_id=self.id)
-                .order_by(WorkerPerformance.created.asc())
-                .offset(20)
-                .subquery()
-            )
-            db.session.query(WorkerPerformance).filter_by(worker_id=self.id).filter(WorkerPerformance.id.notin_(subquery)).delete(synchronize_session=False)
-        new_performance = WorkerPerformance(worker_id=self.id, performance=things_per_sec)
-        db.session.add(new_performance)
-        db.session.commit()
+        self.record_speed(things_per_sec)
         if things_per_sec / hv.thing_divisors[self.wtype] > hv.suspicion_thresholds[self.wtype]:
             self.report_suspicion(reason = Suspicions.UNREASONABLY_FAST, formats=[round(things_per_sec / hv.thing_divisors[self.wtype],2)])
 
-    def modify_kudos(self, kudos, action = 'generated'):
+    def modify_kudos(self, kudos, action = 'generated', commit=True):
         self.kudos = round(self.kudos + kudos, 2)
-        kudos_details = db.session.query(WorkerStats).filter_by(worker_id=self.id).filter_by(action=action).first()
-        if not kudos_details:
-            kudos_details = WorkerStats(worker_id=self.id,action=action, value=round(kudos, 2))
-            db.session.add(kudos_details)
-            db.session.commit()
-        else:
-            kudos_details.value = round(kudos_details.value + kudos, 2)
+        upsert_counters(
+            WorkerStats,
+            ["worker_id", "action"],
+            [{"worker_id": self.id, "action": action, "value": round(kudos, 2)}],
+        )
+        if commit:
             db.session.commit()
-        logger.trace([kudos_details,kudos_details.value])
+        logger.trace([self.id, action, kudos])
+
+    def queue_kudos(self, kudos, action = 'generated'):
+        '''Like modify_kudos(), but the WorkerStats are only updated later, through the kudos ledger
+        The kudos total itself changes immediately. Doesn't commit
+        '''
+        self.kudos = round(self.kudos + kudos, 2)
+        db.session.add(KudosLedger(
+            event_type=LedgerEventTypes.WORKER_KUDOS,
+            worker_id=self.id,
+            key=action,
+            value=kudos,
+        ))
 
     def log_aborted_job(self):
         # We count the number of jobs aborted in an 1 hour period. So we only log the new timer each time an hour expires.
@@ -400,9 +471,8 @@ class WorkerTemplate(db.Model):
         db.session.commit()
 
     def import_performances(self, performances):
-        for p in performances:
-            new_kd = WorkerPerformance(worker_id=self.id, performance=p)
-            db.session.add(new_kd)
+        if len(performances):
+            self.speed = sum(performances) / len(performances)
         db.session.commit()
 
     def import_suspicions(self, suspicions):
@@ -455,9 +525,6 @@ class WorkerTemplate(db.Model):
         }
         return ret_dict
 
-# Don't know if this works, need to recreate the DB to find out
-# db.Index('ix_image_workers_speed', WorkerTemplate.speed)
-
 class Worker(WorkerTemplate):
     '''A worker is meant to receive a text prompt and pass it though a generative model'''
     __mapper_args__ = {
@@ -468,14 +535,14 @@ class Worker(WorkerTemplate):
     blacklist = db.relationship("WorkerBlackList", back_populates="worker", cascade="all, delete-orphan")
     models = db.relationship("WorkerModel", back_populates="worker", cascade="all, delete-orphan")
     processing_gens = db.relationship("ImageProcessingGeneration", back_populates="worker", lazy='raise')
+    details_columns = WorkerTemplate.details_columns + ("nsfw",)
 
     # This should be extended by each specific horde
-    def check_in(self, **kwargs):
-        super().check_in(**kwargs)
+    def update_details(self, **kwargs):
+        super().update_details(**kwargs)
         self.set_models(kwargs.get("models"))
         self.nsfw = kwargs.get("nsfw", True)
         self.set_blacklist(kwargs.get("blacklist", []))
-        db.session.commit()    
 
     def set_blacklist(self, blacklist):
         # We don't allow more workers to claim they can server more than 50 models atm (to prevent abuse)
@@ -492,29 +559,53 @@ class Worker(WorkerTemplate):
             blacklisted_word = WorkerBlackList(worker_id=self.id,word=word[0:15])
             db.session.add(blacklisted_word)
         db.session.commit()
-
-    def refresh_model_cache(self):
-        models_list = [m.model for m in self.models]
+        self.blacklist_loaded = False
+        self.refresh_blacklist_cache()
+
+    def refresh_blacklist_cache(self):
+        '''Stores the blacklist words along with a version stamp, so that every node can reuse the same matcher'''
+        words = sorted(b.word for b in self.blacklist)
+        blacklist_cache = {
+            "version": hash_dictionary(words),
+            "words": words,
+        }
         try:
-            hr.horde_r_setex(f'worker_{self.id}_model_cache', timedelta(seconds=600), json.dumps(models_list))
+            hr.horde_r_setex(f'worker_{self.id}_blacklist_cache', timedelta(seconds=600), json.dumps(blacklist_cache))
         except Exception as err:
-            logger.debug(f"Error when trying to set models cache: {err}. Retrieving from DB.")
-        return models_list
+            logger.debug(f"Error when trying to set blacklist cache: {err}. Retrieving from DB.")
+        return blacklist_cache
 
-    def get_model_names(self):
+    def get_blacklist_cache(self):
         if hr.horde_r is None:
-            return [m.model for m in self.models]
-        model_cache = hr.horde_r_get(f'worker_{self.id}_model_cache')
-        if not model_cache:
-            return self.refresh_model_cache()
+            return self.refresh_blacklist_cache()
+        blacklist_cache = hr.horde_r_get(f'worker_{self.id}_blacklist_cache')
+        if not blacklist_cache:
+            return self.refresh_blacklist_cache()
         try:
-            models_ret = json.loads(model_cache)
+            return json.loads(blacklist_cache)
         except TypeError as e:
-            logger.error(f"Model cache could not be loaded: {model_cache}")
-            return self.refresh_model_cache()
-        if models_ret is None:
-            return self.refresh_model_cache()
-        return models_ret
+            logger.error(f"Blacklist cache could not be loaded: {blacklist_cache}")
+            return self.refresh_blacklist_cache()
+
+    def get_blacklist_matcher(self):
+        '''Returns the matcher for all the blacklisted words of this worker
+        Returns None if the worker doesn't have a blacklist
+        '''
+        # Most workers don't have a blacklist, so we remember that as well, instead of looking it up for every WP
+        if not getattr(self, "blacklist_loaded", False):
+            blacklist_cache = self.get_blacklist_cache()
+            self.blacklist_matcher = None
+            if len(blacklist_cache["words"]) > 0:
+                self.blacklist_matcher = get_blacklist_matcher(blacklist_cache["version"], blacklist_cache["words"])
+            self.blacklist_loaded = True
+        return self.blacklist_matcher
+
+    def refresh_model_cache(self):
+        return Worker.get_model_names.refresh(self)
+
+    @cached_request(key=lambda self: f'worker_{self.id}_model_cache', ttl=600)
+    def get_model_names(self):
+        return [m.model for m in self.models]
 
 
     def set_models(self, models):
@@ -541,6 +632,33 @@ class Worker(WorkerTemplate):
         del models[200:]
         return set(models)
 
+    def filter_generatable(self, waiting_prompts):
+        '''Checks a whole page of WaitingPrompts at once
+        Returns a list of [waiting_prompt, can_generate, skipped_reason] for each of them
+        '''
+        if len(waiting_prompts) == 0:
+            return []
+        # We load all the relationships can_generate() needs for the whole page in one go
+        # instead of lazy-loading them one WP at a time
+        wp_class = type(waiting_prompts[0])
+        db.session.query(
+            wp_class
+        ).filter(
+            wp_class.id.in_([wp.id for wp in waiting_prompts])
+        ).options(
+            selectinload(wp_class.user),
+            selectinload(wp_class.workers),
+            selectinload(wp_class.tricked_workers),
+            selectinload(wp_class.models),
+        ).all()
+        # This will be reused by every can_generate() call
+        self.get_blacklist_matcher()
+        results = []
+        for waiting_prompt in waiting_prompts:
+            check_gen = self.can_generate(waiting_prompt)
+            results.append([waiting_prompt, check_gen[0], check_gen[1]])
+        return results
+
     def can_generate(self, waiting_prompt):
         '''Takes as an argument a WaitingPrompt class and checks if this worker is valid for generating it'''
         # Workers in maintenance are still allowed to generate for their owner
@@ -562,14 +680,17 @@ class Worker(WorkerTemplate):
         if waiting_prompt.tricked_worker(self):
             return [False, 'secret']
         #logger.warning(datetime.utcnow())
-        if any(b.word.lower() in waiting_prompt.prompt.lower() for b in self.blacklist):
+        blacklist_matcher = self.get_blacklist_matcher()
+        if blacklist_matcher and blacklist_matcher.search(waiting_prompt.get_lowercase_prompt()):
             return [False, 'blacklist']
         # Skips working prompts which require a specific worker from a list, and our ID is not in that list
+        # We need to load the workers relationship to check its length anyway, so we don't use the redis cache here
+        wp_worker_ids = [w.worker_id for w in waiting_prompt.workers]
         if waiting_prompt.worker_blacklist:
-            if len(waiting_prompt.workers) and self.id in waiting_prompt.get_worker_ids():
+            if len(wp_worker_ids) and self.id in wp_worker_ids:
                 return [False, 'worker_id']
         else:
-            if len(waiting_prompt.workers) and self.id not in waiting_prompt.get_worker_ids():
+            if len(wp_worker_ids) and self.id not in wp_worker_ids:
                 return [False, 'worker_id']
         #logger.warning(datetime.utcnow())
 
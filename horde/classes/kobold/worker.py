@@ -34,17 +34,26 @@ class TextWorker(Worker):
     
     softprompts = db.relationship("TextWorkerSoftprompts", back_populates="worker", cascade="all, delete-orphan")
     wtype = "text"
+    details_columns = Worker.details_columns + ("max_length", "max_context_length")
 
     def check_in(self, max_length, max_context_length, softprompts, **kwargs):
-        super().check_in(**kwargs)
-        self.max_length = max_length
-        self.max_context_length = max_context_length
-        self.set_softprompts(softprompts)
+        super().check_in(
+            max_length=max_length,
+            max_context_length=max_context_length,
+            softprompts=softprompts,
+            **kwargs,
+        )
         paused_string = ''
         if self.paused:
             paused_string = '(Paused) '
         logger.trace(f"{paused_string}Text Worker {self.name} checked-in, offering models {self.models} at {self.max_length} max tokens and {self.max_context_length} max content length.")
 
+    def update_details(self, **kwargs):
+        super().update_details(**kwargs)
+        self.max_length = kwargs.get("max_length", 80)
+        self.max_context_length = kwargs.get("max_context_length", 1024)
+        self.set_softprompts(kwargs.get("softprompts", []))
+
     def refresh_softprompt_cache(self):
         softprompts_list = [s.softprompt for s in self.softprompts]
         try:
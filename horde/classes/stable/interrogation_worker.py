@@ -2,7 +2,7 @@ from sqlalchemy import func
 from datetime import datetime
 from horde.logger import logger
 from horde.flask import db
-from horde.classes.base.worker import WorkerTemplate, WorkerPerformance, uuid_column_type
+from horde.classes.base.worker import WorkerTemplate, uuid_column_type
 from horde.suspicions import Suspicions
 
 
@@ -22,22 +22,25 @@ class InterrogationWorker(WorkerTemplate):
     forms = db.relationship("WorkerInterrogationForm", back_populates="worker")
     processing_forms = db.relationship("InterrogationForms", back_populates="worker")
     wtype = "interrogation"
+    details_columns = WorkerTemplate.details_columns + ("max_power",)
 
     def check_in(self, max_tiles, **kwargs):
-        super().check_in(**kwargs)
-        self.max_power = max_tiles
-        # If's OK to provide an empty list here as we don't actually modify this var
-        # We only check it in can_generate
-        self.set_forms(kwargs.get("forms"))
+        super().check_in(max_tiles=max_tiles, **kwargs)
         form_names = self.get_form_names()
-        if len(form_names) == 0:
-            self.set_forms(['caption'])
         paused_string = ''
         if self.paused:
             paused_string = '(Paused) '
-        db.session.commit()
         logger.trace(f"{paused_string}Interrogation Worker {self.name} checked-in, offering forms: {form_names} @ {self.max_power} max tiles")
 
+    def update_details(self, **kwargs):
+        super().update_details(**kwargs)
+        self.max_power = kwargs.get("max_tiles", 80)
+        # If's OK to provide an empty list here as we don't actually modify this var
+        # We only check it in can_generate
+        self.set_forms(kwargs.get("forms"))
+        if len(self.get_form_names()) == 0:
+            self.set_forms(['caption'])
+
     def calculate_uptime_reward(self):
         # If the alchemist is not trusted yet, we give them some extra uptime kudos to tide them over until they get trusted
         # as otherwise due to the low amount of jobs, they won't be a making any kudos
@@ -70,14 +73,9 @@ class InterrogationWorker(WorkerTemplate):
         '''We record the servers newest interrogation contribution
         '''
         self.user.record_contributions(raw_things = 0, kudos = kudos, contrib_type = self.wtype)
-        self.modify_kudos(kudos,'interrogated')
+        self.queue_kudos(kudos,'interrogated')
         self.fulfilments += 1
-        # TODO: Switch to use desc() and offset to ensure we don't have performances left over
-        performances = db.session.query(WorkerPerformance).filter_by(worker_id=self.id).order_by(WorkerPerformance.created.asc())
-        if performances.count() >= 20:
-            db.session.delete(performances.first())
-        new_performance = WorkerPerformance(worker_id=self.id, performance=seconds_taken)
-        db.session.add(new_performance)
+        self.record_speed(seconds_taken)
         db.session.commit()
         # if things_per_sec / thing_divisor > things_per_sec_suspicion_threshold:
         #     self.report_suspicion(reason = Suspicions.UNREASONABLY_FAST, formats=[round(things_per_sec / thing_divisor,2)])
@@ -102,9 +100,8 @@ class InterrogationWorker(WorkerTemplate):
 
 
     def get_performance(self):
-        performances = [p.performance for p in self.performance]
-        if len(performances):
-            ret_str = f'{round(sum(performances) / len(performances),1)} seconds per form'
+        if self.fulfilments > 0:
+            ret_str = f'{round(self.speed,1)} seconds per form'
         else:
             ret_str = f'No requests fulfilled yet'
         return(ret_str)
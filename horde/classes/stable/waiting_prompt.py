@@ -15,15 +15,25 @@ from horde.bridge_reference import check_bridge_capability
 from horde.consts import KNOWN_POST_PROCESSORS
 from horde.classes.stable.kudos import KudosModel
 from horde.model_reference import model_reference
+from horde import dispatch
 
 
 class ImageWaitingPrompt(WaitingPrompt):
     __mapper_args__ = {
         "polymorphic_identity": "image",
     }
-    #TODO: Find a way to index width*height
     width = db.Column(db.Integer, default=512, nullable=False, server_default=expression.literal(512))
     height = db.Column(db.Integer, default=512, nullable=False, server_default=expression.literal(512))
+    # We materialize the params the workers filter on into their own columns, so that the pop queries can compare them directly
+    # instead of decoding the params JSON of every open WP
+    pixels = db.Column(db.Integer, default=512*512, nullable=False, server_default=expression.literal(512*512))
+    requirements = db.Column(db.Integer, default=0, nullable=False, server_default=expression.literal(0))
+    sampler = db.Column(db.String(30), default='k_euler_a', nullable=False, server_default="k_euler_a")
+    karras = db.Column(db.Boolean, default=True, nullable=False, server_default=expression.literal(True))
+    has_lora = db.Column(db.Boolean, default=False, nullable=False, server_default=expression.literal(False))
+    has_ti = db.Column(db.Boolean, default=False, nullable=False, server_default=expression.literal(False))
+    has_pp = db.Column(db.Boolean, default=False, nullable=False, server_default=expression.literal(False))
+    has_controlnet = db.Column(db.Boolean, default=False, nullable=False, server_default=expression.literal(False))
     source_image = db.Column(db.Text, default=None)
     source_processing = db.Column(db.String(10), default='img2img', nullable=False, server_default="img2img")
     source_mask = db.Column(db.Text, default=None)
@@ -59,6 +69,14 @@ class ImageWaitingPrompt(WaitingPrompt):
             self.params["karras"] = True
         self.width = self.params["width"]
         self.height = self.params["height"]
+        self.pixels = self.width * self.height
+        self.sampler = self.params["sampler_name"]
+        self.karras = bool(self.params["karras"])
+        self.has_lora = 'loras' in self.params
+        self.has_ti = 'tis' in self.params
+        self.has_pp = 'post-processing' in self.params
+        self.has_controlnet = 'control_type' in self.params
+        self.requirements = self.calculate_requirements()
         # Silent change
         # if any(model_name.startswith("stable_diffusion_2") for model_name in self.get_model_names()):
         #     self.params['sampler_name'] = "dpmsolver"
@@ -179,11 +197,12 @@ class ImageWaitingPrompt(WaitingPrompt):
     def activate(self, source_image = None, source_mask = None):
         # We separate the activation from __init__ as often we want to check if there's a valid worker for it
         # Before we add it to the queue
-        super().activate()
         if source_image or source_mask:
             self.source_image = source_image
             self.source_mask = source_mask
-            db.session.commit()
+        # The source image needs to be set before activation, so that the requirements and dispatch index have the right flags
+        self.requirements = self.calculate_requirements()
+        super().activate()
         prompt_type = "txt2img"
         if self.source_image:
             prompt_type = self.source_processing
@@ -194,6 +213,56 @@ class ImageWaitingPrompt(WaitingPrompt):
         )
 
 
+    def calculate_requirements(self):
+        '''Returns the capability flags a worker needs to have to pick up this WP'''
+        flags = 0
+        if self.source_image is not None:
+            flags |= dispatch.DF_IMG2IMG
+        if self.source_processing in ["inpainting", "outpainting"]:
+            flags |= dispatch.DF_PAINTING
+        if not self.safe_ip:
+            flags |= dispatch.DF_UNSAFE_IP
+        if self.nsfw:
+            flags |= dispatch.DF_NSFW
+        if self.r2:
+            flags |= dispatch.DF_R2
+        if self.has_lora:
+            flags |= dispatch.DF_LORA
+        if self.has_ti:
+            flags |= dispatch.DF_TI
+        if self.has_pp:
+            flags |= dispatch.DF_POST_PROCESSING
+        if self.has_controlnet:
+            flags |= dispatch.DF_CONTROLNET
+        if not self.slow_workers:
+            flags |= dispatch.DF_FAST_WORKERS
+        if self.trusted_workers:
+            flags |= dispatch.DF_TRUSTED
+        if self.params.get('hires_fix'):
+            flags |= dispatch.DF_HIRES_FIX
+        if self.params.get('return_control_map'):
+            flags |= dispatch.DF_RETURN_CONTROL_MAP
+        if self.params.get('tiling'):
+            flags |= dispatch.DF_TILING
+        return flags
+
+    def get_dispatch_entry(self):
+        '''Returns the details needed to place this WP in the dispatch index'''
+        return {
+            "id": str(self.id),
+            "models": self.get_model_names(),
+            "pixels": self.pixels,
+            "flags": self.requirements,
+            "sampler": self.sampler,
+            "karras": self.karras,
+            "user_id": self.user_id,
+            "workers": [str(w.worker_id) for w in self.workers],
+            "worker_blacklist": self.worker_blacklist,
+            "queue_priority": self.queue_priority,
+            "created": dispatch.to_epoch(self.created),
+            "expiry": dispatch.to_epoch(self.expiry),
+        }
+
     def seed_to_int(self, s = None):
         if type(s) is int:
             return s
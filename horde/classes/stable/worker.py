@@ -3,7 +3,7 @@ from horde.logger import logger
 from horde.flask import db
 from horde.classes.base.worker import Worker
 from horde.suspicions import Suspicions
-from horde.bridge_reference import check_bridge_capability, check_sampler_capability, parse_bridge_agent
+from horde.bridge_reference import get_bridge_profile, parse_bridge_agent
 from horde.model_reference import model_reference
 from horde import exceptions as e
 from horde.utils import sanitize_string
@@ -21,13 +21,28 @@ class ImageWorker(Worker):
     allow_controlnet = db.Column(db.Boolean, default=False, nullable=False)
     allow_lora = db.Column(db.Boolean, default=False, nullable=False)
     wtype = "image"
+    details_columns = Worker.details_columns + (
+        "max_pixels",
+        "allow_img2img",
+        "allow_painting",
+        "allow_post_processing",
+        "allow_controlnet",
+        "allow_lora",
+    )
 
     def check_in(self, max_pixels, **kwargs):
-        super().check_in(**kwargs)
+        super().check_in(max_pixels=max_pixels, **kwargs)
+        paused_string = ''
+        if self.paused:
+            paused_string = '(Paused) '
+        logger.trace(f"{paused_string}Stable Worker {self.name} checked-in, offering models {self.get_model_names()} at {self.max_pixels} max pixels")
+
+    def update_details(self, **kwargs):
+        super().update_details(**kwargs)
         if kwargs.get("max_pixels", 512 * 512) > 3072 * 3072:
             if not self.user.trusted:
                 self.report_suspicion(reason=Suspicions.EXTREME_MAX_PIXELS)
-        self.max_pixels = max_pixels
+        self.max_pixels = kwargs.get("max_pixels", 512 * 512)
         self.allow_img2img = kwargs.get('allow_img2img', True)
         self.allow_painting = kwargs.get('allow_painting', True)
         self.allow_post_processing = kwargs.get('allow_post_processing', True)
@@ -35,11 +50,6 @@ class ImageWorker(Worker):
         self.allow_lora = kwargs.get('allow_lora', False)
         if len(self.get_model_names()) == 0:
             self.set_models(['stable_diffusion'])
-        paused_string = ''
-        if self.paused:
-            paused_string = '(Paused) '
-        db.session.commit()
-        logger.trace(f"{paused_string}Stable Worker {self.name} checked-in, offering models {self.get_model_names()} at {self.max_pixels} max pixels")
 
     def calculate_uptime_reward(self):
         baseline = 50 + (len(self.get_model_names()) * 2)
@@ -51,49 +61,47 @@ class ImageWorker(Worker):
         can_generate = super().can_generate(waiting_prompt)
         if not can_generate[0]:
             return [can_generate[0], can_generate[1]]
+        # We resolve what our bridge supports once, and then just check against it
+        bridge = get_bridge_profile(self.bridge_agent)
         #logger.warning(datetime.utcnow())
-        if waiting_prompt.source_image and not check_bridge_capability("img2img", self.bridge_agent):
+        if waiting_prompt.source_image and not bridge.has_capability("img2img"):
             return [False, 'img2img']
         #logger.warning(datetime.utcnow())
         if waiting_prompt.source_processing != 'img2img':
-            if not check_bridge_capability("inpainting", self.bridge_agent):
+            if not bridge.has_capability("inpainting"):
                 return [False, 'painting']
             if not model_reference.has_inpainting_models(self.get_model_names()):
                 return [False, 'models']
         # If the only model loaded is the inpainting ones, we skip the worker when this kind of work is not required
         if waiting_prompt.source_processing not in ['inpainting', 'outpainting'] and model_reference.has_only_inpainting_models(self.get_model_names()):
             return [False, 'models']
-        if not check_sampler_capability(
-            waiting_prompt.gen_payload.get('sampler_name', 'k_euler_a'), 
-            self.bridge_agent, 
-            waiting_prompt.gen_payload.get('karras', False)
-        ):
+        if waiting_prompt.gen_payload.get('sampler_name', 'k_euler_a') not in bridge.get_samplers(waiting_prompt.gen_payload.get('karras', False)):
             return [False, 'bridge_version']
         #logger.warning(datetime.utcnow())
-        if len(waiting_prompt.gen_payload.get('post_processing', [])) >= 1 and not check_bridge_capability("post-processing", self.bridge_agent):
+        if len(waiting_prompt.gen_payload.get('post_processing', [])) >= 1 and not bridge.has_capability("post-processing"):
             return [False, 'bridge_version']
         for pp in KNOWN_POST_PROCESSORS:
-            if pp in waiting_prompt.gen_payload.get('post_processing', []) and not check_bridge_capability(pp, self.bridge_agent):
+            if pp in waiting_prompt.gen_payload.get('post_processing', []) and not bridge.has_capability(pp):
                 return [False, 'bridge_version']
         if waiting_prompt.source_image and not self.allow_img2img:
             return [False, 'img2img']
         # Prevent txt2img requests being sent to "stable_diffusion_inpainting" workers
         if not waiting_prompt.source_image and (self.models == ["stable_diffusion_inpainting"] or waiting_prompt.models == ["stable_diffusion_inpainting"]):
             return [False, 'models']
-        if waiting_prompt.params.get('tiling') and not check_bridge_capability("tiling", self.bridge_agent):
+        if waiting_prompt.params.get('tiling') and not bridge.has_capability("tiling"):
             return [False, 'bridge_version']
-        if waiting_prompt.params.get('return_control_map') and not check_bridge_capability("return_control_map", self.bridge_agent):
+        if waiting_prompt.params.get('return_control_map') and not bridge.has_capability("return_control_map"):
             return [False, 'bridge_version']
         if waiting_prompt.params.get('control_type'):
-            if not check_bridge_capability("controlnet", self.bridge_agent):
+            if not bridge.has_capability("controlnet"):
                 return [False, 'bridge_version']
-            if not check_bridge_capability("image_is_control", self.bridge_agent):
+            if not bridge.has_capability("image_is_control"):
                 return [False, 'bridge_version']
             if not self.allow_controlnet:
                 return [False, 'bridge_version']
-        if waiting_prompt.params.get('hires_fix') and not check_bridge_capability("hires_fix", self.bridge_agent):
+        if waiting_prompt.params.get('hires_fix') and not bridge.has_capability("hires_fix"):
             return [False, 'bridge_version']
-        if waiting_prompt.params.get('clip_skip', 1) > 1 and not check_bridge_capability("clip_skip", self.bridge_agent):
+        if waiting_prompt.params.get('clip_skip', 1) > 1 and not bridge.has_capability("clip_skip"):
             return [False, 'bridge_version']
         if waiting_prompt.source_processing != 'img2img' and not self.allow_painting:
             return [False, 'painting']
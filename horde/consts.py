@@ -1,4 +1,4 @@
-HORDE_VERSION = "4.24.1"
+HORDE_VERSION = "4.25.0"
 
 WHITELISTED_SERVICE_IPS = {
     "212.227.227.178", # Turing Bot
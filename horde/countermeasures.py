@@ -1,6 +1,10 @@
 import os
+import time
+import bisect
 import requests
 import ipaddress
+import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FuturesTimeoutError
 
 from horde.logger import logger
 from horde.argparser import args
@@ -9,28 +13,247 @@ from datetime import timedelta
 from horde.consts import WHITELISTED_SERVICE_IPS, WHITELISTED_VPN_IPS
 
 ip_r = None
-logger.init("IP Address Cache", status="Connecting")
-if is_redis_up():
-	ip_r = get_ipaddr_db()
-	logger.init_ok("IP Address Cache", status="Connected")
-else:
-	logger.init_err("IP Address Cache", status="Failed")
 ip_s_r = None
-logger.init("IP Suspicion Cache", status="Connecting")
-if is_redis_up():
-	ip_s_r = get_ipaddr_suspicion_db()
-	logger.init_ok("IP Suspicion Cache", status="Connected")
-else:
-	logger.init_err("IP Suspicion Cache", status="Failed")
 ip_t_r = None
-logger.init("IP Timeout Cache", status="Connecting")
+logger.init("IP Address Caches", status="Connecting")
 if is_redis_up():
+	ip_r = get_ipaddr_db()
+	ip_s_r = get_ipaddr_suspicion_db()
 	ip_t_r = get_ipaddr_timeout_db()
-	logger.init_ok("IP Timeout Cache", status="Connected")
+	logger.init_ok("IP Address Caches", status="Connected")
 else:
-	logger.init_err("IP Timeout Cache", status="Failed")
+	logger.init_err("IP Address Caches", status="Failed")
 
 test_timeout = 0
+# The IP block timeouts are kept in a sorted set, with the block as the member and its expiry as the score
+IP_BLOCK_INDEX_KEY = "ip_block_index"
+# Increased every time a block is added or removed, so that each node knows when to reload its copy
+IP_BLOCK_VERSION_KEY = "ip_block_index_version"
+# How often each node checks if the IP blocks have changed
+IP_BLOCK_REFRESH_SECONDS = 1
+# How many IP checker requests each node can have running at the same time
+IP_CHECKER_THREADS = int(os.getenv("IP_CHECKER_THREADS", 8))
+# Beyond this many IPs waiting to be checked, new IPs are just told to try again later
+# The request threads don't wait on these, so this only bounds the backlog of lookups during raids
+IP_CHECKER_MAX_PENDING = int(os.getenv("IP_CHECKER_MAX_PENDING", 64))
+# After the IP checker fails to answer for an IP, we don't ask it again for this long
+IP_CHECKER_FAILURE_SECONDS = 60
+# How long a request waits for the IP checker to answer about a new IP
+# This is only long enough to catch the fast answers, as it holds the request thread.
+# Otherwise the client is told to try again, and the background lookup fills the cache for its next request
+IP_CHECKER_WAIT_SECONDS = 0.1
+# Returned while an IP is still being checked. The client should try again later
+IP_CHECK_PENDING = "pending"
+
+
+def get_ip_version_and_int(ipaddr):
+	'''Returns the IP version and the integer value of an IP address
+	IPv4 addresses mapped into IPv6 are treated as IPv4
+	'''
+	ip = ipaddress.ip_address(ipaddr)
+	if ip.version == 6 and ip.ipv4_mapped is not None:
+		ip = ip.ipv4_mapped
+	return ip.version, int(ip)
+
+
+class IPRangeTable:
+	'''A fixed list of IP networks, merged into disjoint integer ranges sorted by their start, per IP version
+	Checking if an IP is in any of them is a single bisect
+	'''
+
+	def __init__(self, networks):
+		ranges = {4: [], 6: []}
+		for network in networks:
+			ip_network = ipaddress.ip_network(network, strict=False)
+			ranges[ip_network.version].append((int(ip_network.network_address), int(ip_network.broadcast_address)))
+		self.starts = {}
+		self.ends = {}
+		for ip_version, version_ranges in ranges.items():
+			merged = []
+			for start, end in sorted(version_ranges):
+				# Overlapping or adjacent ranges become one
+				if merged and start <= merged[-1][1] + 1:
+					merged[-1][1] = max(merged[-1][1], end)
+				else:
+					merged.append([start, end])
+			self.starts[ip_version] = [start for start, _ in merged]
+			self.ends[ip_version] = [end for _, end in merged]
+
+	def __contains__(self, ipaddr):
+		try:
+			ip_version, ip_int = get_ip_version_and_int(ipaddr)
+		except ValueError:
+			return False
+		idx = bisect.bisect_right(self.starts[ip_version], ip_int) - 1
+		return idx >= 0 and self.ends[ip_version][idx] >= ip_int
+
+whitelisted_vpn_ranges = IPRangeTable(WHITELISTED_VPN_IPS)
+
+
+class IPBlockIndex:
+	'''In-memory copy of the IP block timeouts
+	The blocks are kept as integer ranges sorted by their start, per IP version,
+	so that an IP can be looked up with a single bisect instead of going through all of them
+	'''
+
+	def __init__(self):
+		self.tables = None
+		self.version = None
+		self.last_refresh = 0
+		self.migrated = False
+		self.lock = threading.Lock()
+
+	def refresh(self, force=False):
+		if not force and time.time() - self.last_refresh < IP_BLOCK_REFRESH_SECONDS:
+			return
+		# If another thread is already refreshing, we just use the current copy
+		if not self.lock.acquire(blocking=force):
+			return
+		try:
+			self.last_refresh = time.time()
+			if not self.migrated:
+				self.migrate_block_keys()
+				self.migrated = True
+			version = ip_t_r.get(IP_BLOCK_VERSION_KEY)
+			if version == self.version and self.tables is not None:
+				return
+			ip_t_r.zremrangebyscore(IP_BLOCK_INDEX_KEY, '-inf', time.time())
+			ranges = {4: [], 6: []}
+			for ip_block, expiry in ip_t_r.zrange(IP_BLOCK_INDEX_KEY, 0, -1, withscores=True):
+				network = ipaddress.ip_network(ip_block.decode(), strict=False)
+				ranges[network.version].append((int(network.network_address), int(network.broadcast_address), expiry))
+			tables = {}
+			for ip_version, version_ranges in ranges.items():
+				version_ranges.sort()
+				# The largest range end up to each position. As CIDR blocks are either nested or disjoint,
+				# this allows us to stop looking back as soon as no earlier block can reach the IP
+				max_ends = []
+				max_end = -1
+				for _, end, _ in version_ranges:
+					max_end = max(max_end, end)
+					max_ends.append(max_end)
+				tables[ip_version] = (
+					[start for start, _, _ in version_ranges],
+					[end for _, end, _ in version_ranges],
+					max_ends,
+					[expiry for _, _, expiry in version_ranges],
+				)
+			self.tables = tables
+			self.version = version
+		except Exception as err:
+			logger.error(f"Failed to refresh the IP block timeouts: {err}")
+		finally:
+			self.lock.release()
+
+	def migrate_block_keys(self):
+		'''Moves the IP block timeouts which were stored as individual keys into the index'''
+		for ip_block_key in ip_t_r.scan_iter("ipblock_*"):
+			ttl = ip_t_r.ttl(ip_block_key)
+			if ttl > 0:
+				ip_range = ip_block_key.decode().split('_',1)[1]
+				ip_t_r.zadd(IP_BLOCK_INDEX_KEY, {ip_range: time.time() + ttl})
+				ip_t_r.incr(IP_BLOCK_VERSION_KEY)
+			ip_t_r.delete(ip_block_key)
+
+	def get_timeout(self, ipaddr):
+		'''Returns the seconds left on the longest block timeout this IP is in'''
+		self.refresh()
+		tables = self.tables
+		if tables is None:
+			return 0
+		ip_version, ip_int = get_ip_version_and_int(ipaddr)
+		starts, ends, max_ends, expiries = tables[ip_version]
+		now = time.time()
+		timeout = 0
+		idx = bisect.bisect_right(starts, ip_int) - 1
+		while idx >= 0 and max_ends[idx] >= ip_int:
+			if ends[idx] >= ip_int and expiries[idx] > now:
+				timeout = max(timeout, int(expiries[idx] - now))
+			idx -= 1
+		return timeout
+
+ip_block_index = IPBlockIndex()
+
+
+class IPReputationResolver:
+	'''Looks up the safety of IPs from the IP checker on a bounded pool of threads
+	Concurrent lookups for the same IP share the same request to the IP checker
+	'''
+
+	def __init__(self, threads=IP_CHECKER_THREADS, max_pending=IP_CHECKER_MAX_PENDING, failure_seconds=IP_CHECKER_FAILURE_SECONDS):
+		self.executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix="ip_checker")
+		self.max_pending = max_pending
+		self.failure_seconds = failure_seconds
+		# The IPs currently being checked, with their futures
+		self.pending = {}
+		# The IPs which the IP checker failed to answer for, with the time we can ask again
+		self.failures = {}
+		self.lock = threading.Lock()
+
+	def resolve(self, ipaddr, wait_seconds=IP_CHECKER_WAIT_SECONDS):
+		'''Returns the safety of the IP, waiting at most wait_seconds for the IP checker if it's not known yet
+		Returns None if the IP checker can't answer about it right now
+		Returns IP_CHECK_PENDING if it's still being checked, or too many IPs are waiting to be checked
+		'''
+		is_safe = CounterMeasures.get_safe(ipaddr)
+		if is_safe is not None:
+			return is_safe
+		with self.lock:
+			future = self.pending.get(ipaddr)
+			if future is None:
+				if self.failures.get(ipaddr, 0) > time.time():
+					return None
+				self.failures.pop(ipaddr, None)
+				if len(self.pending) >= self.max_pending:
+					return IP_CHECK_PENDING
+				future = self.executor.submit(self.check_ip, ipaddr)
+				self.pending[ipaddr] = future
+		try:
+			return future.result(timeout=wait_seconds)
+		except FuturesTimeoutError:
+			return IP_CHECK_PENDING
+
+	def check_ip(self, ipaddr):
+		try:
+			is_safe = self.request_ip_safety(ipaddr)
+		except Exception as err:
+			logger.error(f"Exception when requesting info from checker: {err}")
+			is_safe = None
+		with self.lock:
+			if is_safe is None:
+				self.failures[ipaddr] = time.time() + self.failure_seconds
+				# So that the failures don't pile up during raids
+				if len(self.failures) > self.max_pending * 4:
+					now = time.time()
+					self.failures = {ip: retry_time for ip, retry_time in self.failures.items() if retry_time > now}
+			del self.pending[ipaddr]
+		return is_safe
+
+	def request_ip_safety(self, ipaddr):
+		'''Asks the IP checker about the IP and stores the result
+		Returns None if the IP checker can't answer right now
+		'''
+		safety_threshold=0.93
+		timeout=2.00
+		result = requests.get(os.getenv("IP_CHECKER").format(ipaddr = ipaddr), timeout=timeout)
+		if not result.ok:
+			if result.status_code == 429:
+				# If we exceeded the amount of requests we can do to the IP checker, we ask the client to try again later.
+				return None
+			else:
+				probability = float(result.content)
+			if probability == int(os.getenv("IP_CHECKER_LC")):
+				is_safe = CounterMeasures.set_safe(ipaddr,True)
+			else:
+				is_safe = CounterMeasures.set_safe(ipaddr,True) # True until I can improve my load
+				logger.error(f"An error occurred while validating IP. Return Code: {result.text}")
+		else:
+			probability = float(result.content)
+			is_safe = CounterMeasures.set_safe(ipaddr, probability < safety_threshold)
+		logger.debug(f"IP {ipaddr} has a probability of {probability}. Safe = {is_safe}")
+		return is_safe
+
+ip_reputation_resolver = IPReputationResolver()
 
 
 class CounterMeasures:
@@ -51,6 +274,8 @@ class CounterMeasures:
 	def is_ip_safe(ipaddr):
 		'''Returns False if the IP is not false
 		Else return true
+		Returns None if the IP checker can't answer right now
+		Returns IP_CHECK_PENDING while the IP is still being checked, in which case the client should try again later
 		This function is a bit obscured with env vars to prevent defeat
 		'''
 		# return True # FIXME: Until I figure this out
@@ -59,33 +284,9 @@ class CounterMeasures:
 		# If we don't have the cache up, it's always OK
 		if not ip_r:
 			return True
-		safety_threshold=0.93
-		timeout=2.00
 		if CounterMeasures.is_whitelisted_vpn(ipaddr):
 			return True
-		is_safe = CounterMeasures.get_safe(ipaddr)
-		if is_safe is None:
-			try:
-				result = requests.get(os.getenv("IP_CHECKER").format(ipaddr = ipaddr), timeout=timeout)
-			except Exception as err:
-				logger.error(f"Exception when requesting info from checker")
-				return None
-			if not result.ok:
-				if result.status_code == 429:
-					# If we exceeded the amount of requests we can do to the IP checker, we ask the client to try again later.
-					return None
-				else:
-					probability = float(result.content)
-				if probability == int(os.getenv("IP_CHECKER_LC")):
-					is_safe = CounterMeasures.set_safe(ipaddr,True)
-				else:
-					is_safe = CounterMeasures.set_safe(ipaddr,True) # True until I can improve my load
-					logger.error(f"An error occurred while validating IP. Return Code: {result.text}")
-			else:
-				probability = float(result.content)
-				is_safe = CounterMeasures.set_safe(ipaddr, probability < safety_threshold)
-			logger.debug(f"IP {ipaddr} has a probability of {probability}. Safe = {is_safe}")
-		return is_safe
+		return ip_reputation_resolver.resolve(ipaddr)
 
 	@staticmethod
 	def report_suspicion(ipaddr):
@@ -152,52 +353,69 @@ class CounterMeasures:
 
 	@staticmethod
 	def is_whitelisted_vpn(ipaddr):
-		for iprange in WHITELISTED_VPN_IPS:
-			if ipaddress.ip_address(ipaddr) in ipaddress.ip_network(iprange):
-				return True
-		return False
+		return ipaddr in whitelisted_vpn_ranges
 
 	@staticmethod
 	def set_block_timeout(ip_block, minutes):
 		'''Puts the ip address block into timeout for these amount of seconds'''
 		if not ip_t_r:
 			return
-		if len(ip_block.split('/')) != 2:
-			logger.warning(f"Attempted to inset non-block {ip_block} IP as a block timeout")
+		ip_network = CounterMeasures.parse_ip_block(ip_block)
+		if ip_network is None:
 			return
-		ip_t_r.setex(f"ipblock_{ip_block}", timedelta(minutes=minutes), int(True))
+		pipe = ip_t_r.pipeline()
+		pipe.zadd(IP_BLOCK_INDEX_KEY, {ip_network: time.time() + minutes * 60})
+		pipe.incr(IP_BLOCK_VERSION_KEY)
+		pipe.execute()
+		ip_block_index.refresh(force=True)
 		
 	@staticmethod
 	def retrieve_block_timeout(ipaddr):
 		'''Checks if the IP is in a block timeout'''
 		if not ip_t_r:
 			return
-		for ip_block_key in ip_t_r.scan_iter("ipblock_*"):
-			ip_range = ip_block_key.decode().split('_',1)[1]
-			if ipaddress.ip_address(ipaddr) in ipaddress.ip_network(ip_range):
-				ttl = ip_t_r.ttl(ip_block_key)
-				return int(ttl)
-		return 0
+		return ip_block_index.get_timeout(ipaddr)
 		
 	@staticmethod
 	def delete_block_timeout(ip_block):
 		'''Deletes an IP address block from being in timeout'''
 		if not ip_t_r:
 			return
+		ip_network = CounterMeasures.parse_ip_block(ip_block)
+		if ip_network is None:
+			return
+		pipe = ip_t_r.pipeline()
+		pipe.zrem(IP_BLOCK_INDEX_KEY, ip_network)
+		pipe.incr(IP_BLOCK_VERSION_KEY)
+		pipe.execute()
+		ip_block_index.refresh(force=True)
+
+	@staticmethod
+	def parse_ip_block(ip_block):
+		'''Returns the IP block in its canonical form, so that the same block is always stored the same way
+		Returns None if it's not a valid block
+		'''
 		if len(ip_block.split('/')) != 2:
 			logger.warning(f"Attempted to inset non-block {ip_block} IP as a block timeout")
-			return
-		ip_t_r.delete(f"ipblock_{ip_block}")
+			return None
+		try:
+			return str(ipaddress.ip_network(ip_block, strict=False))
+		except ValueError:
+			logger.warning(f"Attempted to inset invalid block {ip_block} IP as a block timeout")
+			return None
 
 	@staticmethod
 	def get_block_timeouts():
 		'''Returns all known IP block timeouts'''
+		if not ip_t_r:
+			return []
+		ip_block_index.refresh()
 		ip_blocks = []
-		for ip_block_key in ip_t_r.scan_iter("ipblock_*"):
-			ip_range = ip_block_key.decode().split('_',1)[1]
+		now = time.time()
+		for ip_block, expiry in ip_t_r.zrangebyscore(IP_BLOCK_INDEX_KEY, now, '+inf', withscores=True):
 			ip_blocks.append({
-				"ipaddr": ip_range,
-				"seconds": ip_t_r.ttl(ip_block_key),
+				"ipaddr": ip_block.decode(),
+				"seconds": int(expiry - now),
 			})
 		return ip_blocks
 		
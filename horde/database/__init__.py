@@ -3,12 +3,18 @@ from horde.database.classes import Quorum
 import horde.database.threads as threads
 from horde.argparser import args
 from horde.logger import logger
+from horde.flask import SQLITE_MODE
 
 # Threads
 quorum = Quorum(1, threads.get_quorum)
 wp_list_cacher = PrimaryTimedFunction(1, threads.store_prioritized_wp_queue, quorum=quorum)
+dispatch_indexer = PrimaryTimedFunction(5, threads.store_dispatch_index, quorum=quorum)
 worker_cacher = PrimaryTimedFunction(30, threads.store_worker_list, quorum=quorum)
+heartbeat_flusher = PrimaryTimedFunction(5, threads.flush_worker_heartbeats, quorum=quorum)
+# There's never a primary in SQLITE_MODE, so then every node applies the ledger itself
+kudos_ledger_flusher = PrimaryTimedFunction(5, threads.flush_kudos_ledger, quorum=quorum if not SQLITE_MODE else None)
 model_cacher = PrimaryTimedFunction(10, threads.store_available_models, quorum=quorum)
+cache_metrics_logger = PrimaryTimedFunction(300, threads.log_cached_request_metrics, quorum=quorum)
 if not args.check_prompts:
     wp_cleaner = PrimaryTimedFunction(60, threads.check_waiting_prompts, quorum=quorum)
 interrogations_cleaner = PrimaryTimedFunction(60, threads.check_interrogations, quorum=quorum)
@@ -16,13 +22,14 @@ patreon_cacher = PrimaryTimedFunction(3600, threads.store_patreon_members, quoru
 monthly_kudos = PrimaryTimedFunction(3600, threads.assign_monthly_kudos, quorum=quorum)
 totals_store = PrimaryTimedFunction(60, threads.store_totals, quorum=quorum)
 prune_stats = PrimaryTimedFunction(60, threads.prune_stats, quorum=quorum)
-priority_increaser = PrimaryTimedFunction(10, threads.increment_extra_priority, quorum=quorum)
 compiled_filter_cacher = PrimaryTimedFunction(10, threads.store_compiled_filter_regex, quorum=quorum)
 regex_replacements_cacher = PrimaryTimedFunction(10, threads.store_compiled_filter_regex_replacements, quorum=quorum)
 
 if args.reload_all_caches:
     logger.info("store_prioritized_wp_queue()")
     threads.store_prioritized_wp_queue()
+    logger.info("store_dispatch_index()")
+    threads.store_dispatch_index()
     logger.info("store_worker_list()")
     threads.store_worker_list()
     logger.info("store_totals()")
@@ -51,6 +58,6 @@ if args.new_patreons:
 # # Test
 
 # logger.info("store_compiled_filter_regex_replacements()")
-# threads.increment_extra_priority()
+# threads.store_compiled_filter_regex_replacements()
 # import sys
 # sys.exit()
\ No newline at end of file
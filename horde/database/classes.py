@@ -1,6 +1,8 @@
 import time
 import uuid
 import json
+import struct
+import hashlib
 import threading
 from datetime import datetime, timedelta
 from horde.argparser import args
@@ -10,12 +12,88 @@ from horde import horde_instance_id
 from horde.threads import PrimaryTimedFunction
 
 class FakeWPRow:
-    def __init__(self,json_row):
-        self.id = uuid.UUID(json_row["id"])
-        self.things = json_row["things"]
-        self.n = json_row["n"]
-        self.extra_priority = json_row["extra_priority"]
-        self.created = datetime.strptime(json_row["created"],"%Y-%m-%d %H:%M:%S")
+    def __init__(self, wp_id, things, n, priority, created):
+        self.id = wp_id
+        self.things = things
+        self.n = n
+        self.priority = priority
+        self.created = created
+
+
+# The queue is packed as a header followed by one column per field
+# All numbers are little-endian, which is what memoryview.cast() reads on the servers we run on
+WP_QUEUE_MAGIC = b"HWPQ"
+WP_QUEUE_FORMAT = 1
+WP_QUEUE_HEADER = struct.Struct("<4sBQI")
+UNIX_EPOCH = datetime(1970, 1, 1)
+
+def encode_wp_queue(wp_queue):
+    '''Packs the prioritized WP queue into a compact binary blob
+    Returns the version of the queue along with the blob. The version only changes when the queue does.
+    '''
+    count = len(wp_queue)
+    body = b"".join([
+        # In SQLITE_MODE the ids are strings
+        b"".join(wp.id.bytes if isinstance(wp.id, uuid.UUID) else uuid.UUID(wp.id).bytes for wp in wp_queue),
+        struct.pack(f"<{count}q", *[wp.things for wp in wp_queue]),
+        struct.pack(f"<{count}i", *[wp.n for wp in wp_queue]),
+        struct.pack(f"<{count}q", *[wp.queue_priority for wp in wp_queue]),
+        struct.pack(f"<{count}q", *[int((wp.created - UNIX_EPOCH).total_seconds()) for wp in wp_queue]),
+    ])
+    version = int.from_bytes(hashlib.blake2b(body, digest_size=8).digest(), "little")
+    return version, WP_QUEUE_HEADER.pack(WP_QUEUE_MAGIC, WP_QUEUE_FORMAT, version, count) + body
+
+
+class PackedWPQueue:
+    '''Reads the blob created by encode_wp_queue()
+    Nothing is decoded until it's accessed, and then only the requested rows
+    '''
+
+    def __init__(self, blob):
+        magic, queue_format, self.version, self.count = WP_QUEUE_HEADER.unpack_from(blob)
+        if magic != WP_QUEUE_MAGIC or queue_format != WP_QUEUE_FORMAT:
+            raise ValueError(f"Unknown WP queue format: {magic} v{queue_format}")
+        self.blob = blob
+        view = memoryview(blob)[WP_QUEUE_HEADER.size:]
+        count = self.count
+        self.ids = view[0:16 * count]
+        offset = 16 * count
+        self.things = view[offset:offset + 8 * count].cast('q')
+        offset += 8 * count
+        self.n = view[offset:offset + 4 * count].cast('i')
+        offset += 4 * count
+        self.priority = view[offset:offset + 8 * count].cast('q')
+        offset += 8 * count
+        self.created = view[offset:offset + 8 * count].cast('q')
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += self.count
+        if not 0 <= index < self.count:
+            raise IndexError("WP queue index out of range")
+        return FakeWPRow(
+            uuid.UUID(bytes=bytes(self.ids[16 * index:16 * (index + 1)])),
+            self.things[index],
+            self.n[index],
+            self.priority[index],
+            datetime.utcfromtimestamp(self.created[index]),
+        )
+
+    def index(self, wp_id):
+        '''Returns the position of this WP id in the queue, or None if it's not in it'''
+        wp_id_bytes = uuid.UUID(str(wp_id)).bytes
+        ids_start = WP_QUEUE_HEADER.size
+        ids_end = ids_start + 16 * self.count
+        position = self.blob.find(wp_id_bytes, ids_start, ids_end)
+        # The id bytes could also match across the boundary of two ids
+        while position != -1 and (position - ids_start) % 16 != 0:
+            position = self.blob.find(wp_id_bytes, position + 1, ids_end)
+        if position == -1:
+            return None
+        return (position - ids_start) // 16
 
 
 class Quorum(PrimaryTimedFunction):
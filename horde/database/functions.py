@@ -1,9 +1,10 @@
 import time
 import uuid
 import json
+import struct
 from datetime import datetime, timedelta
-from sqlalchemy import func, or_, and_, not_, Boolean
-from sqlalchemy.orm import noload
+from sqlalchemy import func, or_, and_
+from sqlalchemy.orm import noload, selectinload
 
 from horde.classes.base.waiting_prompt import WPModels, WPAllowedWorkers
 from horde.classes.base.worker import WorkerModel
@@ -11,10 +12,11 @@ from horde.flask import db, SQLITE_MODE
 from horde.logger import logger
 from horde.vars import thing_name
 from horde import vars as hv
-from horde.classes.base.worker import WorkerPerformance
+from horde.classes.base.worker import WorkerStats
 from horde.classes.stable.worker import ImageWorker
 from horde.classes.kobold.worker import TextWorker
-from horde.classes.base.user import User, UserRecords, UserSharedKey, KudosTransferLog
+from horde.classes.base.user import User, UserRecords, UserStats, UserSharedKey, KudosTransferLog, retrieve_role_flags, has_role_flag
+from horde.classes.base.kudos_ledger import KudosLedger, upsert_counters
 from horde.classes.stable.waiting_prompt import ImageWaitingPrompt
 from horde.classes.stable.processing_generation import ImageProcessingGeneration
 from horde.classes.kobold.waiting_prompt import TextWaitingPrompt
@@ -26,12 +28,21 @@ from horde.classes.base.detection import Filter
 from horde.classes.stable.interrogation_worker import InterrogationWorker
 from horde.utils import hash_api_key, validate_regex
 from horde import horde_redis as hr
-from horde.database.classes import FakeWPRow
-from horde.enums import State
+from horde.cached_request import cached_request
+from horde.apikey_cache import apikey_cache
+from horde.database.classes import PackedWPQueue, encode_wp_queue
+from horde.enums import State, LedgerEventTypes, UserRoleTypes
 from horde.bridge_reference import check_bridge_capability, get_supported_samplers, get_supported_pp
 
 from horde.classes.base.team import find_team_by_id, find_team_by_name, get_all_teams
 from horde.model_reference import model_reference
+from horde.dispatch import image_dispatch_index, get_image_worker_flags, retrieve_skip_histogram
+from horde import dispatch
+
+# This field is always present in the queue ranks hash, so that we can tell an empty queue from a missing one
+QUEUE_SIZE_FIELD = "_size"
+# The last decoded WP queue per type, along with its version
+packed_wp_queues = {}
 
 ALLOW_ANONYMOUS = True
 WORKER_CLASS_MAP = {
@@ -92,10 +103,13 @@ def get_active_workers(worker_type=None):
         ).all()
     return active_workers
 
+@cached_request(
+    key=lambda worker_class = "image": f"count_active_workers_{worker_class}",
+    ttl=300,
+    deserialize=tuple,
+    should_cache=lambda counts: counts[0] and counts[1],
+)
 def count_active_workers(worker_class = "image"):
-    worker_cache = hr.horde_r_get_json(f"count_active_workers_{worker_class}")
-    if worker_cache:
-        return tuple(worker_cache)
     WorkerClass = ImageWorker
     if worker_class == "interrogation":
         WorkerClass = InterrogationWorker
@@ -113,7 +127,6 @@ def count_active_workers(worker_class = "image"):
     ).first()
     # logger.debug([worker_class,active_workers,active_workers_threads.threads])
     if active_workers and active_workers_threads.threads:
-        hr.horde_r_setex_json(f"count_active_workers_{worker_class}", timedelta(seconds=300), [active_workers,active_workers_threads.threads])
         return active_workers,active_workers_threads.threads
     return 0,0
 
@@ -170,9 +183,54 @@ def find_user_by_id(user_id):
 def find_user_by_api_key(api_key):
     if api_key == 0000000000 and not ALLOW_ANONYMOUS:
         return(None)
-    user = db.session.query(User).filter_by(api_key=hash_api_key(api_key)).first()
+    hashed_api_key = hash_api_key(api_key)
+    user_details = apikey_cache.get(hashed_api_key)
+    if user_details is not None:
+        user = db.session.get(User, user_details["id"])
+        # The user might have been deleted or changed their key since it was cached
+        if user is not None and user.api_key == hashed_api_key:
+            return user
+        apikey_cache.invalidate(hashed_api_key)
+    user = db.session.query(User).filter_by(api_key=hashed_api_key).first()
+    if user is not None:
+        apikey_cache.set(hashed_api_key, get_api_key_user_details(user))
     return user
 
+def find_user_details_by_api_key(api_key):
+    '''Returns the id and role flags of the user owning this api key, without loading the user
+    Use this when the user is only needed to check its identity or roles
+    '''
+    if api_key == 0000000000 and not ALLOW_ANONYMOUS:
+        return(None)
+    hashed_api_key = hash_api_key(api_key)
+    user_details = apikey_cache.get(hashed_api_key)
+    if user_details is None:
+        user = db.session.query(User).filter_by(api_key=hashed_api_key).first()
+        if user is None:
+            return None
+        user_details = get_api_key_user_details(user)
+        apikey_cache.set(hashed_api_key, user_details)
+    # The roles are not cached with the api key, so that role changes reach every node straight away
+    role_flags = retrieve_role_flags(user_details["id"])
+    # Before granting moderator privileges, we make sure the key still belongs to this user
+    # in case the user or its key were changed outside of the ORM
+    if has_role_flag(role_flags, UserRoleTypes.MODERATOR):
+        key_owner = db.session.query(User.id).filter(
+            User.id == user_details["id"],
+            User.api_key == hashed_api_key,
+        ).first()
+        if key_owner is None:
+            # We look the key up again from the DB
+            apikey_cache.invalidate(hashed_api_key)
+            return find_user_details_by_api_key(api_key)
+    return {
+        "id": user_details["id"],
+        "role_flags": role_flags,
+    }
+
+def get_api_key_user_details(user):
+    return {"id": user.id}
+
 def find_user_by_sharedkey(shared_key):
     try:
         sharedkey_uuid = uuid.UUID(shared_key)
@@ -344,11 +402,9 @@ def retrieve_available_models(model_type=None,min_count=None,max_count=None):
     '''Retrieves model details from Redis cache, or from DB if cache is unavailable'''
     if hr.horde_r is None:
         return get_available_models()
-    model_cache = hr.horde_r_get('models_cache')
-    try:
-        models_ret = json.loads(model_cache)
-    except TypeError as e:
-        logger.error(f"Model cache could not be loaded: {model_cache}")
+    models_ret = hr.horde_r_get_decoded('models_cache')
+    if models_ret is None:
+        logger.error(f"Model cache could not be loaded")
         return []
     if models_ret is None:
         models_ret = get_available_models()
@@ -374,7 +430,17 @@ def transfer_kudos(source_user, dest_user, amount):
         return([0,'Your account has been flagged for suspicious activity. Please contact the mods.'])
     if amount < 0:
         return([0,'Nice try...'])
+    # Every transfer locks both users in the same order, so that two opposite transfers can't deadlock
+    # This also reloads their kudos, so the balance check can't race another transfer
+    db.session.query(
+        User
+    ).filter(
+        User.id.in_([source_user.id, dest_user.id])
+    ).order_by(
+        User.id
+    ).with_for_update().populate_existing().all()
     if amount > source_user.kudos - source_user.get_min_kudos():
+        db.session.rollback()
         return([0,'Not enough kudos.'])
     hr.horde_r_setex(f'kudos_transfer_{source_user.id}-{dest_user.id}', timedelta(seconds=60), 1)
     transfer_log = KudosTransferLog(
@@ -383,9 +449,10 @@ def transfer_kudos(source_user, dest_user, amount):
         kudos = amount,
     )
     db.session.add(transfer_log)
+    # The transfer and both sides of it are written together
+    source_user.modify_kudos(-amount, 'gifted', commit=False)
+    dest_user.modify_kudos(amount, 'received', commit=False)
     db.session.commit()
-    source_user.modify_kudos(-amount, 'gifted')
-    dest_user.modify_kudos(amount, 'received')
     logger.info(f"{source_user.get_unique_alias()} transfered {amount} kudos to {dest_user.get_unique_alias()}")
     return([amount,'OK'])
 
@@ -559,7 +626,7 @@ def retrieve_totals(ignore_cache = False):
     '''Retrieves horde totals from Redis cache'''
     if ignore_cache or hr.horde_r is None:
         return count_totals()
-    totals_ret = hr.horde_r_get('totals_cache')
+    totals_ret = hr.horde_r_get_decoded('totals_cache')
     if totals_ret is None:
         return {
             "queued_requests": 0,
@@ -568,7 +635,8 @@ def retrieve_totals(ignore_cache = False):
             f"queued_{hv.thing_names['text']}": 0,
             f"queued_forms": 0,
         }
-    return(json.loads(totals_ret))
+    # The decoded totals are shared, and our callers like to extend them
+    return(totals_ret.copy())
 
 
 def get_organized_wps_by_model(wp_class):
@@ -647,11 +715,31 @@ def count_things_for_specific_model(wp_class, procgen_class, model_name):
     return things,jobs
 
 
-def get_sorted_wp_filtered_to_worker(worker, models_list = None, blacklist = None, priority_user_ids=None, page=0): 
+def filter_wps_after(wp_class, after_wp):
+    '''Keyset filter which only keeps the WPs sorted after after_wp by queue_priority, created and id'''
+    return or_(
+        wp_class.queue_priority < after_wp.queue_priority,
+        and_(
+            wp_class.queue_priority == after_wp.queue_priority,
+            wp_class.created > after_wp.created,
+        ),
+        and_(
+            wp_class.queue_priority == after_wp.queue_priority,
+            wp_class.created == after_wp.created,
+            wp_class.id > after_wp.id,
+        ),
+    )
+
+def get_sorted_wp_filtered_to_worker(worker, models_list = None, blacklist = None, priority_user_ids=None, after_wp=None, per_page=3): 
     # This is just the top 25 - Adjusted method to send ImageWorker object. Filters to add.
     # TODO: Filter by ImageWorker not in WP.tricked_worker
     # TODO: If any word in the prompt is in the WP.blacklist rows, then exclude it (L293 in base.worker.ImageWorker.gan_generate())
-    PER_PAGE = 3 # how many requests we're picking up to filter further
+    # per_page is how many requests we're picking up to filter further
+    # after_wp is the last WP of the previous page we checked
+    dispatched_wp_list = get_dispatched_wp_for_worker(worker, models_list, priority_user_ids, after_wp, per_page)
+    if dispatched_wp_list is not None:
+        return dispatched_wp_list
+    worker_flags = get_image_worker_flags(worker)
     final_wp_list = db.session.query(
         ImageWaitingPrompt
     ).options(
@@ -664,7 +752,7 @@ def get_sorted_wp_filtered_to_worker(worker, models_list = None, blacklist = Non
         ImageWaitingPrompt.active == True,
         ImageWaitingPrompt.faulted == False,
         ImageWaitingPrompt.expiry > datetime.utcnow(),
-        ImageWaitingPrompt.width * ImageWaitingPrompt.height <= worker.max_pixels,
+        ImageWaitingPrompt.pixels <= worker.max_pixels,
         or_(
             WPModels.model.in_(models_list),
             and_(
@@ -684,72 +772,76 @@ def get_sorted_wp_filtered_to_worker(worker, models_list = None, blacklist = Non
                 WPAllowedWorkers.worker_id != worker.id,
             ),
         ),
-        or_(
-            ImageWaitingPrompt.source_image == None,
-            worker.allow_img2img == True,
-        ),
-        or_(
-            ImageWaitingPrompt.source_processing.not_in(["inpainting", "outpainting"]),
-            worker.allow_painting == True,
-        ),
-        or_(
-            ImageWaitingPrompt.safe_ip == True,
-            worker.allow_unsafe_ipaddr == True,
-        ),
-        or_(
-            ImageWaitingPrompt.nsfw == False,
-            worker.nsfw == True,
-        ),
+        # The WP can only be picked up if this worker can serve all the capabilities it requires
+        ImageWaitingPrompt.requirements.op('&')(~worker_flags) == 0,
         or_(
             worker.maintenance == False,
             ImageWaitingPrompt.user_id == worker.user_id,
         ),
-        or_(
-            check_bridge_capability("r2", worker.bridge_agent),
-            ImageWaitingPrompt.r2 == False,
-        ),
-        or_(
-            not_(ImageWaitingPrompt.params.has_key('loras')),
-            and_(
-                worker.allow_lora == True,
-                check_bridge_capability("lora", worker.bridge_agent),
-            ),
-        ),
-        or_(
-            not_(ImageWaitingPrompt.params.has_key('tis')),
-            check_bridge_capability("textual_inversion", worker.bridge_agent),
-        ),
-        or_(
-            not_(ImageWaitingPrompt.params.has_key('post-processing')),
-            and_(
-                worker.allow_post_processing == True,
-                check_bridge_capability("post-processing", worker.bridge_agent),
-            ),
-        ),
-        or_(
-            not_(ImageWaitingPrompt.params.has_key('control_type')),
-            and_(
-                worker.allow_controlnet == True,
-                check_bridge_capability("controlnet", worker.bridge_agent),
-            ),
-        ),
-        or_(
-            worker.speed >= 500000, # 0.5 MPS/s
-            ImageWaitingPrompt.slow_workers == True,
-        ),
     )
     # logger.debug(final_wp_list)
     if priority_user_ids:
         final_wp_list = final_wp_list.filter(ImageWaitingPrompt.user_id.in_(priority_user_ids))
+    if after_wp is not None:
+        final_wp_list = final_wp_list.filter(filter_wps_after(ImageWaitingPrompt, after_wp))
     # logger.debug(final_wp_list)
     final_wp_list = final_wp_list.order_by(
-        ImageWaitingPrompt.extra_priority.desc(), 
-        ImageWaitingPrompt.created.asc()
-    ).offset(PER_PAGE * page).limit(PER_PAGE)
-    return final_wp_list.populate_existing().with_for_update(skip_locked=True, of=ImageWaitingPrompt).all()
+        ImageWaitingPrompt.queue_priority.desc(), 
+        ImageWaitingPrompt.created.asc(),
+        ImageWaitingPrompt.id.asc(),
+    ).limit(per_page)
+    return final_wp_list.populate_existing().all()
+
+def get_dispatched_wp_for_worker(worker, models_list, priority_user_ids, after_wp, per_page):
+    """Uses the in-memory dispatch index to find which WPs this worker can pick up
+    so that we only need to touch the DB to lock the rows we've chosen.
+    Returns None when the index is not available, in which case we have to do a full DB query.
+    """
+    candidate_ids = image_dispatch_index.find_candidates(
+        worker,
+        get_image_worker_flags(worker),
+        models_list,
+        priority_user_ids,
+        after_wp,
+    )
+    if candidate_ids is None:
+        return None
+    offset = 0
+    while offset < len(candidate_ids):
+        page_ids = candidate_ids[offset:offset + per_page]
+        if not SQLITE_MODE:
+            page_ids = [uuid.UUID(wp_id) for wp_id in page_ids]
+        # The index can be up to a second behind, so we still ensure the WP is waiting
+        # The job itself is claimed atomically in WaitingPrompt.claim_job()
+        wp_list = db.session.query(
+            ImageWaitingPrompt
+        ).options(
+            noload(ImageWaitingPrompt.processing_gens)
+        ).filter(
+            ImageWaitingPrompt.id.in_(page_ids),
+            ImageWaitingPrompt.n > 0,
+            ImageWaitingPrompt.active == True,
+            ImageWaitingPrompt.faulted == False,
+            ImageWaitingPrompt.expiry > datetime.utcnow(),
+        ).order_by(
+            ImageWaitingPrompt.queue_priority.desc(), 
+            ImageWaitingPrompt.created.asc(),
+            ImageWaitingPrompt.id.asc(),
+        ).populate_existing().all()
+        if len(wp_list) > 0:
+            return wp_list
+        # If all the candidates in this page were picked up in the meantime, we move to the next candidates
+        # as an empty page means to the caller that there are no more WPs to check
+        offset += per_page
+    return []
 
 def count_skipped_image_wp(worker, models_list = None, blacklist = None, priority_user_ids=None):
+    if not models_list: models_list = []
+    histogram = retrieve_skip_histogram("image")
+    if histogram is not None:
+        return count_skipped_image_wp_from_histogram(worker, histogram, models_list)
     ## Massively costly approach, doing 1 new query per count. Not sure about it.
+    # We only do this when the primary hasn't stored the skip histogram.
     ret_dict = {}
     open_wp_list = db.session.query(
         ImageWaitingPrompt
@@ -788,7 +880,7 @@ def count_skipped_image_wp(worker, models_list = None, blacklist = None, priorit
     if skipped_workers > 0:
         ret_dict["worker_id"] = skipped_workers
     max_pixels = open_wp_list.filter(
-        ImageWaitingPrompt.width * ImageWaitingPrompt.height >= worker.max_pixels,
+        ImageWaitingPrompt.pixels > worker.max_pixels,
     ).count()
     # Count skipped max pixels
     if max_pixels > 0:
@@ -830,7 +922,7 @@ def count_skipped_image_wp(worker, models_list = None, blacklist = None, priorit
     # Count skipped lora
     if worker.allow_lora == False or not check_bridge_capability("lora", worker.bridge_agent):
         skipped_wps = open_wp_list.filter(
-            ImageWaitingPrompt.params.has_key('loras'),
+            ImageWaitingPrompt.has_lora == True,
         ).count()
         if skipped_wps > 0:
             if worker.allow_lora == False:
@@ -840,14 +932,14 @@ def count_skipped_image_wp(worker, models_list = None, blacklist = None, priorit
     # Count skipped TI
     if not check_bridge_capability("textual_inversion", worker.bridge_agent):
         skipped_wps = open_wp_list.filter(
-            ImageWaitingPrompt.params.has_key('tis'),
+            ImageWaitingPrompt.has_ti == True,
         ).count()
         if skipped_wps > 0:
             ret_dict["bridge_version"] = ret_dict.get("bridge_version",0) + skipped_wps
     # Count skipped PP
     if worker.allow_post_processing == False or not check_bridge_capability("post-processing", worker.bridge_agent):
         skipped_wps = open_wp_list.filter(
-            ImageWaitingPrompt.params.has_key('post-processing'),
+            ImageWaitingPrompt.has_pp == True,
         ).count()
         if skipped_wps > 0:
             if worker.allow_post_processing == False:
@@ -866,7 +958,7 @@ def count_skipped_image_wp(worker, models_list = None, blacklist = None, priorit
     #         ret_dict["bridge_version"] = ret_dict.get("bridge_version",0) + skipped_wps
     if worker.allow_controlnet == False or not check_bridge_capability("controlnet", worker.bridge_agent):
         skipped_wps = open_wp_list.filter(
-            ImageWaitingPrompt.params.has_key('control_type'),
+            ImageWaitingPrompt.has_controlnet == True,
         ).count()
         if worker.allow_controlnet == False:
             ret_dict["controlnet"] = skipped_wps
@@ -892,24 +984,24 @@ def count_skipped_image_wp(worker, models_list = None, blacklist = None, priorit
     skipped_bv = open_wp_list.filter(
         or_(
             and_(
-                ImageWaitingPrompt.params['sampler_name'].astext.not_in(available_samplers),
-                ImageWaitingPrompt.params['karras'].astext.cast(Boolean).is_(False)
+                ImageWaitingPrompt.sampler.not_in(available_samplers),
+                ImageWaitingPrompt.karras.is_(False)
             ),
             and_(
-                ImageWaitingPrompt.params['sampler_name'].astext.not_in(available_karras_samplers),
-                ImageWaitingPrompt.params['karras'].astext.cast(Boolean).is_(True)
+                ImageWaitingPrompt.sampler.not_in(available_karras_samplers),
+                ImageWaitingPrompt.karras.is_(True)
             ),
             and_(
                 not check_bridge_capability("hires_fix", worker.bridge_agent),
-                ImageWaitingPrompt.params['hires_fix'].astext.cast(Boolean).is_(True)
+                ImageWaitingPrompt.requirements.op('&')(dispatch.DF_HIRES_FIX) != 0
             ),
             and_(
                 not check_bridge_capability("return_control_map", worker.bridge_agent),
-                ImageWaitingPrompt.params['return_control_map'].astext.cast(Boolean).is_(True)
+                ImageWaitingPrompt.requirements.op('&')(dispatch.DF_RETURN_CONTROL_MAP) != 0
             ),
             and_(
                 not check_bridge_capability("tiling", worker.bridge_agent),
-                ImageWaitingPrompt.params['tiling'].astext.cast(Boolean).is_(True)
+                ImageWaitingPrompt.requirements.op('&')(dispatch.DF_TILING) != 0
             ),
         ),
     ).count()
@@ -924,6 +1016,71 @@ def count_skipped_image_wp(worker, models_list = None, blacklist = None, priorit
     # 'kudos': skipped_kudos, # Not Implemented: See skipped_kudos TODO.
     return ret_dict
 
+def count_skipped_image_wp_from_histogram(worker, histogram, models_list):
+    '''Calculates the same skipped counts as count_skipped_image_wp()
+    but from the histogram of open WP features stored by the primary, so we don't hit the DB
+    '''
+    ret_dict = {}
+    def add_skipped(reason, count):
+        ret_dict[reason] = ret_dict.get(reason, 0) + count
+    # We figure out which reason each flag should be reported as for this worker, if it can't serve it
+    flag_reasons = []
+    for flag, allowed, capability, reason in [
+        (dispatch.DF_IMG2IMG, worker.allow_img2img, "img2img", "img2img"),
+        (dispatch.DF_PAINTING, worker.allow_painting, "inpainting", "painting"),
+        (dispatch.DF_LORA, worker.allow_lora, "lora", "lora"),
+        (dispatch.DF_TI, True, "textual_inversion", None),
+        (dispatch.DF_POST_PROCESSING, worker.allow_post_processing, "post-processing", "post-processing"),
+        (dispatch.DF_CONTROLNET, worker.allow_controlnet, "controlnet", "controlnet"),
+    ]:
+        if allowed == False:
+            flag_reasons.append((flag, reason))
+        elif not check_bridge_capability(capability, worker.bridge_agent):
+            flag_reasons.append((flag, "bridge_version"))
+    if worker.allow_unsafe_ipaddr == False:
+        flag_reasons.append((dispatch.DF_UNSAFE_IP, "unsafe_ip"))
+    if worker.nsfw == False:
+        flag_reasons.append((dispatch.DF_NSFW, "nsfw"))
+    if worker.speed <= 500000: # 0.5 MPS/s
+        flag_reasons.append((dispatch.DF_FAST_WORKERS, "performance"))
+    if worker.user.trusted == False:
+        flag_reasons.append((dispatch.DF_TRUSTED, "untrusted"))
+    bridge_flags = 0
+    for flag, capability in [
+        (dispatch.DF_HIRES_FIX, "hires_fix"),
+        (dispatch.DF_RETURN_CONTROL_MAP, "return_control_map"),
+        (dispatch.DF_TILING, "tiling"),
+    ]:
+        if not check_bridge_capability(capability, worker.bridge_agent):
+            bridge_flags |= flag
+    available_samplers = get_supported_samplers(worker.bridge_agent, karras=False)
+    available_karras_samplers = get_supported_samplers(worker.bridge_agent, karras=True)
+    for features in histogram["features"]:
+        count = features["count"]
+        if len(features["models"]) and not any(model_name in models_list for model_name in features["models"]):
+            add_skipped("models", count)
+        # We only count the tiers which are fully above the worker's max pixels.
+        # This undercounts: WPs in the tier straddling the worker's max pixels which are above it
+        # aren't reported as skipped, since the histogram doesn't know their exact pixels.
+        # The PIXEL_TIERS boundaries are the usual square max_pixels (512x512, 768x768, 1024x1024 etc),
+        # so workers using one of those are counted exactly.
+        if dispatch.get_tier_min_pixels(features["tier"]) > worker.max_pixels:
+            add_skipped("max_pixels", count)
+        for flag, reason in flag_reasons:
+            if features["flags"] & flag:
+                add_skipped(reason, count)
+        if features["karras"]:
+            sampler_supported = features["sampler"] in available_karras_samplers
+        else:
+            sampler_supported = features["sampler"] in available_samplers
+        if not sampler_supported or features["flags"] & bridge_flags:
+            add_skipped("bridge_version", count)
+    worker_id = str(worker.id)
+    for restricted in histogram["restricted"]:
+        if restricted["worker_blacklist"] == (worker_id in restricted["workers"]):
+            add_skipped("worker_id", restricted["count"])
+    return ret_dict
+
 def get_sorted_forms_filtered_to_worker(worker, forms_list = None, priority_user_ids = None, excluded_forms = None): 
     # Currently the worker is not being used, but I leave it being sent in case we need it later for filtering
     if forms_list == None:
@@ -975,24 +1132,27 @@ def get_sorted_forms_filtered_to_worker(worker, forms_list = None, priority_user
 def get_wp_queue_stats(wp):
     if not wp.needs_gen():
         return(-1,0,0)
+    queue_rank = retrieve_wp_queue_rank(wp)
+    if queue_rank is not None:
+        return queue_rank
     things_ahead_in_queue = 0
     n_ahead_in_queue = 0
     priority_sorted_list = retrieve_prioritized_wp_queue(wp.wp_type)
     # In case the primary thread has borked, we fall back to the DB
     if priority_sorted_list is None:
         logger.warning("Cached WP priority query does not exist. Falling back to direct DB query. Please check thread on primary!")
-        priority_sorted_list = query_prioritized_wps(wp.wp_type)
-    # logger.info(priority_sorted_list)
-    for iter in range(len(priority_sorted_list)):
-        iter_wp = priority_sorted_list[iter]
-        queued_things = round(iter_wp.things * iter_wp.n/hv.thing_divisors["image"],2)
-        things_ahead_in_queue += queued_things
-        n_ahead_in_queue += iter_wp.n
-        if iter_wp.id == wp.id:
-            things_ahead_in_queue = round(things_ahead_in_queue,2)
-            return(iter, things_ahead_in_queue, n_ahead_in_queue)
+        _, packed_queue = encode_wp_queue(query_prioritized_wps(wp.wp_type))
+        priority_sorted_list = PackedWPQueue(packed_queue)
+    queue_position = priority_sorted_list.index(wp.id)
     # -1 means the WP is done and not in the queue
-    return(-1,0,0)
+    if queue_position is None:
+        return(-1,0,0)
+    for iter in range(queue_position + 1):
+        queued_things = round(priority_sorted_list.things[iter] * priority_sorted_list.n[iter]/hv.thing_divisors["image"],2)
+        things_ahead_in_queue += queued_things
+        n_ahead_in_queue += priority_sorted_list.n[iter]
+    things_ahead_in_queue = round(things_ahead_in_queue,2)
+    return(queue_position, things_ahead_in_queue, n_ahead_in_queue)
 
 
 def get_wp_by_id(wp_id, lite=False):
@@ -1058,13 +1218,13 @@ def get_all_active_wps():
         ImageWaitingPrompt.expiry > datetime.utcnow(),
     ).all()    
 
-#TODO: Convert below three functions into a general "cached db request" (or something) class
-# Which I can reuse to cache the results of other requests
 def retrieve_worker_performances(worker_type = ImageWorker):
     avg_perf = db.session.query(
-        func.avg(WorkerPerformance.performance)
-    ).join(
+        func.avg(worker_type.speed)
+    ).select_from(
         worker_type
+    ).filter(
+        worker_type.fulfilments > 0
     ).scalar()
     if avg_perf is None:
         avg_perf = 0
@@ -1072,35 +1232,20 @@ def retrieve_worker_performances(worker_type = ImageWorker):
         avg_perf = round(avg_perf, 2)
     return avg_perf
 
-def refresh_worker_performances_cache(request_type = "image"):
-    ret_dict = {
-        "image":retrieve_worker_performances(ImageWorker),
-        "text": retrieve_worker_performances(TextWorker),
-    }
-    try:
-        hr.horde_r_setex(f'worker_performances_avg_cache', timedelta(seconds=30), ret_dict["image"])
-        hr.horde_r_setex(f'text_worker_performances_avg_cache', timedelta(seconds=30), ret_dict["text"])
-    except Exception as e:
-        logger.debug(f"Error when trying to set worker performances cache: {e}. Retrieving from DB.")
-    return ret_dict[request_type]
-
+@cached_request(
+    key=lambda request_type = "image": "worker_performances_avg_cache" if request_type == "image" else f"{request_type}_worker_performances_avg_cache",
+    ttl=30,
+)
 def get_request_avg(request_type = "image"):
-    if hr.horde_r == None:
-        return retrieve_worker_performances(WORKER_CLASS_MAP[request_type])
-    if request_type == "image":
-        perf_cache = hr.horde_r_get(f'worker_performances_avg_cache')
-    else:
-        perf_cache = hr.horde_r_get(f'text_worker_performances_avg_cache')
-    if not perf_cache:
-        return refresh_worker_performances_cache(request_type)
-    perf_cache = float(perf_cache)
-    return perf_cache
+    return retrieve_worker_performances(WORKER_CLASS_MAP[request_type])
 
+@cached_request(
+    key=lambda wp: f"wp_validity_{wp.id}",
+    ttl=60,
+    serialize=bool,
+)
 def wp_has_valid_workers(wp):
     # return True # FIXME: Still too heavy on the amount of data retrieved
-    cached_validity = hr.horde_r_get(f'wp_validity_{wp.id}')
-    if cached_validity is not None:
-        return bool(int(cached_validity))
     # tic = time.time()
     if wp.faulted:
         return []
@@ -1178,7 +1323,7 @@ def wp_has_valid_workers(wp):
     )
     if wp.wp_type == "image":
         final_worker_list = final_worker_list.filter(
-            wp.width * wp.height <= worker_class.max_pixels,
+            wp.pixels <= worker_class.max_pixels,
             or_(
                 wp.source_image == None,
                 and_(
@@ -1191,12 +1336,13 @@ def wp_has_valid_workers(wp):
                 worker_class.speed >= 500000,
             ),
             or_(
-                'loras' not in wp.params,
-                and_(
-                    worker_class.allow_lora == True,
-                    #TODO: Create an sql function I can call to check the worker bridge capabilities
-                    'loras' in wp.params,
-                ),
+                wp.has_lora == False,
+                #TODO: Create an sql function I can call to check the worker bridge capabilities
+                worker_class.allow_lora == True,
+            ),
+            or_(
+                wp.has_controlnet == False,
+                worker_class.allow_controlnet == True,
             ),
             # or_(
             #     'tis' not in wp.params,
@@ -1222,25 +1368,64 @@ def wp_has_valid_workers(wp):
         if worker.can_generate(wp)[0]:
             worker_found = True
     # logger.debug(time.time() - tic)
-    hr.horde_r_setex(f'wp_validity_{wp.id}', timedelta(seconds=60), int(worker_found))
     return worker_found
 
+@logger.catch(reraise=True)
+def retrieve_wp_queue_rank(wp):
+    '''Looks up the position of the WP in the queue stored by the primary
+    Returns None if the primary hasn't stored the queue ranks
+    '''
+    if not hr.horde_r:
+        return None
+    try:
+        queue_rank, queue_size = hr.horde_r_hmget(f'{wp.wp_type}_wp_queue_ranks', str(wp.id), QUEUE_SIZE_FIELD)
+    except Exception as err:
+        logger.error(f"Failed retrieving the queue rank with error: {err}")
+        return None
+    if queue_size is None:
+        return None
+    # -1 means the WP is done and not in the queue
+    if queue_rank is None:
+        return(-1,0,0)
+    rank, things_ahead_in_queue, n_ahead_in_queue = queue_rank.split(',')
+    return(int(rank), float(things_ahead_in_queue), int(n_ahead_in_queue))
+
 @logger.catch(reraise=True)
 def retrieve_prioritized_wp_queue(wp_type):
-    cached_queue = hr.horde_r_get(f'{wp_type}_wp_cache')
-    if cached_queue is None:
+    '''Returns the WP queue stored by the primary
+    We keep the queue we retrieved last, until the primary stores a different version of it
+    '''
+    queue_version = hr.horde_r_get(f'{wp_type}_wp_cache_version')
+    if queue_version is None:
+        return None
+    cached_queue = packed_wp_queues.get(wp_type)
+    if cached_queue is not None and str(cached_queue.version) == queue_version:
+        return cached_queue
+    packed_queue = hr.horde_r_get_bytes(f'{wp_type}_wp_cache')
+    if packed_queue is None:
         return None
     try:
-        retrieved_json_list = json.loads(cached_queue)
-    except (TypeError, OverflowError) as e:
+        cached_queue = PackedWPQueue(packed_queue)
+    except (ValueError, struct.error) as e:
         logger.error(f"Failed deserializing with error: {e}")
         return None
-    deserialized_wp_list = []
-    for json_row in retrieved_json_list:
-        fake_wp_row = FakeWPRow(json_row)
-        deserialized_wp_list.append(fake_wp_row)
-    # logger.debug(len(deserialized_wp_list))
-    return deserialized_wp_list
+    packed_wp_queues[wp_type] = cached_queue
+    return cached_queue
+
+def query_dispatchable_wps(wp_type = "image"):
+    waiting_prompt_type = WP_CLASS_MAP[wp_type]
+    return db.session.query(
+                waiting_prompt_type
+            ).options(
+                noload(waiting_prompt_type.processing_gens),
+                selectinload(waiting_prompt_type.models),
+                selectinload(waiting_prompt_type.workers),
+            ).filter(
+                waiting_prompt_type.n > 0,
+                waiting_prompt_type.faulted == False,
+                waiting_prompt_type.active == True,
+                waiting_prompt_type.expiry > datetime.utcnow(),
+            ).all()
 
 def query_prioritized_wps(wp_type = "image"):
     waiting_prompt_type = WP_CLASS_MAP[wp_type]
@@ -1249,6 +1434,7 @@ def query_prioritized_wps(wp_type = "image"):
                 waiting_prompt_type.things, 
                 waiting_prompt_type.n, 
                 waiting_prompt_type.extra_priority, 
+                waiting_prompt_type.queue_priority, 
                 waiting_prompt_type.created,
                 waiting_prompt_type.expiry,
             ).filter(
@@ -1256,7 +1442,7 @@ def query_prioritized_wps(wp_type = "image"):
                 waiting_prompt_type.faulted == False,
                 waiting_prompt_type.active == True,
             ).order_by(
-                waiting_prompt_type.extra_priority.desc(), waiting_prompt_type.created.asc()
+                waiting_prompt_type.queue_priority.desc(), waiting_prompt_type.created.asc()
             ).all()
 
 
@@ -1276,6 +1462,69 @@ def prune_expired_stats():
     logger.debug("Pruned Expired Stats")
 
 
+def apply_kudos_ledger(limit=10000):
+    '''Folds the oldest events of the kudos ledger into the UserStats, UserRecords, WorkerStats and Team totals
+    The events are deleted in the same transaction in which they're applied, so they can never be counted twice
+    Returns how many events were applied
+    '''
+    events_query = db.session.query(KudosLedger).order_by(KudosLedger.id).limit(limit)
+    if not SQLITE_MODE:
+        # If a different node is still applying some events, we leave them to it
+        events_query = events_query.with_for_update(skip_locked=True)
+    events = events_query.all()
+    if not events:
+        return 0
+    user_stats = {}
+    user_records = {}
+    worker_stats = {}
+    team_totals = {}
+    for event in events:
+        if event.event_type == LedgerEventTypes.USER_KUDOS:
+            counter_key = (event.user_id, event.key)
+            user_stats[counter_key] = user_stats.get(counter_key, 0) + event.value
+        elif event.event_type == LedgerEventTypes.USER_RECORD:
+            counter_key = (event.user_id, event.record_type, event.key)
+            user_records[counter_key] = user_records.get(counter_key, 0) + event.value
+        elif event.event_type == LedgerEventTypes.WORKER_KUDOS:
+            counter_key = (event.worker_id, event.key)
+            worker_stats[counter_key] = worker_stats.get(counter_key, 0) + event.value
+        elif event.event_type == LedgerEventTypes.TEAM:
+            totals = team_totals.setdefault(event.team_id, {"last_active": event.created})
+            totals[event.key] = totals.get(event.key, 0) + event.value
+            totals["last_active"] = max(totals["last_active"], event.created)
+    upsert_counters(
+        UserStats,
+        ["user_id", "action"],
+        [{"user_id": user_id, "action": action, "value": round(value, 2)} for (user_id, action), value in user_stats.items()],
+    )
+    upsert_counters(
+        UserRecords,
+        ["user_id", "record_type", "record"],
+        [
+            {"user_id": user_id, "record_type": record_type, "record": record, "value": round(value, 2)}
+            for (user_id, record_type, record), value in user_records.items()
+        ],
+    )
+    upsert_counters(
+        WorkerStats,
+        ["worker_id", "action"],
+        [{"worker_id": worker_id, "action": action, "value": round(value, 2)} for (worker_id, action), value in worker_stats.items()],
+    )
+    for team_id, totals in team_totals.items():
+        team_update = {Team.last_active: totals.pop("last_active")}
+        for column, value in totals.items():
+            team_column = getattr(Team, column)
+            team_update[team_column] = team_column + round(value, 2)
+        db.session.query(Team).filter(Team.id == team_id).update(team_update, synchronize_session=False)
+    db.session.query(
+        KudosLedger
+    ).filter(
+        KudosLedger.id.in_([event.id for event in events])
+    ).delete(synchronize_session=False)
+    db.session.commit()
+    return len(events)
+
+
 def compile_regex_filter(filter_type):
     all_filter_regex_query = db.session.query(Filter.regex).filter_by(filter_type=filter_type)
     all_filter_regex = [filter.regex for filter in all_filter_regex_query.all()]
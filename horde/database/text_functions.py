@@ -13,7 +13,7 @@ from horde.flask import db, SQLITE_MODE
 from horde.logger import logger
 from horde.vars import thing_name,thing_divisor
 from horde import vars as hv
-from horde.classes.base.worker import WorkerPerformance
+from horde.classes.base.worker import WorkerTemplate
 from horde.classes.kobold.worker import TextWorker
 from horde.classes.base.user import User
 # FIXME: Renamed for backwards compat. To fix later
@@ -22,8 +22,8 @@ from horde.classes.kobold.processing_generation import TextProcessingGeneration
 import horde.classes.base.stats as stats
 from horde.utils import hash_api_key
 from horde import horde_redis as hr
-from horde.database.classes import FakeWPRow, PrimaryTimedFunction
-from horde.database.functions import query_prioritized_wps
+from horde.database.classes import PrimaryTimedFunction
+from horde.database.functions import query_prioritized_wps, filter_wps_after
 from horde.enums import State
 from horde.bridge_reference import check_bridge_capability
 from horde.model_reference import model_reference
@@ -36,13 +36,13 @@ def convert_things_to_kudos(things, **kwargs):
 
 
 
-def get_sorted_text_wp_filtered_to_worker(worker, models_list = None, priority_user_ids=None, page=0): 
+def get_sorted_text_wp_filtered_to_worker(worker, models_list = None, priority_user_ids=None, after_wp=None, per_page=3): 
     # This is just the top 100 - Adjusted method to send Worker object. Filters to add.
     # TODO: Filter by (Worker in WP.workers) __ONLY IF__ len(WP.workers) >=1 
     # TODO: Filter by WP.trusted_workers == False __ONLY IF__ Worker.user.trusted == False
     # TODO: Filter by Worker not in WP.tricked_worker
     # TODO: If any word in the prompt is in the WP.blacklist rows, then exclude it (L293 in base.worker.Worker.gan_generate())
-    PER_PAGE = 3 # how many requests we're picking up to filter further
+    # per_page is how many requests we're picking up to filter further
     if len(models_list) >= 1:
         params = model_reference.get_text_model_multiplier(models_list[0])
         if params >= 20:
@@ -101,13 +101,16 @@ def get_sorted_text_wp_filtered_to_worker(worker, models_list = None, priority_u
     )
     if priority_user_ids:
         final_wp_list = final_wp_list.filter(TextWaitingPrompt.user_id.in_(priority_user_ids))
+    if after_wp is not None:
+        final_wp_list = final_wp_list.filter(filter_wps_after(TextWaitingPrompt, after_wp))
     # logger.debug(final_wp_list)
     final_wp_list = final_wp_list.order_by(
-        TextWaitingPrompt.extra_priority.desc(), 
-        TextWaitingPrompt.created.asc()
-    ).offset(PER_PAGE * page).limit(PER_PAGE)
+        TextWaitingPrompt.queue_priority.desc(), 
+        TextWaitingPrompt.created.asc(),
+        TextWaitingPrompt.id.asc(),
+    ).limit(per_page)
     # logger.debug(final_wp_list.all())
-    return final_wp_list.populate_existing().with_for_update(skip_locked=True, of=TextWaitingPrompt).all()
+    return final_wp_list.populate_existing().all()
 
 
 def get_text_wp_by_id(wp_id, lite=False):
@@ -150,7 +153,7 @@ def get_all_text_wps():
 
 def get_cached_worker_performance():
     if hr.horde_r == None:
-        return [p.performance for p in db.session.query(WorkerPerformance.performance).all()]
+        return [w.speed for w in db.session.query(WorkerTemplate.speed).filter(WorkerTemplate.fulfilments > 0).all()]
     perf_cache = hr.horde_r.get(f'worker_performances_cache')
     if not perf_cache:
         return refresh_worker_performances_cache()
@@ -166,7 +169,7 @@ def get_cached_worker_performance():
 #TODO: Convert below three functions into a general "cached db request" (or something) class
 # Which I can reuse to cache the results of other requests
 def retrieve_worker_performances():
-    avg_perf = db.session.query(func.avg(WorkerPerformance.performance)).scalar()
+    avg_perf = db.session.query(func.avg(WorkerTemplate.speed)).filter(WorkerTemplate.fulfilments > 0).scalar()
     if avg_perf is None:
         avg_perf = 0
     else:
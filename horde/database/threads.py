@@ -9,6 +9,7 @@ from sqlalchemy import func, or_
 
 from horde import horde_redis as hr
 from horde.classes.base.user import User
+from horde.classes.base.worker import WorkerTemplate, HEARTBEATS_KEY
 # FIXME: Renamed for backwards compat. To fix later
 from horde.classes.stable.waiting_prompt import ImageWaitingPrompt
 from horde.classes.kobold.waiting_prompt import TextWaitingPrompt
@@ -17,12 +18,16 @@ from horde.classes.kobold.processing_generation import TextProcessingGeneration
 from horde.classes.stable.interrogation import Interrogation, InterrogationForms
 from horde.flask import HORDE, db, SQLITE_MODE
 from horde.logger import logger
+from horde.database.classes import encode_wp_queue
 from horde.database.functions import (
+    QUEUE_SIZE_FIELD,
     query_prioritized_wps, 
+    query_dispatchable_wps, 
     get_active_workers, 
     get_available_models, 
     count_totals, 
     prune_expired_stats, 
+    apply_kudos_ledger,
     compile_regex_filter, 
     retrieve_regex_replacements
 )
@@ -32,6 +37,9 @@ from horde.r2 import delete_procgen_image, delete_source_image
 from horde.argparser import args
 from horde.patreon import patrons
 from horde.enums import State
+from horde import dispatch
+from horde.cached_request import get_cache_metrics
+from horde import vars as hv
 
 @logger.catch(reraise=True)
 def get_quorum():
@@ -72,30 +80,102 @@ def assign_monthly_kudos():
 
 @logger.catch(reraise=True)
 def store_prioritized_wp_queue():
-    '''Stores the retrieved WP queue as json for 1 second horde-wide'''
+    '''Stores the retrieved WP queue packed for 1 second horde-wide'''
     with HORDE.app_context():
         for wp_type in ["image", "text"]:
             wp_queue = query_prioritized_wps(wp_type)
-            serialized_wp_list = []
-            for wp in wp_queue:
-                wp_json = {
-                    "id": str(wp.id),
-                    "things": wp.things, 
-                    "n": wp.n, 
-                    "extra_priority": wp.extra_priority, 
-                    "created": wp.created.strftime("%Y-%m-%d %H:%M:%S"),
-                }
-                serialized_wp_list.append(wp_json)
-            try:
-                cached_queue = json.dumps(serialized_wp_list)
-                # We set the expiry in redis to 10 seconds, in case the primary thread dies
-                # However the primary thread is set to set the cache every 1 second
-                hr.horde_r_setex(f'{wp_type}_wp_cache', timedelta(seconds=5), cached_queue)
-            except (TypeError, OverflowError) as err:
-                logger.error(f"Failed serializing with error: {err}")
+            queue_version, packed_queue = encode_wp_queue(wp_queue)
+            # We set the expiry in redis to 5 seconds, in case the primary thread dies
+            # However the primary thread is set to set the cache every 1 second
+            hr.horde_r_setex_bytes(f'{wp_type}_wp_cache', timedelta(seconds=5), packed_queue)
+            hr.horde_r_setex(f'{wp_type}_wp_cache_version', timedelta(seconds=5), queue_version)
+            # We also store the position of each WP along with the running totals of the queue ahead of it
+            # So that a status check doesn't need to go through the whole queue
+            queue_ranks = {QUEUE_SIZE_FIELD: len(wp_queue)}
+            things_ahead_in_queue = 0
+            n_ahead_in_queue = 0
+            for rank, wp in enumerate(wp_queue):
+                things_ahead_in_queue += round(wp.things * wp.n/hv.thing_divisors["image"],2)
+                n_ahead_in_queue += wp.n
+                queue_ranks[str(wp.id)] = f"{rank},{round(things_ahead_in_queue,2)},{n_ahead_in_queue}"
+            hr.horde_r_replace_hash(f'{wp_type}_wp_queue_ranks', queue_ranks, expiry=timedelta(seconds=5))
 
 
 
+@logger.catch(reraise=True)
+def store_dispatch_index():
+    '''Rebuilds the whole WP dispatch index from the DB, 
+    to pick up any changes that the incremental updates might have missed
+    such as priority increases, restarted jobs and expired WPs
+    '''
+    with HORDE.app_context():
+        snapshot_time = time.time()
+        entries = [wp.get_dispatch_entry() for wp in query_dispatchable_wps("image")]
+        try:
+            dispatch.store_dispatch_index("image", entries, snapshot_time)
+            dispatch.store_skip_histogram("image", entries)
+        except (TypeError, OverflowError) as err:
+            logger.error(f"Failed serializing dispatch index with error: {err}")
+
+
+@logger.catch(reraise=True)
+def flush_worker_heartbeats():
+    '''Writes the worker check-ins which have been accumulating in redis to the DB in one transaction'''
+    with HORDE.app_context():
+        heartbeats = hr.horde_r_hgetall(HEARTBEATS_KEY)
+        if not heartbeats:
+            return
+        parsed_heartbeats = {}
+        stale_heartbeats = {}
+        for worker_id, raw_heartbeat in heartbeats.items():
+            heartbeat = json.loads(raw_heartbeat)
+            check_in_time = datetime.fromisoformat(heartbeat["check_in"])
+            # Workers which have stopped checking in are cleared from the hash, once we've written their last check-in
+            if datetime.utcnow() - check_in_time > timedelta(seconds=300):
+                stale_heartbeats[worker_id] = raw_heartbeat
+            parsed_heartbeats[worker_id] = (check_in_time, heartbeat["threads"])
+        worker_ids = list(parsed_heartbeats.keys())
+        if not SQLITE_MODE:
+            worker_ids = [uuid.UUID(worker_id) for worker_id in worker_ids]
+        workers = db.session.query(WorkerTemplate).filter(WorkerTemplate.id.in_(worker_ids)).all()
+        for worker in workers:
+            check_in_time, threads = parsed_heartbeats[str(worker.id)]
+            worker.record_check_in(check_in_time, threads)
+        db.session.commit()
+        # A worker might have checked in again since we read the hash, in which case we keep its new heartbeat
+        hr.horde_r_hdel_unchanged(HEARTBEATS_KEY, stale_heartbeats)
+
+
+@logger.catch(reraise=True)
+def log_cached_request_metrics():
+    '''Logs how each cached request has been doing horde-wide'''
+    for name, metrics in sorted(get_cache_metrics().items()):
+        hits = metrics.get("hits", 0) + metrics.get("stale_hits", 0) + metrics.get("waited_hits", 0)
+        reads = hits + metrics.get("misses", 0) + metrics.get("early_refreshes", 0) + metrics.get("expired_refreshes", 0)
+        recomputes = metrics.get("recomputes", 0)
+        avg_recompute = metrics.get("recompute_seconds", 0) / recomputes if recomputes else 0
+        logger.info(
+            f"Cached request {name}: {round(hits / reads * 100 if reads else 0, 1)}% hits of {int(reads)} reads, "
+            f"{int(metrics.get('stale_hits', 0))} stale, {int(metrics.get('misses', 0))} misses, "
+            f"{int(recomputes)} recomputes averaging {round(avg_recompute, 3)}s"
+        )
+
+
+@logger.catch(reraise=True)
+def flush_kudos_ledger():
+    '''Applies the kudos ledger to the stats tables, until it's caught up'''
+    with HORDE.app_context():
+        applied_events = 0
+        ledger_limit = 10000
+        while True:
+            batch_events = apply_kudos_ledger(ledger_limit)
+            applied_events += batch_events
+            if batch_events < ledger_limit:
+                break
+        if applied_events:
+            logger.debug(f"Applied {applied_events} kudos ledger events")
+
+
 @logger.catch(reraise=True)
 def store_worker_list():
     '''Stores the retrieved worker details as json for 300 seconds horde-wide'''
@@ -110,8 +190,10 @@ def store_worker_list():
         json_workers = json.dumps(serialized_workers)
         json_workers_privileged = json.dumps(serialized_workers_privileged)
         try:
-            hr.horde_r_setex('worker_cache', timedelta(seconds=300), json_workers)
-            hr.horde_r_setex('worker_cache_privileged', timedelta(seconds=300), json_workers_privileged)
+            hr.horde_r_mset_ex({
+                'worker_cache': json_workers,
+                'worker_cache_privileged': json_workers_privileged,
+            }, timedelta(seconds=300))
         except (TypeError, OverflowError) as err:
             logger.error(f"Failed serializing workers with error: {err}")
 
@@ -320,34 +402,6 @@ def store_patreon_members():
     hr.horde_r_set('patreon_cache', cached_patreons)
 
 
-@logger.catch(reraise=True)
-def increment_extra_priority():
-    '''Increases the priority of every WP currently in the queue by 50 kudos'''
-    with HORDE.app_context():
-        cutoff_time = datetime.utcnow()
-        for wp_class in [ImageWaitingPrompt, TextWaitingPrompt]:
-            wp_ids = db.session.query(
-                wp_class.id
-            ).filter(
-                wp_class.n > 0,
-                wp_class.faulted == False,
-                wp_class.active == True,
-                # Commented to avoid running into a deadlock with the WP delete thread
-                # wp_class.expiry > cutoff_time,
-            )
-            # logger.debug(f"Found {wp_ids.count()} of class {wp_class} to increase priority")
-            for wp in wp_ids.all():
-                db.session.query(
-                    wp_class
-                ).filter_by(
-                    id=wp.id
-                ).update(
-                    {wp_class.extra_priority: wp_class.extra_priority + 50},
-                    synchronize_session=False
-                )
-                db.session.commit()
-
-
 @logger.catch(reraise=True)
 def store_compiled_filter_regex():
     '''Compiles each filter as a final regex and stores it in redit'''
@@ -4,7 +4,7 @@ import regex as re
 from datetime import datetime
 import dateutil.relativedelta
 from horde.logger import logger
-from horde.horde_redis import horde_r_get
+from horde.horde_redis import horde_r_get, horde_r_get_decoded
 from horde.flask import HORDE, SQLITE_MODE # Local Testing
 from horde.database.functions import compile_regex_filter, retrieve_regex_replacements
 from horde.model_reference import model_reference
@@ -74,15 +74,14 @@ class PromptChecker:
             with HORDE.app_context():
                 stored_replacements = retrieve_regex_replacements(filter_type=10)
         else:
-            cached_replacements = horde_r_get("cached_regex_replacements")
-            if not cached_replacements:
-                logger.warning("No cached regex replacements found in redis! Check threads!")
-                stored_replacements = []
             try:
-                stored_replacements = json.loads(cached_replacements)
+                stored_replacements = horde_r_get_decoded("cached_regex_replacements")
             except:
                 logger.warning("Errors when loading cached regex replacements in redis! Check threads!")
                 stored_replacements = []
+            if stored_replacements is None:
+                logger.warning("No cached regex replacements found in redis! Check threads!")
+                stored_replacements = []
         for id in [10, 11, 20]:
             filter_id = f"filter_{id}"
             if SQLITE_MODE:
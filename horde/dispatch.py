@@ -0,0 +1,396 @@
+import os
+import json
+import time
+import threading
+from datetime import datetime, timedelta
+
+from horde.logger import logger
+from horde import horde_redis as hr
+from horde.bridge_reference import get_bridge_profile
+
+# The capability flags a waiting prompt can require from a worker
+# A worker can only pick up a WP when it supports all the flags set on it
+DF_IMG2IMG = 1
+DF_PAINTING = 1 << 1
+DF_UNSAFE_IP = 1 << 2
+DF_NSFW = 1 << 3
+DF_R2 = 1 << 4
+DF_LORA = 1 << 5
+DF_TI = 1 << 6
+DF_POST_PROCESSING = 1 << 7
+DF_CONTROLNET = 1 << 8
+DF_FAST_WORKERS = 1 << 9
+DF_TRUSTED = 1 << 10
+DF_HIRES_FIX = 1 << 11
+DF_RETURN_CONTROL_MAP = 1 << 12
+DF_TILING = 1 << 13
+
+# We bucket the WPs by their resolution, so that small workers don't even look at the large requests
+PIXEL_TIERS = [512*512, 768*768, 1024*1024, 1536*1536, 2048*2048, 3072*3072]
+# How often each node reloads its in-memory copy of the index from redis
+REFRESH_SECONDS = 1
+# If the primary hasn't rebuilt the index in this time, we fall back to querying the DB
+INDEX_TTL_SECONDS = 30
+# The most a worker can park its pop, waiting for new WPs to arrive
+MAX_POP_WAIT_SECONDS = 30
+# Each parked pop holds one of the 45 waitress threads, so only a few of them can be parked at the same time
+MAX_PARKED_POPS = int(os.getenv("MAX_PARKED_POPS", 10))
+
+
+def get_pixel_tier(pixels):
+    for tier, max_tier_pixels in enumerate(PIXEL_TIERS):
+        if pixels <= max_tier_pixels:
+            return tier
+    return len(PIXEL_TIERS)
+
+def get_tier_min_pixels(tier):
+    '''The smallest amount of pixels a WP in this tier can have'''
+    if tier == 0:
+        return 0
+    return PIXEL_TIERS[tier - 1] + 1
+
+def get_index_key(wp_type):
+    return f"{wp_type}_dispatch_index"
+
+def get_built_key(wp_type):
+    return f"{wp_type}_dispatch_index_built"
+
+def get_histogram_key(wp_type):
+    return f"{wp_type}_skip_tier_histogram"
+
+def get_new_wp_channel(wp_type, model_name):
+    return f"{wp_type}_new_wp:{model_name}"
+
+def to_epoch(dt):
+    return (dt - datetime(1970, 1, 1)).total_seconds()
+
+
+def index_wp(wp):
+    '''Adds or updates a WP in the horde-wide dispatch index'''
+    if not hr.horde_r:
+        return
+    entry = wp.get_dispatch_entry()
+    if entry is None:
+        return
+    # The full rebuilds don't overwrite or remove entries indexed after they took their snapshot
+    entry["indexed"] = time.time()
+    try:
+        hr.horde_r_hset(get_index_key(wp.wp_type), entry["id"], json.dumps(entry))
+    except Exception as err:
+        logger.warning(f"Failed to index wp {wp.id} for dispatch: {err}")
+
+def unindex_wp(wp):
+    '''Removes a WP from the horde-wide dispatch index, once it doesn't need any more gens'''
+    if not hr.horde_r:
+        return
+    try:
+        hr.horde_r_hdel(get_index_key(wp.wp_type), str(wp.id))
+    except Exception as err:
+        logger.warning(f"Failed to unindex wp {wp.id} from dispatch: {err}")
+
+def notify_new_wp(wp):
+    '''Wakes up the workers which are waiting on a pop for the models of this WP'''
+    if not hr.horde_r:
+        return
+    # A WP without models is announced on the '' channel, which all workers listen to
+    channels = [get_new_wp_channel(wp.wp_type, model_name) for model_name in wp.get_model_names() or ['']]
+    try:
+        hr.horde_r_publish(channels)
+    except Exception as err:
+        logger.warning(f"Failed to announce new wp {wp.id}: {err}")
+
+def store_dispatch_index(wp_type, entries, snapshot_time):
+    '''Merges a full snapshot of the dispatchable WPs, taken from the DB at snapshot_time, into the dispatch index
+    WPs indexed or unindexed by the nodes since the snapshot was taken are left as they are
+    Only the primary should be doing this
+    '''
+    index_key = get_index_key(wp_type)
+    current_index = hr.horde_r_hgetall(index_key) or {}
+    newer_ids = set()
+    stale_entries = {}
+    snapshot_ids = set(entry["id"] for entry in entries)
+    for wp_id, raw_entry in current_index.items():
+        if json.loads(raw_entry).get("indexed", 0) >= snapshot_time:
+            newer_ids.add(wp_id)
+        elif wp_id not in snapshot_ids:
+            stale_entries[wp_id] = raw_entry
+    mapping = {}
+    for entry in entries:
+        if entry["id"] in newer_ids:
+            continue
+        entry["indexed"] = snapshot_time
+        mapping[entry["id"]] = json.dumps(entry)
+    hr.horde_r_hset_many(index_key, mapping)
+    # If an entry has been written again since we read it, it's not stale anymore
+    hr.horde_r_hdel_unchanged(index_key, stale_entries)
+    hr.horde_r_setex(get_built_key(wp_type), timedelta(seconds=INDEX_TTL_SECONDS), 1)
+
+def store_skip_histogram(wp_type, entries):
+    '''Counts the open WPs per combination of features which can cause a worker to skip them
+    This allows us to tell idle workers why they're not getting any jobs, without querying the DB
+    The pixels are bucketed by PIXEL_TIERS so that the amount of combinations stays small
+    and the few WPs restricted to specific workers are counted on their own
+    '''
+    histogram = {}
+    restricted = {}
+    for entry in entries:
+        feature_key = (
+            tuple(sorted(entry["models"])),
+            get_pixel_tier(entry["pixels"]),
+            entry["flags"],
+            entry["sampler"],
+            entry["karras"],
+        )
+        histogram[feature_key] = histogram.get(feature_key, 0) + 1
+        if len(entry["workers"]):
+            restricted_key = (tuple(sorted(entry["workers"])), entry["worker_blacklist"])
+            restricted[restricted_key] = restricted.get(restricted_key, 0) + 1
+    serialized_histogram = {
+        "features": [],
+        "restricted": [],
+    }
+    for feature_key, count in histogram.items():
+        models, tier, flags, sampler, karras = feature_key
+        serialized_histogram["features"].append({
+            "models": models,
+            "tier": tier,
+            "flags": flags,
+            "sampler": sampler,
+            "karras": karras,
+            "count": count,
+        })
+    for restricted_key, count in restricted.items():
+        workers, worker_blacklist = restricted_key
+        serialized_histogram["restricted"].append({
+            "workers": workers,
+            "worker_blacklist": worker_blacklist,
+            "count": count,
+        })
+    hr.horde_r_setex_json(get_histogram_key(wp_type), timedelta(seconds=INDEX_TTL_SECONDS), serialized_histogram)
+
+def retrieve_skip_histogram(wp_type):
+    if not hr.horde_r:
+        return None
+    return hr.horde_r_get_json(get_histogram_key(wp_type))
+
+
+class DispatchIndex:
+    '''In-memory copy of the dispatch index of one WP type
+    WPs are bucketed by model, pixel tier and required capability flags
+    so that a worker only needs to look at the buckets it can serve
+    '''
+
+    def __init__(self, wp_type):
+        self.wp_type = wp_type
+        self.buckets = None
+        self.last_refresh = 0
+        # The raw and parsed entries of the last refresh, so that only the changed entries are parsed again
+        self.entries = {}
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def start(self):
+        '''The index is reloaded by its own thread, so that the request threads never wait on it'''
+        with self.lock:
+            if self.thread is not None and self.thread.is_alive():
+                return
+            self.thread = threading.Thread(target=self.keep_refreshed, daemon=True)
+            self.thread.start()
+
+    def keep_refreshed(self):
+        while True:
+            self.refresh()
+            time.sleep(REFRESH_SECONDS)
+
+    def refresh(self):
+        try:
+            if not hr.horde_r_get(get_built_key(self.wp_type)):
+                self.buckets = None
+                return
+            raw_index = hr.horde_r_hgetall(get_index_key(self.wp_type))
+            if raw_index is None:
+                self.buckets = None
+                return
+            entries = {}
+            changed = len(raw_index) != len(self.entries)
+            for wp_id, raw_entry in raw_index.items():
+                previous = self.entries.get(wp_id)
+                if previous is not None and previous[0] == raw_entry:
+                    entries[wp_id] = previous
+                    continue
+                entries[wp_id] = (raw_entry, json.loads(raw_entry))
+                changed = True
+            self.entries = entries
+            if changed or self.buckets is None:
+                buckets = {}
+                for _, entry in entries.values():
+                    bucket_key = (get_pixel_tier(entry["pixels"]), entry["flags"])
+                    # A WP without models can be picked up by any model, so it goes into the '' bucket
+                    for model_name in entry["models"] or ['']:
+                        buckets.setdefault(model_name, {}).setdefault(bucket_key, []).append(entry)
+                self.buckets = buckets
+            self.last_refresh = time.time()
+        except Exception as err:
+            logger.error(f"Failed to refresh {self.wp_type} dispatch index: {err}")
+            self.buckets = None
+
+    def get_buckets(self):
+        '''Returns the current buckets, or None if the index is not available'''
+        self.start()
+        # If our refresh thread has fallen behind, it's safer to go to the DB
+        if time.time() - self.last_refresh > INDEX_TTL_SECONDS:
+            return None
+        return self.buckets
+
+    def is_ready(self):
+        return self.get_buckets() is not None
+
+    def find_candidates(self, worker, worker_flags, models_list, priority_user_ids=None, after_wp=None):
+        '''Returns the sorted WP ids this worker can serve, or None if the index is not available
+        When after_wp is passed, only the WPs sorted after it are returned
+        '''
+        buckets = self.get_buckets()
+        if buckets is None:
+            return None
+        if not models_list: models_list = []
+        model_names = list(models_list)
+        if not any("horde_special" in mname for mname in models_list) and "SDXL_beta::stability.ai#6901" not in models_list:
+            model_names.append('')
+        now = to_epoch(datetime.utcnow())
+        worker_id = str(worker.id)
+        candidates = {}
+        for model_name in model_names:
+            for (tier, flags), entries in buckets.get(model_name, {}).items():
+                if get_tier_min_pixels(tier) > worker.max_pixels:
+                    continue
+                if flags & ~worker_flags:
+                    continue
+                for entry in entries:
+                    if entry["id"] in candidates:
+                        continue
+                    if entry["pixels"] > worker.max_pixels:
+                        continue
+                    if entry["expiry"] <= now:
+                        continue
+                    if priority_user_ids and entry["user_id"] not in priority_user_ids:
+                        continue
+                    if worker.maintenance and entry["user_id"] != worker.user_id:
+                        continue
+                    if len(entry["workers"]):
+                        if entry["worker_blacklist"] == (worker_id in entry["workers"]):
+                            continue
+                    candidates[entry["id"]] = entry
+        sort_key = lambda e: (-e["queue_priority"], e["created"], e["id"])
+        sorted_candidates = sorted(candidates.values(), key=sort_key)
+        if after_wp is not None:
+            after_key = (-after_wp.queue_priority, to_epoch(after_wp.created), str(after_wp.id))
+            sorted_candidates = [entry for entry in sorted_candidates if sort_key(entry) > after_key]
+        return [entry["id"] for entry in sorted_candidates]
+
+
+class NewWPListener:
+    '''Listens for newly activated WPs and wakes up the pops which are waiting for them
+    We only keep a single redis subscription per process, no matter how many pops are waiting
+    '''
+
+    def __init__(self, max_parked=MAX_PARKED_POPS):
+        # Each channel points to the events of the pops waiting on it
+        self.waiters = {}
+        self.lock = threading.Lock()
+        self.thread = None
+        self.parking = threading.BoundedSemaphore(max_parked)
+
+    def park(self):
+        '''Reserves a spot for a pop to wait for new WPs
+        Returns False if too many pops are already parked, in which case the pop should return straight away
+        '''
+        return self.parking.acquire(blocking=False)
+
+    def unpark(self):
+        self.parking.release()
+
+    def start(self):
+        with self.lock:
+            if self.thread is not None and self.thread.is_alive():
+                return
+            self.thread = threading.Thread(target=self.listen, daemon=True)
+            self.thread.start()
+
+    def listen(self):
+        while True:
+            try:
+                pubsub = hr.horde_r.pubsub(ignore_subscribe_messages=True)
+                pubsub.psubscribe(get_new_wp_channel('*', '*'))
+                while True:
+                    # We poll instead of blocking on listen(), which would hit the socket timeout when no WPs arrive
+                    message = pubsub.get_message(timeout=1)
+                    if message is not None:
+                        self.wake(message["channel"])
+            except Exception as err:
+                logger.warning(f"Lost the subscription to new wps: {err}. Reconnecting...")
+                time.sleep(1)
+
+    def wake(self, channel):
+        with self.lock:
+            for event in self.waiters.get(channel, []):
+                event.set()
+
+    def wait(self, wp_type, models_list, timeout):
+        '''Blocks until a WP for one of these models is activated, or until the timeout passes
+        Returns True if a new WP arrived
+        '''
+        if not hr.horde_r or timeout <= 0:
+            return False
+        self.start()
+        if not models_list: models_list = []
+        channels = [get_new_wp_channel(wp_type, model_name) for model_name in list(models_list) + ['']]
+        event = threading.Event()
+        with self.lock:
+            for channel in channels:
+                self.waiters.setdefault(channel, []).append(event)
+        try:
+            return event.wait(timeout)
+        finally:
+            with self.lock:
+                for channel in channels:
+                    self.waiters[channel].remove(event)
+                    if len(self.waiters[channel]) == 0:
+                        del self.waiters[channel]
+
+
+def get_image_worker_flags(worker):
+    '''Returns the capability flags this worker can serve'''
+    worker_flags = 0
+    bridge = get_bridge_profile(worker.bridge_agent)
+    if worker.allow_img2img:
+        worker_flags |= DF_IMG2IMG
+    if worker.allow_painting:
+        worker_flags |= DF_PAINTING
+    if worker.allow_unsafe_ipaddr:
+        worker_flags |= DF_UNSAFE_IP
+    if worker.nsfw:
+        worker_flags |= DF_NSFW
+    if bridge.has_capability("r2"):
+        worker_flags |= DF_R2
+    if worker.allow_lora and bridge.has_capability("lora"):
+        worker_flags |= DF_LORA
+    if bridge.has_capability("textual_inversion"):
+        worker_flags |= DF_TI
+    if worker.allow_post_processing and bridge.has_capability("post-processing"):
+        worker_flags |= DF_POST_PROCESSING
+    if worker.allow_controlnet and bridge.has_capability("controlnet"):
+        worker_flags |= DF_CONTROLNET
+    if worker.speed >= 500000: # 0.5 MPS/s
+        worker_flags |= DF_FAST_WORKERS
+    if worker.user.trusted:
+        worker_flags |= DF_TRUSTED
+    if bridge.has_capability("hires_fix"):
+        worker_flags |= DF_HIRES_FIX
+    if bridge.has_capability("return_control_map"):
+        worker_flags |= DF_RETURN_CONTROL_MAP
+    if bridge.has_capability("tiling"):
+        worker_flags |= DF_TILING
+    return worker_flags
+
+image_dispatch_index = DispatchIndex("image")
+new_wp_listener = NewWPListener()
@@ -29,4 +29,10 @@ class UserRoleTypes(enum.Enum):
     CUSTOMIZER = 4
     VPN = 5
     SPECIAL = 6
+
+class LedgerEventTypes(enum.Enum):
+    USER_KUDOS = 0
+    USER_RECORD = 1
+    WORKER_KUDOS = 2
+    TEAM = 3
     
@@ -1,18 +1,43 @@
 from datetime import timedelta
 import json
+import time
 from threading import Lock
+from concurrent.futures import ThreadPoolExecutor
 
 from horde.redis_ctrl import get_horde_db, is_redis_up, get_local_horde_db, is_local_redis_up, get_all_redis_db_servers
 from horde.logger import logger
 
 locks = {}
+# The decoded values of redis keys, shared by all threads of this process
+# Each entry is key: (expiry, raw_value, decoded_value)
+decoded_values = {}
+decoded_value_locks = {}
+# Deletes each field of KEYS[1] given in ARGV, only if its value is the one which follows it in ARGV
+HDEL_UNCHANGED_SCRIPT = """
+local deleted = 0
+for i = 1, #ARGV, 2 do
+    if redis.call("hget", KEYS[1], ARGV[i]) == ARGV[i + 1] then
+        deleted = deleted + redis.call("hdel", KEYS[1], ARGV[i])
+    end
+end
+return deleted
+"""
 
 horde_r = None
 all_horde_redis = []
+# Writes go to all redis servers in parallel, so that each of them doesn't add its own round trip
+redis_write_executor = None
+# These connections don't decode the responses, so that they can store binary values
+horde_r_raw = None
+all_horde_redis_raw = []
 logger.init("Horde Redis", status="Connecting")
 if is_redis_up():
     horde_r = get_horde_db()
     all_horde_redis = get_all_redis_db_servers()
+    horde_r_raw = get_horde_db(decode_responses=False)
+    all_horde_redis_raw = get_all_redis_db_servers(decode_responses=False)
+    if len(all_horde_redis) > 1:
+        redis_write_executor = ThreadPoolExecutor(max_workers=len(all_horde_redis) * 4, thread_name_prefix="redis_write")
     logger.init_ok("Horde Redis", status="Connected")
 else:
     logger.init_err("Horde Redis", status="Failed")
@@ -26,20 +51,83 @@ if is_local_redis_up():
 else:
     logger.init_err("Horde Local Redis", status="Failed")
 
-def horde_r_set(key, value):
-    for hr in all_horde_redis:
-        hr.set(key, value)
-    if horde_local_r:
-        horde_local_r.setex(key, timedelta(10), value)
+def pipeline_to_all(servers, queue_commands, local_write=None, transaction=False):
+    """Sends the same commands to all the redis servers, each in a single pipeline
+    The pipelines are sent in parallel, and we wait until all of them have been executed
+    `local_write` is done while we're waiting on the remote servers
+    """
+    if redis_write_executor is None or len(servers) <= 1:
+        for hr in servers:
+            pipe = hr.pipeline(transaction=transaction)
+            queue_commands(pipe)
+            pipe.execute()
+        if local_write:
+            local_write()
+        return
 
-def horde_r_setex(key, expiry, value):
-    for hr in all_horde_redis:
-        hr.setex(key, expiry, value)
+    def execute_pipeline(hr):
+        pipe = hr.pipeline(transaction=transaction)
+        queue_commands(pipe)
+        pipe.execute()
+
+    futures = [redis_write_executor.submit(execute_pipeline, hr) for hr in servers]
+    try:
+        if local_write:
+            local_write()
+    finally:
+        # We raise the first error only after all servers had their chance to be written to
+        for future in futures:
+            future.exception()
+    for future in futures:
+        future.result()
+
+def get_local_expiry(expiry):
     # We don't keep local cache for more than 5 seconds
     if expiry > timedelta(5):
-        expiry = timedelta(5)
-    if horde_local_r:
-        horde_local_r.setex(key, expiry, value)
+        return timedelta(5)
+    return expiry
+
+def horde_r_set(key, value):
+    def local_write():
+        if horde_local_r:
+            horde_local_r.setex(key, timedelta(10), value)
+    pipeline_to_all(all_horde_redis, lambda pipe: pipe.set(key, value), local_write)
+
+def horde_r_setex(key, expiry, value):
+    def local_write():
+        if horde_local_r:
+            horde_local_r.setex(key, get_local_expiry(expiry), value)
+    pipeline_to_all(all_horde_redis, lambda pipe: pipe.setex(key, expiry, value), local_write)
+
+def horde_r_mset_ex(mapping, expiry):
+    """Same as horde_r_setex() for multiple keys with the same expiry
+    Each redis server only gets a single round trip for all of them
+    """
+    if len(mapping) == 0:
+        return
+
+    def queue_setex(pipe):
+        for key, value in mapping.items():
+            pipe.setex(key, expiry, value)
+
+    def local_write():
+        if horde_local_r:
+            local_expiry = get_local_expiry(expiry)
+            pipe = horde_local_r.pipeline(transaction=False)
+            for key, value in mapping.items():
+                pipe.setex(key, local_expiry, value)
+            pipe.execute()
+    pipeline_to_all(all_horde_redis, queue_setex, local_write)
+
+
+def horde_r_delete(*keys):
+    if len(keys) == 0:
+        return
+
+    def local_write():
+        if horde_local_r:
+            horde_local_r.delete(*keys)
+    pipeline_to_all(all_horde_redis, lambda pipe: pipe.delete(*keys), local_write)
 
 
 def horde_r_setex_json(key, expiry, value):
@@ -71,6 +159,17 @@ def horde_local_setex_to_json(key, seconds, value):
             logger.error(f"Something went wrong when setting local redis: {e}")
         locks[key].release()
 
+def horde_r_setex_bytes(key, expiry, value):
+    """Same as horde_r_setex() but for binary values
+    These are not kept in the local redis cache
+    """
+    pipeline_to_all(all_horde_redis_raw, lambda pipe: pipe.setex(key, expiry, value))
+
+def horde_r_get_bytes(key):
+    if not horde_r_raw:
+        return None
+    return horde_r_raw.get(key)
+
 def horde_r_get(key):
     """Retrieves the value from local redis if it exists
     If it doesn't exist retrieves it from remote redis
@@ -94,6 +193,37 @@ def horde_r_get(key):
                 horde_local_r.setex(key, timedelta(seconds=abs(ttl)), value)
     return value
 
+def horde_r_get_decoded(key, decoder=json.loads, ttl=1):
+    """Same as horde_r_get() but returns the value already decoded
+    The decoded value is kept in memory for `ttl` seconds and shared by all threads,
+    so callers should never modify it.
+    When it expires, only one thread retrieves it again, while the others keep using the stale value.
+    If the raw value hasn't changed, it is not decoded again.
+    """
+    entry = decoded_values.get(key)
+    if entry is not None and entry[0] > time.monotonic():
+        return entry[2]
+    lock = decoded_value_locks.setdefault(key, Lock())
+    # If there's no value to serve in the meantime, we wait for the thread refreshing it
+    if not lock.acquire(blocking=entry is None):
+        return entry[2]
+    try:
+        entry = decoded_values.get(key)
+        if entry is not None and entry[0] > time.monotonic():
+            return entry[2]
+        value = horde_r_get(key)
+        if value is None:
+            decoded_values.pop(key, None)
+            return None
+        if entry is not None and entry[1] == value:
+            decoded_value = entry[2]
+        else:
+            decoded_value = decoder(value)
+        decoded_values[key] = (time.monotonic() + ttl, value, decoded_value)
+        return decoded_value
+    finally:
+        lock.release()
+
 def horde_r_get_json(key):
     """Same as horde_r_get()
     but also converts the json to python built-ins
@@ -102,3 +232,58 @@ def horde_r_get_json(key):
     if value is None:
         return None
     return json.loads(value)
+
+def horde_r_hset(key, field, value):
+    pipeline_to_all(all_horde_redis, lambda pipe: pipe.hset(key, field, value))
+
+def horde_r_hset_many(key, mapping):
+    if len(mapping) == 0:
+        return
+    pipeline_to_all(all_horde_redis, lambda pipe: pipe.hset(key, mapping=mapping))
+
+def horde_r_hdel(key, *fields):
+    if len(fields) == 0:
+        return
+    pipeline_to_all(all_horde_redis, lambda pipe: pipe.hdel(key, *fields))
+
+def horde_r_hdel_unchanged(key, mapping):
+    """Deletes the fields of the hash only if they still have the value given in the mapping
+    so that we don't delete a value which was written after we read it
+    """
+    if len(mapping) == 0:
+        return
+    args = []
+    for field, value in mapping.items():
+        args += [field, value]
+    pipeline_to_all(all_horde_redis, lambda pipe: pipe.eval(HDEL_UNCHANGED_SCRIPT, 1, key, *args))
+
+def horde_r_replace_hash(key, mapping, expiry=None):
+    """Atomically replaces the whole hash in all redis servers"""
+    def queue_replace(pipe):
+        pipe.delete(key)
+        if len(mapping) > 0:
+            pipe.hset(key, mapping=mapping)
+            if expiry is not None:
+                pipe.expire(key, expiry)
+    pipeline_to_all(all_horde_redis, queue_replace, transaction=True)
+
+def horde_r_publish(channels, message=1):
+    """Publishes the same message to multiple channels in all redis servers
+    Subscribers can be connected to any of them
+    """
+    def queue_publish(pipe):
+        for channel in channels:
+            pipe.publish(channel, message)
+    pipeline_to_all(all_horde_redis, queue_publish)
+
+def horde_r_hmget(key, *fields):
+    """Hashes are never stored in the local redis, as they're partially updated"""
+    if not horde_r:
+        return None
+    return horde_r.hmget(key, *fields)
+
+def horde_r_hgetall(key):
+    """Hashes are never stored in the local redis, as they're partially updated"""
+    if not horde_r:
+        return None
+    return horde_r.hgetall(key)
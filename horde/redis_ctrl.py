@@ -1,7 +1,7 @@
 import os
-import socket
 import redis
 import json
+from threading import Lock
 
 from horde.logger import logger
 
@@ -15,14 +15,57 @@ ipaddr_db = 2
 cache_db = 3
 ipaddr_supicion_db = 4
 ipaddr_timeout_db = 5
+local_horde_db = 6
+
+# The waitress server runs 45 threads, on top of the background threads of each node
+# Once all connections of a pool are in use, further requests wait for one to be freed
+REDIS_MAX_CONNECTIONS = int(os.getenv("REDIS_MAX_CONNECTIONS", 64))
+# All clients to the same server and db share their connection pool
+redis_clients = {}
+redis_clients_lock = Lock()
+# Each redis server is only probed once on startup
+redis_servers_up = {}
+
+if redis.utils.HIREDIS_AVAILABLE:
+    logger.init_ok("Redis Parser", status="hiredis")
+else:
+    logger.init_warn("Redis Parser", status="Python (pip install hiredis for faster parsing)")
+
+def get_redis_client(host, port, db, decode_responses=False):
+    client_key = (host, port, db, decode_responses)
+    with redis_clients_lock:
+        if client_key not in redis_clients:
+            pool = redis.BlockingConnectionPool(
+                host=host,
+                port=port,
+                db=db,
+                decode_responses=decode_responses,
+                max_connections=REDIS_MAX_CONNECTIONS,
+                # How long to wait for a free connection from the pool
+                timeout=5,
+                socket_timeout=5,
+                socket_connect_timeout=2,
+                socket_keepalive=True,
+                health_check_interval=30,
+            )
+            redis_clients[client_key] = redis.Redis(connection_pool=pool)
+        return redis_clients[client_key]
+
+def is_server_up(host, port, db) -> bool:
+    server_key = (host, port)
+    if server_key not in redis_servers_up:
+        try:
+            # The connection used to ping stays in the pool to be reused
+            redis_servers_up[server_key] = get_redis_client(host, port, db).ping()
+        except redis.exceptions.RedisError:
+            redis_servers_up[server_key] = False
+    return redis_servers_up[server_key]
 
 def is_redis_up() -> bool:
-    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-        return s.connect_ex((redis_hostname, redis_port)) == 0
+    return is_server_up(redis_hostname, redis_port, horde_db)
 
 def is_local_redis_up() -> bool:
-    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-        return s.connect_ex(("127.0.0.1", 6379)) == 0
+    return is_server_up("127.0.0.1", 6379, local_horde_db)
 
 def ger_limiter_url():
     return(f"{redis_address}/{limiter_db}")
@@ -30,52 +73,31 @@ def ger_limiter_url():
 def ger_cache_url():
     return(f"{redis_address}/{cache_db}")
 
-def get_horde_db():
-    return redis.Redis(
-        host=redis_hostname,
-        port=redis_port,
-        db = horde_db,
-        decode_responses=True)
+def get_horde_db(decode_responses=True):
+    return get_redis_client(redis_hostname, redis_port, horde_db, decode_responses)
 
 def get_local_horde_db():
-    return redis.Redis(
-        host="127.0.0.1",
-        port=6379,
-        db = 6,
-        decode_responses=True)
+    return get_redis_client("127.0.0.1", 6379, local_horde_db, decode_responses=True)
 
 def get_ipaddr_db():
-    return redis.Redis(
-        host=redis_hostname,
-        port=redis_port,
-        db = ipaddr_db)
+    return get_redis_client(redis_hostname, redis_port, ipaddr_db)
 
 def get_ipaddr_suspicion_db():
-    return redis.Redis(
-        host=redis_hostname,
-        port=redis_port,
-        db = ipaddr_supicion_db)
+    return get_redis_client(redis_hostname, redis_port, ipaddr_supicion_db)
 
 def get_ipaddr_timeout_db():
-    return redis.Redis(
-        host=redis_hostname,
-        port=redis_port,
-        db = ipaddr_timeout_db)
-
-def get_redis_db_server(server_ip):
-    return redis.Redis(
-        host=server_ip,
-        port=redis_port,
-        db = horde_db,
-        decode_responses=True)
-
-def get_all_redis_db_servers():
+    return get_redis_client(redis_hostname, redis_port, ipaddr_timeout_db)
+
+def get_redis_db_server(server_ip, decode_responses=True):
+    return get_redis_client(server_ip, redis_port, horde_db, decode_responses)
+
+def get_all_redis_db_servers(decode_responses=True):
     """An array of all the redis servers in the cluster
     We use this to always store the entries in all servers
     This allows redis to transparently failover.
     """
     try:
-        return [get_redis_db_server(rs) for rs in json.loads(os.getenv("REDIS_SERVERS"))]
+        return [get_redis_db_server(rs, decode_responses) for rs in json.loads(os.getenv("REDIS_SERVERS"))]
     except:
         logger.error(f"Error setting up REDIS_SERVERS array. Falling back to loadbalancer.")
-        return [get_horde_db()]
+        return [get_horde_db(decode_responses)]
@@ -230,6 +230,7 @@ def register():
             if is_profane(username):
                 return render_template('bad_username.html', page_title="Bad Username")
             user.username = username
+            # The old key is dropped from the api key cache once this is committed
             user.api_key = hashed_api_key
             db.session.commit()
         else: